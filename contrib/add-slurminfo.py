@@ -7,6 +7,9 @@ sams-collector, add SlurmInfo from sacct and save the result in new
 JSON files that can later be fed to sams-aggregator. Files in input
 directory are removed.
 
+The jobids of the files are fetched from sacct many at the time, in
+--workers calls of --chunk-size jobids running at the same time.
+
 add-slurminfo --in=/input/dir --out=/output/dir --error=/error/dir
 """
 
@@ -28,6 +31,10 @@ CONFIG = {
     "sams.loader.FileSlurmInfoFallback": {
         "environment": {"TZ": "UTC"},
         "file_pattern": "^.*\\.json$",
+        "sort": "jobid",
+        "sacct_prefetch": 10000,
+        # The files are expected to have no SlurmInfo
+        "sacct_prefetch_files": True,
     },
 }
 
@@ -51,6 +58,9 @@ class Main:
         parser.add_argument("--in", help="Input directory", required=True, dest="in_dir")
         parser.add_argument("--out", help="Output directory", required=True)
         parser.add_argument("--error", help="Error directory", required=True)
+        parser.add_argument("--cache", help="File caching the jobs fetched from sacct")
+        parser.add_argument("--chunk-size", type=int, default=500, help="Jobids in each sacct call")
+        parser.add_argument("--workers", type=int, default=4, help="Number of sacct calls at the same time")
         args = parser.parse_args()
 
         # Add arguments to CONFIG
@@ -58,6 +68,9 @@ class Main:
             "in_path": args.in_dir,
             "archive_path": args.out,
             "error_path": args.error,
+            "sacct_cache": args.cache,
+            "sacct_chunk_size": args.chunk_size,
+            "sacct_workers": args.workers,
         }.items():
             CONFIG["sams.loader.FileSlurmInfoFallback"][k] = v
 
@@ -99,6 +112,7 @@ class Main:
                 logger.error(e)
                 loader.error()
                 continue
+        loader.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""Load generator for sams-post-receiver
+
+Sends collector like records to a running sams-post-receiver from many
+threads and reports requests per second and latency percentiles.
+
+post-receiver-loadgen.py --uri=http://127.0.0.1:8080 --requests=10000 --concurrency=32
+"""
+
+import json
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+import requests
+
+
+def record(jobid, size):
+    return {
+        "sams.sampler.Core": {"jobid": jobid, "node": "loadgen"},
+        "sams.sampler.Software": {"execs": {"/sw/app/bin/app": {"user": 1.0, "system": 0.1}}},
+        "padding": "x" * size,
+    }
+
+
+class Worker(threading.Thread):
+    def __init__(self, args, jobids):
+        super().__init__()
+        self.args = args
+        self.jobids = jobids
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        session = requests.Session()
+        for jobid in self.jobids:
+            if self.args.batch > 1:
+                uri = "%s/batch" % self.args.uri
+                body = "".join(
+                    json.dumps({"jobid": j, "filename": "%d.loadgen.json" % j, "data": record(j, self.args.size)}) + "\n"
+                    for j in range(jobid, jobid + self.args.batch)
+                )
+            else:
+                uri = "%s/%d/%d.loadgen.json" % (self.args.uri, jobid, jobid)
+                body = json.dumps(record(jobid, self.args.size))
+            start = time.perf_counter()
+            try:
+                response = session.post(uri, data=body, timeout=60)
+                if response.status_code != 200:
+                    self.errors += 1
+            except requests.RequestException:
+                self.errors += 1
+            self.latencies.append(time.perf_counter() - start)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = ArgumentParser(description="Load generator for sams-post-receiver")
+    parser.add_argument("--uri", default="http://127.0.0.1:8080", help="Receiver URI")
+    parser.add_argument("--requests", type=int, default=10000, help="Number of requests")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of client threads")
+    parser.add_argument("--size", type=int, default=2048, help="Padding bytes in each record")
+    parser.add_argument("--batch", type=int, default=1, help="Records in each request, >1 uses /batch")
+    parser.add_argument("--first-jobid", type=int, default=1, help="First jobid to use")
+    args = parser.parse_args()
+
+    jobids = list(range(args.first_jobid, args.first_jobid + args.requests * args.batch, args.batch))
+    workers = [Worker(args, jobids[i :: args.concurrency]) for i in range(args.concurrency)]
+
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for worker in workers for latency in worker.latencies)
+    errors = sum(worker.errors for worker in workers)
+    print("requests: %d errors: %d time: %.2fs" % (len(latencies), errors, elapsed))
+    print("requests/s: %.1f records/s: %.1f" % (len(latencies) / elapsed, len(latencies) * args.batch / elapsed))
+    if latencies:
+        print(
+            "latency ms p50: %.1f p90: %.1f p99: %.1f max: %.1f"
+            % tuple(x * 1000 for x in (percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99), latencies[-1]))
+        )
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
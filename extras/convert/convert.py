@@ -3,8 +3,8 @@ import sqlite3
 import sys
 
 import sams.core
+from sams.backend.SoftwareAccountingPW import SEED_EXTRACT_QUEUE, Command, Job, LastSent, Node, Project, Software, User
 from sams.backend.SoftwareAccountingPW import Backend as Backend
-from sams.backend.SoftwareAccountingPW import Command, Job, LastSent, Node, Project, Software, User
 
 config = sams.core.Config("convert.yaml", {})
 
@@ -22,7 +22,7 @@ print("Update last_sent")
 try:
     ls = LastSent.get()
 except LastSent.DoesNotExist:
-    ls = LastSent(timestamp=datetime.fromtimestamp(0))
+    ls = LastSent(timestamp=datetime.datetime.fromtimestamp(0))
 
 for ts in c.execute("SELECT * FROM last_sent"):
     timestamp = datetime.datetime.fromtimestamp(ts[0])
@@ -32,6 +32,80 @@ for ts in c.execute("SELECT * FROM last_sent"):
         ls.save()
 
 
+def staged(query, table, chunk_size=100000):
+    """Copies the rows of query into the staging table and merges them
+    into the database, chunk_size rows at the time"""
+    c = sc.cursor()
+    cnt = 0
+    c.execute(query)
+    while True:
+        rows = c.fetchmany(chunk_size)
+        if not rows:
+            break
+        with db.atomic():
+            b.stage(table, rows)
+            b.merge(mark_jobs=False)
+        cnt += len(rows)
+        print(f"{table} @ {cnt}")
+
+
+def queue_unsent():
+    """Queues the jobs not sent yet for extraction, from the extract_queue
+    of the old database or else by last_sent"""
+    tables = [row[0] for row in sc.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    with db.atomic():
+        if "extract_queue" in tables:
+            jobids = [str(row[0]) for row in sc.execute("SELECT j.jobid FROM extract_queue q JOIN jobs j ON j.id = q.job ORDER BY q.id")]
+            for chunk in b._chunks(jobids):
+                b.queue([job for (job,) in Job.select(Job.id).where(Job.jobid.in_(chunk)).tuples()])
+        else:
+            db.execute_sql(SEED_EXTRACT_QUEUE)
+    print("Extract queue Done!")
+
+
+def timestamp(column):
+    return f"datetime({column}, 'unixepoch', 'localtime')"
+
+
+if b.bulk_load == "staging":
+    staged(
+        f"""
+    SELECT s.path, s.software, s.version, s.versionstr,
+        s.user_provided, s.ignore, {timestamp("s.last_updated")}
+        FROM software s
+    """,
+        "sams_staging_softwares",
+    )
+    print("Software Done!")
+
+    staged(
+        f"""
+    SELECT j.jobid,j.recordid,u.user,p.project,j.ncpus,
+            {timestamp("j.start_time")},{timestamp("j.end_time")},j.user_time,j.system_time
+        FROM jobs j
+        INNER JOIN projects p ON p.id = j.project
+        INNER JOIN users u ON u.id = j.user
+    """,
+        "sams_staging_jobs",
+    )
+    print("Jobs Done!")
+
+    staged(
+        f"""
+    SELECT j.jobid,n.node,s.path,
+            {timestamp("c.start_time")},{timestamp("c.end_time")},c.user,c.sys,{timestamp("c.updated")}
+        FROM command c
+        INNER JOIN jobs j ON j.id = c.jobid
+        INNER JOIN node n ON n.id = c.node
+        INNER JOIN software s ON s.id = c.software
+    """,
+        "sams_staging_commands",
+    )
+    print("Command Done!")
+    queue_unsent()
+    sys.exit(0)
+
+
 all_softwares = {x.path: x for x in Software.select()}
 c = sc.cursor()
 n = 0
@@ -199,3 +273,4 @@ with db.atomic() as txn:
         command.save()
 
 print("Command Done!")
+queue_unsent()
@@ -37,11 +37,35 @@ sams.backend.SoftwareAccounting:
     # DEFAULT is normally FILE but is dependent on compile time
     # options of the sqlite library.
     sqlite_temp_store: DEFAULT
+
+    # Commit every batch_size records or batch_time seconds.
+    # Records are grouped in one transaction for each database file and
+    # a failed record is rolled back alone using a savepoint.
+    batch_size: 1
+    batch_time: 0
+
+    # sqlite journal_mode pragma, default WAL when batch_size > 1
+    journal_mode: WAL
+
+    # sqlite synchronous, cache_size and mmap_size pragmas.
+    # Not set unless configured.
+    synchronous: FULL
+    cache_size: -65536
+    mmap_size: 268435456
+
+    # Number of worker processes. Each database file is written by the
+    # worker number jobid_hash % processes, 0 writes in sams-aggregator.
+    # Every commit waits for all workers, so batch_size must be larger
+    # than 1, the defaults are batch_size 100 and batch_time 30.
+    processes: 0
 """
 
 import logging
+import multiprocessing
 import os
+import queue
 import sqlite3
+import time
 
 import sams.base
 
@@ -88,18 +112,12 @@ TABLES = [
     );
     """,
     """
-    CREATE INDEX IF NOT EXISTS software_path_idx on software(path);
-    """,
-    """
     CREATE TABLE IF NOT EXISTS node (
         id              INTEGER PRIMARY KEY AUTOINCREMENT,
         node            TEXT NOT NULL
     );
     """,
     """
-    CREATE INDEX IF NOT EXISTS node_node_idx on node(node);
-    """,
-    """
     CREATE TABLE IF NOT EXISTS command (
         id              INTEGER PRIMARY KEY AUTOINCREMENT,
         jobid           INTEGER NOT NULL,
@@ -123,54 +141,213 @@ TABLES = [
     INSERT INTO last_sent(timestamp) SELECT 0 WHERE NOT EXISTS(SELECT 1 FROM last_sent);
     """,
     """
-    CREATE INDEX IF NOT EXISTS command_jobid_node_software_idx on command(jobid,node,software);
-    """,
-    """
     CREATE INDEX IF NOT EXISTS command_updated_idx on command(updated);
     """,
     """
     CREATE INDEX IF NOT EXISTS software_last_updated_idx on software(last_updated);
     """,
     """
-    CREATE INDEX IF NOT EXISTS jobs_jobid_idx on jobs(jobid);
-    """,
-    """
     CREATE INDEX IF NOT EXISTS jobs_start_time_idx on jobs(start_time);
     """,
     """
     CREATE INDEX IF NOT EXISTS jobs_end_time_idx on jobs(end_time);
     """,
-    """
-    CREATE INDEX IF NOT EXISTS jobs_user_time_idx on jobs(user_time);
-    """,
-    """
-    CREATE INDEX IF NOT EXISTS jobs_system_time_idx on jobs(system_time);
-    """,
 ]
 
+""" Schema migrations, MIGRATIONS[n] upgrades user_version n to n + 1 """
+MIGRATIONS = [
+    # Unique dimension values, jobids and commands. Duplicates left by
+    # earlier versions are merged into the row with the lowest id first.
+    [
+        """
+        UPDATE jobs SET user = (SELECT min(b.id) FROM users a, users b WHERE a.id = jobs.user AND b.user = a.user)
+        WHERE user NOT IN (SELECT min(id) FROM users GROUP BY user);
+        """,
+        """
+        DELETE FROM users WHERE id NOT IN (SELECT min(id) FROM users GROUP BY user);
+        """,
+        """
+        UPDATE jobs SET project = (SELECT min(b.id) FROM projects a, projects b WHERE a.id = jobs.project AND b.project = a.project)
+        WHERE project NOT IN (SELECT min(id) FROM projects GROUP BY project);
+        """,
+        """
+        DELETE FROM projects WHERE id NOT IN (SELECT min(id) FROM projects GROUP BY project);
+        """,
+        """
+        UPDATE command SET node = (SELECT min(b.id) FROM node a, node b WHERE a.id = command.node AND b.node = a.node)
+        WHERE node NOT IN (SELECT min(id) FROM node GROUP BY node);
+        """,
+        """
+        DELETE FROM node WHERE id NOT IN (SELECT min(id) FROM node GROUP BY node);
+        """,
+        """
+        UPDATE command SET software = (SELECT min(b.id) FROM software a, software b WHERE a.id = command.software AND b.path = a.path)
+        WHERE software NOT IN (SELECT min(id) FROM software GROUP BY path);
+        """,
+        """
+        DELETE FROM software WHERE id NOT IN (SELECT min(id) FROM software GROUP BY path);
+        """,
+        """
+        UPDATE command SET jobid = (SELECT min(b.id) FROM jobs a, jobs b WHERE a.id = command.jobid AND b.jobid = a.jobid)
+        WHERE jobid NOT IN (SELECT min(id) FROM jobs GROUP BY jobid);
+        """,
+        """
+        DELETE FROM jobs WHERE id NOT IN (SELECT min(id) FROM jobs GROUP BY jobid);
+        """,
+        """
+        DELETE FROM command WHERE id NOT IN (SELECT min(id) FROM command GROUP BY jobid,node,software);
+        """,
+        """
+        DROP INDEX IF EXISTS software_path_idx;
+        """,
+        """
+        DROP INDEX IF EXISTS node_node_idx;
+        """,
+        """
+        DROP INDEX IF EXISTS jobs_jobid_idx;
+        """,
+        """
+        DROP INDEX IF EXISTS command_jobid_node_software_idx;
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS users_user_uidx on users(user);
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS projects_project_uidx on projects(project);
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS node_node_uidx on node(node);
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS software_path_uidx on software(path);
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS jobs_jobid_uidx on jobs(jobid);
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS command_jobid_node_software_uidx on command(jobid,node,software);
+        """,
+    ],
+    # Jobs with new commands are kept in dirty_jobs until their times are
+    # summed up. The times are no longer searched for NULL.
+    [
+        """
+        CREATE TABLE IF NOT EXISTS dirty_jobs (
+            id              INTEGER PRIMARY KEY
+        );
+        """,
+        """
+        INSERT OR IGNORE INTO dirty_jobs (id)
+            SELECT id FROM jobs WHERE start_time IS NULL OR end_time IS NULL OR user_time IS NULL OR system_time IS NULL;
+        """,
+        """
+        DROP INDEX IF EXISTS jobs_user_time_idx;
+        """,
+        """
+        DROP INDEX IF EXISTS jobs_system_time_idx;
+        """,
+    ],
+    # Jobs to extract are queued in extract_queue by the aggregator and by
+    # a trigger when software is classified. Jobs queued again get a new id.
+    [
+        """
+        CREATE TABLE IF NOT EXISTS extract_queue (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            job             INTEGER NOT NULL UNIQUE
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS command_software_idx on command(software);
+        """,
+        """
+        INSERT OR IGNORE INTO extract_queue (job)
+            SELECT jobid FROM command WHERE updated > (SELECT max(timestamp) FROM last_sent)
+            UNION
+            SELECT c.jobid FROM command c, software s
+            WHERE c.software = s.id AND s.last_updated > (SELECT max(timestamp) FROM last_sent) AND NOT s.ignore
+            ORDER BY 1;
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS software_extract_queue_trg
+        AFTER UPDATE OF software, version, versionstr, user_provided, ignore ON software
+        WHEN NEW.software IS NOT NULL AND NOT NEW.ignore
+        BEGIN
+            INSERT OR REPLACE INTO extract_queue (job) SELECT DISTINCT jobid FROM command WHERE software = NEW.id;
+        END;
+        """,
+    ],
+    # Failed extraction attempts of each job, a job is not queued again
+    # after extract_max_attempts failures.
+    [
+        """
+        CREATE TABLE IF NOT EXISTS extract_failed (
+            job             INTEGER PRIMARY KEY,
+            attempts        INTEGER NOT NULL,
+            error           TEXT
+        );
+        """,
+    ],
+]
+
+
+def migrate(db):
+    """Upgrade the schema of db to the latest version"""
+    c = db.cursor()
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    for n in range(version, len(MIGRATIONS)):
+        c.execute("BEGIN IMMEDIATE TRANSACTION")
+        try:
+            # Another process may have migrated while we waited for the lock
+            if c.execute("PRAGMA user_version").fetchone()[0] > n:
+                c.execute("COMMIT")
+                continue
+            logger.info("Migrating database schema to version %d", n + 1)
+            for sql in MIGRATIONS[n]:
+                logger.debug(sql)
+                c.execute(sql)
+            c.execute("PRAGMA user_version = %d" % (n + 1))
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+
+
+# RETURNING is supported from sqlite 3.35
+UPSERT_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Cache name -> (table, column) of the dimension tables
+DIMENSIONS = {
+    "projects": ("projects", "project"),
+    "users": ("users", "user"),
+    "nodes": ("node", "node"),
+    "softwares": ("software", "path"),
+}
+
 # Update/Insert SQL
-INSERT_USER = """ insert or replace into users (id,user) values ((select ID from users where user = :user), :user); """
-INSERT_PROJECT = """ insert or replace into projects (id,project) values ((select ID from projects where project = :project), :project); """
-INSERT_JOBS = """
-    insert or replace into jobs (id,jobid,user,project,ncpus,recordid)
-        values ((select ID from jobs where jobid = :jobid), :jobid, :user ,:project, :ncpus, :recordid);
+UPSERT_DIMENSION = """ insert into %(table)s (%(column)s) values (:value)
+    on conflict(%(column)s) do update set %(column)s = excluded.%(column)s returning id; """
+INSERT_DIMENSION = """ insert or ignore into %(table)s (%(column)s) values (:value); """
+FETCH_DIMENSION = """ select id from %(table)s where %(column)s = :value; """
+PRELOAD_DIMENSION = """ select %(column)s, id from %(table)s; """
+
+UPSERT_JOBS = """
+    insert into jobs (jobid,user,project,ncpus,recordid)
+        values (:jobid, :user, :project, :ncpus, :recordid)
+    on conflict(jobid) do update set
+        user = excluded.user, project = excluded.project, ncpus = excluded.ncpus, recordid = excluded.recordid
+    returning id;
+"""
+INSERT_JOBS = """ insert or ignore into jobs (jobid) values (:jobid); """
+UPDATE_JOBS = """
+    update jobs set user = :user, project = :project, ncpus = :ncpus, recordid = :recordid
+    where jobid = :jobid;
 """
-INSERT_NODE = """ insert or replace into node (id,node) values ((select ID from node where node = :node), :node); """
-FETCH_SOFTWARE_ID = """ select ID from software where path = :software; """
-INSERT_SOFTWARE = """ insert or ignore into software (id,path) values ((select ID from software where path = :software), :software); """
+INSERT_DIRTY_JOB = """ insert or ignore into dirty_jobs (id) values (:id); """
+INSERT_EXTRACT_QUEUE = """ insert or replace into extract_queue (job) values (:id); """
+FETCH_JOBS_ID = """ select id from jobs where jobid = :jobid; """
 INSERT_COMMAND = """
-insert or ignore into command (id,jobid,node,software,start_time,end_time,user,sys,updated) values
+insert or ignore into command (jobid,node,software,start_time,end_time,user,sys,updated) values
 (
-        (
-                select ID from command 
-                        where 
-                                jobid = :id
-                        and 
-                                node  = :node_id
-                        and
-                                software = :sw_id
-        )
-, 
         :id,
         :node_id,
         :sw_id,
@@ -180,27 +357,58 @@ insert or ignore into command (id,jobid,node,software,start_time,end_time,user,s
 );
 """
 
-UPDATE_MINMAX = """
-update jobs set 
-    start_time = :start_time,
-    end_time = :end_time,
-    user_time = :user_time,
-    system_time = :system_time
-where id = :id
-"""
-
-FIND_MINMAX_JOBS = """
-select jobid,min(start_time),max(end_time),sum(user),sum(sys) 
-from command 
-where jobid in (select id from jobs where start_time is null or end_time is null or user_time is null or system_time is null)
-group by jobid
+# Sum up the times of the jobs with new commands
+ROLLUP_JOBS = """
+update jobs set
+    start_time = (select min(start_time) from command where command.jobid = jobs.id),
+    end_time = (select max(end_time) from command where command.jobid = jobs.id),
+    user_time = (select sum(user) from command where command.jobid = jobs.id),
+    system_time = (select sum(sys) from command where command.jobid = jobs.id)
+where id in (select id from dirty_jobs)
 """
+CLEAR_DIRTY_JOBS = """ delete from dirty_jobs; """
+
+
+def worker(id, config, inbox, outbox):
+    """Aggregates the records of the shards of one worker process.
+    Failed records are reported by their position in the batch."""
+    aggregator = Aggregator(id, config, worker=True)
+    failed = []
+    positions = []
+    while True:
+        message = inbox.get()
+        if message[0] == "aggregate":
+            _, position, data = message
+            positions.append(position)
+            try:
+                aggregator.aggregate(data)
+            except Exception as e:
+                logger.error("Failed to aggregate: %s", e)
+                failed.append(position)
+                aggregator.cleanup()
+        elif message[0] == "flush":
+            try:
+                aggregator.flush()
+            except Exception as e:
+                logger.exception(e)
+                aggregator.cleanup()
+                failed = positions
+            outbox.put(failed)
+            failed = []
+            positions = []
+        elif message[0] == "rollup":
+            aggregator.rollup()
+            outbox.put([])
+        elif message[0] == "close":
+            aggregator.close()
+            outbox.put([])
+            return
 
 
 class Aggregator(sams.base.Aggregator):
     """SAMS Software accounting aggregator"""
 
-    def __init__(self, id, config):
+    def __init__(self, id, config, worker=False):
         super(Aggregator, self).__init__(id, config)
         self.db = {}
         self.db_path = self.config.get([self.id, "db_path"])
@@ -214,6 +422,51 @@ class Aggregator(sams.base.Aggregator):
         if self.sqlite_temp_store not in ["DEFAULT", "FILE", "MEMORY"]:
             sams.base.AggregatorException("sqlite_temp_store must be one of DEFAULT, FILE or MEMORY")
 
+        # The workers use the batch defaults of the main process
+        processes = int(self.config.get([self.id, "processes"], 0))
+        self.batch_size = int(self.config.get([self.id, "batch_size"], 100 if processes else 1))
+        self.batch_time = float(self.config.get([self.id, "batch_time"], 30 if processes else 0))
+        if processes and self.batch_size <= 1:
+            raise sams.base.AggregatorException("batch_size must be larger than 1 when processes is used")
+        self.journal_mode = self.config.get([self.id, "journal_mode"], "WAL" if self.batch_size > 1 else None)
+        self.pragmas = {"synchronous": self.config.get([self.id, "synchronous"])}
+        for pragma in ["cache_size", "mmap_size"]:
+            value = self.config.get([self.id, pragma])
+            self.pragmas[pragma] = None if value is None else int(value)
+
+        # jobid_hash of the databases with an open transaction
+        self.in_transaction = set()
+        self.batch_count = 0
+        self.batch_started = None
+        # Ids cached while aggregating the current record
+        self.added = []
+
+        self.processes = 0 if worker else processes
+        self.workers = []
+
+    def _start_workers(self):
+        for _ in range(self.processes):
+            inbox = multiprocessing.Queue(maxsize=1000)
+            outbox = multiprocessing.Queue()
+            process = multiprocessing.Process(target=worker, args=(self.id, self.config, inbox, outbox), daemon=True)
+            process.start()
+            self.workers.append((process, inbox, outbox))
+
+    def _send_all(self, message):
+        """Send message to all workers, returns their replies"""
+        for _, inbox, _ in self.workers:
+            inbox.put(message)
+        replies = []
+        for process, _, outbox in self.workers:
+            while True:
+                try:
+                    replies.append(outbox.get(timeout=1))
+                    break
+                except queue.Empty:
+                    if not process.is_alive():
+                        raise sams.base.AggregatorException("Aggregator worker %d died" % process.pid)
+        return replies
+
     def _open_db(self, jobid_hash):
         """Open database object"""
         db = os.path.join(self.db_path, self.file_pattern % {"jobid_hash": int(jobid_hash)})
@@ -221,36 +474,47 @@ class Aggregator(sams.base.Aggregator):
         self.db[jobid_hash].isolation_level = None
         c = self.db[jobid_hash].cursor()
         c.execute("PRAGMA temp_store = %s" % self.sqlite_temp_store)
+        if self.journal_mode:
+            c.execute("PRAGMA journal_mode = %s" % self.journal_mode)
+        for pragma, value in self.pragmas.items():
+            if value is not None:
+                c.execute("PRAGMA %s = %s" % (pragma, value))
         for sql in TABLES:
             logger.debug(sql)
             c.execute(sql)
         self.db[jobid_hash].commit()
+        migrate(self.db[jobid_hash])
+
+        # The dimension tables are small, cache them all
+        self.inserted[jobid_hash] = {}
+        for table, (dbtable, column) in DIMENSIONS.items():
+            self.inserted[jobid_hash][table] = dict(c.execute(PRELOAD_DIMENSION % {"table": dbtable, "column": column}))
         return self.db[jobid_hash]
 
+    def jobid_hash(self, jobid):
+        if self.jobid_hash_size > 0:
+            return int(jobid / self.jobid_hash_size)
+        return 0
+
     def get_db(self, jobid):
         """get db connection based on jobid / jobid_hash_size"""
-        jobid_hash = 0
-        if self.jobid_hash_size > 0:
-            jobid_hash = int(jobid / self.jobid_hash_size)
+        jobid_hash = self.jobid_hash(jobid)
         if jobid_hash in self.db:
             return self.db[jobid_hash]
         return self._open_db(jobid_hash)
 
     def save_id(self, jobid, table, value, id):
         """Only try to insert once / session"""
-        jobid_hash = 0
-        if self.jobid_hash_size > 0:
-            jobid_hash = int(jobid / self.jobid_hash_size)
+        jobid_hash = self.jobid_hash(jobid)
         if value not in self.inserted[jobid_hash][table]:
             self.inserted[jobid_hash][table][value] = id
+            self.added.append((jobid_hash, table, value))
         logger.debug("save_id(%d (%d),%s,%s,%d)", jobid, jobid_hash, table, value, id)
         return id
 
     def get_id(self, jobid, table, value):
         """Only try to insert once / session"""
-        jobid_hash = 0
-        if self.jobid_hash_size > 0:
-            jobid_hash = int(jobid / self.jobid_hash_size)
+        jobid_hash = self.jobid_hash(jobid)
         logger.debug(
             "get_id(%d (%d),%s,%s,%d)",
             jobid,
@@ -263,9 +527,7 @@ class Aggregator(sams.base.Aggregator):
 
     def do_insert(self, jobid, table, value):
         """Only try to insert once / session"""
-        jobid_hash = 0
-        if self.jobid_hash_size > 0:
-            jobid_hash = int(jobid / self.jobid_hash_size)
+        jobid_hash = self.jobid_hash(jobid)
         if jobid_hash not in self.inserted:
             self.inserted[jobid_hash] = {}
         if table not in self.inserted[jobid_hash]:
@@ -277,11 +539,22 @@ class Aggregator(sams.base.Aggregator):
     def aggregate(self, data):
         """Information aggregate method"""
 
+        if self.processes:
+            if not self.workers:
+                self._start_workers()
+            if self.batch_started is None:
+                self.batch_started = time.time()
+            jobid_hash = self.jobid_hash(int(data["sams.sampler.Core"]["jobid"]))
+            self.workers[jobid_hash % self.processes][1].put(("aggregate", self.batch_count, data))
+            self.batch_count += 1
+            return
+
         jobid = int(data["sams.sampler.Core"]["jobid"])
         node = data["sams.sampler.Core"]["node"]
 
         # Get database for jobid
         db = self.get_db(jobid)
+        jobid_hash = self.jobid_hash(jobid)
         c = db.cursor()
 
         for module in ["sams.sampler.Software", "sams.sampler.SlurmInfo"]:
@@ -292,35 +565,55 @@ class Aggregator(sams.base.Aggregator):
         if len(data["sams.sampler.Software"]["execs"]) == 0:
             raise sams.base.AggregatorException("Jobid: %d on node %s has no execs" % (jobid, node))
 
-        # Begin transaction
-        c.execute("BEGIN TRANSACTION")
-        c.execute("PRAGMA temp_store = %s" % self.sqlite_temp_store)
+        # Begin transaction, kept open until the batch is flushed
+        if jobid_hash not in self.in_transaction:
+            c.execute("BEGIN TRANSACTION")
+            self.in_transaction.add(jobid_hash)
+        if self.batch_started is None:
+            self.batch_started = time.time()
+
+        # A failed record only rolls back its own changes
+        self.added = []
+        c.execute("SAVEPOINT record")
+        try:
+            self._aggregate(c, jobid, node, data)
+        except Exception:
+            c.execute("ROLLBACK TO SAVEPOINT record")
+            c.execute("RELEASE SAVEPOINT record")
+            # Ids inserted by the failed record are gone
+            for shard, table, value in self.added:
+                self.inserted[shard][table].pop(value, None)
+            raise
+        c.execute("RELEASE SAVEPOINT record")
+        self.batch_count += 1
+
+        if self.batch_size <= 1:
+            # Commit data to disk
+            self.flush()
+
+    def upsert_id(self, c, jobid, table, value):
+        """Returns the id of value in the dimension table, inserted if needed"""
+        if not self.do_insert(jobid, table, value):
+            return self.get_id(jobid, table, value)
+        sql = {"table": DIMENSIONS[table][0], "column": DIMENSIONS[table][1]}
+        if UPSERT_RETURNING:
+            id = c.execute(UPSERT_DIMENSION % sql, {"value": value}).fetchone()[0]
+        else:
+            c.execute(INSERT_DIMENSION % sql, {"value": value})
+            id = c.execute(FETCH_DIMENSION % sql, {"value": value}).fetchone()[0]
+        logger.debug("Inserted %s: %s as %d", table, value, id)
+        return self.save_id(jobid, table, value, id)
 
+    def _aggregate(self, c, jobid, node, data):
         # If project (account) is defined in data insert into table
-        project = None
         project_id = None
         if "account" in data["sams.sampler.SlurmInfo"]:
-            project = data["sams.sampler.SlurmInfo"]["account"]
-            if self.do_insert(jobid, "projects", project):
-                c.execute(INSERT_PROJECT, {"project": project})
-                project_id = self.save_id(jobid, "projects", project, c.lastrowid)
-                logger.debug("Inserted project: %s as %d (%d)", project, c.lastrowid, project_id)
-            else:
-                project_id = self.get_id(jobid, "projects", project)
-                logger.debug("Fetched project: %s as %d", project, project_id)
+            project_id = self.upsert_id(c, jobid, "projects", data["sams.sampler.SlurmInfo"]["account"])
 
         # If username is defined in data insert into table
-        user = None
         user_id = None
         if "username" in data["sams.sampler.SlurmInfo"]:
-            user = data["sams.sampler.SlurmInfo"]["username"]
-            if self.do_insert(jobid, "users", user):
-                c.execute(INSERT_USER, {"user": user})
-                user_id = self.save_id(jobid, "users", user, c.lastrowid)
-                logger.debug("Inserted user: %s as %d (%d)", user, c.lastrowid, user_id)
-            else:
-                user_id = self.get_id(jobid, "users", user)
-                logger.debug("Fetched user: %s as %d", user, user_id)
+            user_id = self.upsert_id(c, jobid, "users", data["sams.sampler.SlurmInfo"]["username"])
 
         recordid = "%s:%s" % (self.cluster, jobid)
         if "starttime" in data["sams.sampler.SlurmInfo"]:
@@ -334,47 +627,30 @@ class Aggregator(sams.base.Aggregator):
             ncpus = data["sams.sampler.SlurmInfo"]["cpus"]
 
         # Insert information about job
-        c.execute(
-            INSERT_JOBS,
-            {
-                "jobid": jobid,
-                "user": user_id,
-                "project": project_id,
-                "ncpus": ncpus,
-                "recordid": recordid,
-            },
-        )
-        id = c.lastrowid
+        job = {
+            "jobid": jobid,
+            "user": user_id,
+            "project": project_id,
+            "ncpus": ncpus,
+            "recordid": recordid,
+        }
+        if UPSERT_RETURNING:
+            id = c.execute(UPSERT_JOBS, job).fetchone()[0]
+        else:
+            c.execute(INSERT_JOBS, job)
+            c.execute(UPDATE_JOBS, job)
+            id = c.execute(FETCH_JOBS_ID, job).fetchone()[0]
 
         # Insert node
-        node_id = None
-        if self.do_insert(jobid, "nodes", node):
-            c.execute(INSERT_NODE, {"node": node})
-            node_id = self.save_id(jobid, "nodes", node, c.lastrowid)
-            logger.debug("Inserted node: %s as %d (%d)", node, c.lastrowid, node_id)
-        else:
-            node_id = self.get_id(jobid, "nodes", node)
+        node_id = self.upsert_id(c, jobid, "nodes", node)
 
         # Insert information about running commands
+        commands = []
         for sw, info in data["sams.sampler.Software"]["execs"].items():
             # Insert software
-            sw_id = None
-            if self.do_insert(jobid, "softwares", sw):
-                sw_id_row = [ts for ts in c.execute(FETCH_SOFTWARE_ID, {"software": sw})]
-
-                if sw_id_row:
-                    sw_id = self.save_id(jobid, "softwares", sw, sw_id_row[0][0])
-                    logger.debug("Fetched sw: %s as %d (%d)", sw, sw_id_row[0][0], sw_id)
-                else:
-                    c.execute(INSERT_SOFTWARE, {"software": sw})
-                    sw_id = self.save_id(jobid, "softwares", sw, c.lastrowid)
-                    logger.debug("Inserted sw: %s as %d (%d)", sw, c.lastrowid, sw_id)
-            else:
-                sw_id = self.get_id(jobid, "softwares", sw)
-                logger.debug("Cached sw: %s as %d", sw, sw_id)
-
-            c.execute(
-                INSERT_COMMAND,
+            sw_id = self.upsert_id(c, jobid, "softwares", sw)
+
+            commands.append(
                 {
                     "id": id,
                     "node_id": node_id,
@@ -383,39 +659,96 @@ class Aggregator(sams.base.Aggregator):
                     "end_time": int(data["sams.sampler.Software"]["end_time"]),
                     "user": info["user"],
                     "sys": info["system"],
-                },
+                }
             )
+        c.executemany(INSERT_COMMAND, commands)
+        if c.rowcount > 0:
+            c.execute(INSERT_EXTRACT_QUEUE, {"id": id})
+        c.execute(INSERT_DIRTY_JOB, {"id": id})
 
-        # Commit data to disk
-        c.execute("COMMIT")
-        db.commit()
+    def pending(self):
+        return self.batch_count
 
-    def cleanup(self):
-        for db in self.db.values():
-            db.rollback()
+    def should_flush(self):
+        if self.batch_count >= self.batch_size:
+            return True
+        return bool(self.batch_count and self.batch_time and time.time() - self.batch_started >= self.batch_time)
 
-    def close(self):
+    def flush(self):
+        """Commit the open transactions to disk, returns the positions in
+        the batch of the records that failed in the worker processes."""
+        if self.processes:
+            failed = []
+            try:
+                if self.workers and self.batch_count:
+                    for positions in self._send_all(("flush",)):
+                        failed.extend(positions)
+            finally:
+                self.batch_count = 0
+                self.batch_started = None
+            return sorted(failed)
+        try:
+            for jobid_hash in sorted(self.in_transaction):
+                self.db[jobid_hash].cursor().execute("COMMIT")
+                self.in_transaction.remove(jobid_hash)
+        finally:
+            self.batch_count = 0
+            self.batch_started = None
+
+    def cleanup(self):
+        """Roll back the open transactions"""
+        if self.processes:
+            # Each worker process cleans up after its own failures
+            return
+        if self.batch_count and self.batch_size > 1:
+            # Failed records are already rolled back to their savepoint,
+            # the rest of the batch is kept.
+            return
+        for jobid_hash in self.in_transaction:
+            db = self.db[jobid_hash]
+            if db.in_transaction:
+                db.cursor().execute("ROLLBACK")
+            # Cached ids may refer to rolled back rows
+            self.inserted.pop(jobid_hash, None)
+        self.in_transaction.clear()
+        self.batch_count = 0
+        self.batch_started = None
+
+    def rollup(self):
+        """Update the times of the jobs that got new commands"""
+        if self.processes:
+            if self.workers:
+                self._send_all(("rollup",))
+            return
         for db in self.db.values():
-            # Update jobs table.
             try:
                 c = db.cursor()
                 c.execute("BEGIN TRANSACTION")
-                c.execute("PRAGMA temp_store = %s" % self.sqlite_temp_store)
-                rows = [row for row in c.execute(FIND_MINMAX_JOBS)]
-                for row in rows:
-                    c.execute(
-                        UPDATE_MINMAX,
-                        {
-                            "id": row[0],
-                            "start_time": row[1],
-                            "end_time": row[2],
-                            "user_time": row[3],
-                            "system_time": row[4],
-                        },
-                    )
+                c.execute(ROLLUP_JOBS)
+                logger.debug("Updated times of %d jobs", c.rowcount)
+                c.execute(CLEAR_DIRTY_JOBS)
                 c.execute("COMMIT")
-                db.commit()
             except Exception as e:
                 logger.exception(e)
+                if db.in_transaction:
+                    db.cursor().execute("ROLLBACK")
 
+    def close(self):
+        if self.processes:
+            if self.workers:
+                self._send_all(("close",))
+                for process, _, _ in self.workers:
+                    process.join()
+                self.workers = []
+            return
+
+        try:
+            self.flush()
+        except Exception as e:
+            logger.exception(e)
+            self.cleanup()
+
+        # Update jobs table.
+        self.rollup()
+        for db in self.db.values():
             db.close()
@@ -30,6 +30,13 @@ sams.backend.SoftwareAccounting:
     # DEFAULT is normally FILE but is dependent on compile time
     # options of the sqlite library.
     sqlite_temp_store: DEFAULT
+
+    # Number of queued jobs extracted by each query.
+    extract_chunk_size: 10000
+
+    # A job that can not be extracted is queued again until it has failed
+    # extract_max_attempts times.
+    extract_max_attempts: 3
 """
 
 import logging
@@ -38,7 +45,8 @@ import re
 import sqlite3
 
 import sams.base
-from sams.core import JobSoftware, Software
+from sams.aggregator.SoftwareAccounting import MIGRATIONS
+from sams.core import JobSoftware, JobSoftwareException, Software
 
 logger = logging.getLogger(__name__)
 
@@ -49,27 +57,31 @@ UPDATE_SOFTWARE = """
         user_provided = :user_provided, ignore = :ignore, last_updated = strftime('%s','now')
     WHERE id = :id and software is NULL
 """
+# Snapshot of the queue, jobs queued while extracting are left for the next run
+EXTRACT_QUEUE_MAX = """ SELECT max(id) FROM extract_queue """
+EXTRACT_QUEUE_CHUNK = """
+SELECT job FROM extract_queue WHERE id <= :max_id AND job > :after ORDER BY job LIMIT :limit
+"""
 EXTRACT_SOFTWARE = """
-SELECT x.software,x.version,x.versionstr,x.jobid,x.recordid,
-        sum(x.cpu) as cpu,max(x.updated) as updated,x.user_provided, users.user,projects.project
-FROM (
-             SELECT s.software,s.version,s.versionstr,j.jobid,j.user,j.project,sum(c.user+c.sys) as cpu, j.recordid, j.id,
-                    max(max(s.last_updated,c.updated)) as updated,s.user_provided
-             FROM software s, command c, jobs j
-             WHERE c.software = s.id and c.jobid = j.id and NOT s.ignore and
-                j.id in (select DISTINCT jobid from command where updated > :updated UNION
-                    select DISTINCT jobid from command where software in (
-                                select DISTINCT id from software where last_updated > :updated and NOT ignore
-                        )
-                )
-             GROUP BY s.software,s.version,s.versionstr,s.user_provided,j.jobid,j.recordid,j.id,j.user,j.project
-          ) x
-LEFT JOIN users ON x.user = users.id
-LEFT JOIN projects ON x.project = projects.id
-WHERE x.recordid is not null
-GROUP BY x.software,x.version,x.versionstr,x.jobid,recordid,x.user_provided,users.user,projects.project
-ORDER BY x.jobid
+SELECT s.software,s.version,s.versionstr,j.jobid,j.recordid,
+        sum(c.user+c.sys) as cpu,s.user_provided,users.user,projects.project,j.id
+FROM extract_queue q
+JOIN jobs j ON j.id = q.job
+JOIN command c ON c.jobid = j.id
+JOIN software s ON s.id = c.software
+LEFT JOIN users ON j.user = users.id
+LEFT JOIN projects ON j.project = projects.id
+WHERE q.id <= :max_id AND q.job BETWEEN :first AND :last AND s.software is not null AND NOT s.ignore
+    AND j.recordid is not null
+GROUP BY j.id,s.software,s.version,s.versionstr,s.user_provided
+ORDER BY j.id
 """
+CLEAR_EXTRACT_QUEUE = """ DELETE FROM extract_queue WHERE id <= :max_id AND job <= :last """
+# Skipped jobs get a new id and are extracted again by the next run
+REQUEUE_EXTRACT_QUEUE = """ INSERT OR REPLACE INTO extract_queue (job) VALUES (:job) """
+INSERT_EXTRACT_FAILED = """ INSERT OR IGNORE INTO extract_failed (job, attempts) VALUES (:job, 0) """
+UPDATE_EXTRACT_FAILED = """ UPDATE extract_failed SET attempts = attempts + 1, error = :error WHERE job = :job """
+EXTRACT_FAILED_ATTEMPTS = """ SELECT attempts FROM extract_failed WHERE job = :job """
 
 RESET_PATH = """
 UPDATE software SET software = NULL where path GLOB :path
@@ -94,6 +106,13 @@ SELECT path from software where software IS NULL order by path
 """
 
 
+def expand(value, **names):
+    """Expands %(user)s and %(project)s in value"""
+    if value is None:
+        return None
+    return value % names
+
+
 class Backend(sams.base.Backend):
     """SAMS Software accounting aggregator"""
 
@@ -102,25 +121,35 @@ class Backend(sams.base.Backend):
         self.db_path = self.config.get([self.id, "db_path"])
         self.file_pattern = re.compile(self.config.get([self.id, "file_pattern"], r"sa-\d+.db"))
         self.sqlite_temp_store = self.config.get([self.id, "sqlite_temp_store"], "DEFAULT")
+        self.extract_chunk_size = int(self.config.get([self.id, "extract_chunk_size"], 10000))
+        self.extract_max_attempts = int(self.config.get([self.id, "extract_max_attempts"], 3))
 
         if self.sqlite_temp_store not in ["DEFAULT", "FILE", "MEMORY"]:
             sams.base.BackendException("sqlite_temp_store must be one of DEFAULT, FILE or MEMORY")
 
         self.dry_run(False)
         self.updated = {}
+        self.committed = {}
 
     @classmethod
     def _open_db(cls, db):
         """Open database object"""
         dbh = sqlite3.connect(db)
         dbh.isolation_level = None
+        # Only the aggregator migrates the schema
+        version = dbh.cursor().execute("PRAGMA user_version").fetchone()[0]
+        if version < len(MIGRATIONS):
+            dbh.close()
+            raise sams.base.BackendException(
+                "%s has schema version %d, run sams-aggregator to migrate it to version %d" % (db, version, len(MIGRATIONS))
+            )
         return dbh
 
     def get_databases(self):
         dbs = os.listdir(self.db_path)
         dbs = filter(self.file_pattern.match, dbs)
         dbs = map(lambda file: os.path.join(self.db_path, file), dbs)
-        return list(dbs)
+        return sorted(dbs)
 
     def dry_run(self, dry):
         self._dry_run = dry
@@ -164,48 +193,99 @@ class Backend(sams.base.Backend):
                 dbh.commit()
             dbh.close()
 
-    def extract(self):
-        """Software extract method"""
+    def shards(self):
+        return self.get_databases()
+
+    def extract(self, shards=None):
+        """Software extract method, yields the jobs of one database at the
+        time in job order. commit() removes the jobs of the chunks yielded
+        so far from the queues. shards limits the extraction to some of the
+        databases."""
 
-        jobs = {}
         self.updated = {}
-        for db in self.get_databases():
+        self.committed = {}
+        self.skipped = {}
+        for db in shards or self.get_databases():
             dbh = self._open_db(db)
-            c = dbh.cursor()
-            c.execute("PRAGMA temp_store = %s" % self.sqlite_temp_store)
-            updated = [ts for ts in c.execute("SELECT timestamp from last_sent")][0][0]
-            rows = [row for row in c.execute(EXTRACT_SOFTWARE, {"updated": updated})]
-            dbh.close()
-
-            for row in rows:
-                if row[3] not in jobs:
-                    jobs[row[3]] = JobSoftware(row[3], row[4])
-
-                software = row[0] % dict(user=row[8], project=row[9])
-                version = row[1] % dict(user=row[8], project=row[9])
-                versionstr = row[2] % dict(user=row[8], project=row[9])
-
-                jobs[row[3]].addSoftware(Software(software, version, versionstr, row[7], row[5]))
-
-                if updated < row[6]:
-                    updated = row[6]
-
-            self.updated[db] = updated
-
-        return jobs.values()
+            try:
+                c = dbh.cursor()
+                c.execute("PRAGMA temp_store = %s" % self.sqlite_temp_store)
+                max_id = c.execute(EXTRACT_QUEUE_MAX).fetchone()[0]
+                if max_id is None:
+                    continue
+
+                # The queued jobs are extracted extract_chunk_size jobs at the time
+                after = 0
+                count = 0
+                while True:
+                    chunk = [
+                        row[0]
+                        for row in c.execute(EXTRACT_QUEUE_CHUNK, {"max_id": max_id, "after": after, "limit": self.extract_chunk_size})
+                    ]
+                    if not chunk:
+                        break
+                    rows = c.execute(EXTRACT_SOFTWARE, {"max_id": max_id, "first": chunk[0], "last": chunk[-1]}).fetchall()
+                    jobid = None
+                    job = None
+                    for row in rows:
+                        if jobid != row[3]:
+                            if job is not None:
+                                yield job
+                            jobid = row[3]
+                            try:
+                                job = JobSoftware(row[3], row[4])
+                            except JobSoftwareException as e:
+                                logger.info("Skipping job %s: %s", row[3], e)
+                                self.skipped.setdefault(db, {})[row[9]] = (row[3], str(e))
+                                job = None
+                        if job is None:
+                            continue
+
+                        software = expand(row[0], user=row[7], project=row[8])
+                        version = expand(row[1], user=row[7], project=row[8])
+                        versionstr = expand(row[2], user=row[7], project=row[8])
+
+                        try:
+                            job.addSoftware(Software(software, version, versionstr, row[6], row[5]))
+                        except JobSoftwareException as e:
+                            # The job is left in the queue for the next run
+                            logger.info("Skipping job %s: %s", row[3], e)
+                            self.skipped.setdefault(db, {})[row[9]] = (row[3], str(e))
+                            job = None
+
+                    # The chunk is done once its last job is yielded
+                    count += len(chunk)
+                    self.updated[db] = (max_id, chunk[-1])
+                    logger.info("Extracted %d queued jobs from %s", count, db)
+                    if job is not None:
+                        yield job
+                    after = chunk[-1]
+            finally:
+                dbh.close()
 
     def commit(self):
-        """Commits last used timestamp to database."""
-        for db in self.get_databases():
+        """Removes the jobs extracted so far from the queues of the
+        databases with progress since the last commit. Skipped jobs are
+        queued again until they have failed extract_max_attempts times."""
+        for db, (max_id, last) in self.updated.items():
+            if self.committed.get(db) == (max_id, last):
+                continue
             dbh = self._open_db(db)
             c = dbh.cursor()
             c.execute("PRAGMA temp_store = %s" % self.sqlite_temp_store)
-            c.execute(
-                "UPDATE last_sent set timestamp = :timestamp",
-                {"timestamp": self.updated[db]},
-            )
-            dbh.commit()
+            c.execute("BEGIN TRANSACTION")
+            c.execute(CLEAR_EXTRACT_QUEUE, {"max_id": max_id, "last": last})
+            for job, (jobid, error) in sorted(self.skipped.pop(db, {}).items()):
+                c.execute(INSERT_EXTRACT_FAILED, {"job": job})
+                c.execute(UPDATE_EXTRACT_FAILED, {"job": job, "error": error})
+                attempts = c.execute(EXTRACT_FAILED_ATTEMPTS, {"job": job}).fetchone()[0]
+                if attempts < self.extract_max_attempts:
+                    c.execute(REQUEUE_EXTRACT_QUEUE, {"job": job})
+                else:
+                    logger.error("Giving up on job %s after %d attempts: %s", jobid, attempts, error)
+            c.execute("COMMIT")
             dbh.close()
+            self.committed[db] = (max_id, last)
 
     @classmethod
     def _print_software(cls, software):
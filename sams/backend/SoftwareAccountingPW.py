@@ -40,9 +40,28 @@ sams.backend.SoftwareAccountingPW:
         pragmas:
             temp_store: MEMORY
 
+    # sams.aggregator.SoftwareAccountingPW writes the records in one
+    # transaction every batch_size records or batch_time seconds, with
+    # at most chunk_size rows in each INSERT.
+    batch_size: 1
+    batch_time: 0
+    chunk_size: 1000
+
+    # insert: INSERT the rows in chunks.
+    # staging: COPY (PostgreSQL) or INSERT (SQLite) the rows into temporary
+    # staging tables and merge them into the tables with one INSERT ... SELECT
+    # for each table. Not supported with mysql.
+    bulk_load: insert
+
+    # A job that can not be extracted is queued again until it has failed
+    # extract_max_attempts times.
+    extract_max_attempts: 3
+
 """
 
+import io
 import logging
+import time
 from datetime import datetime
 
 from peewee import (
@@ -67,6 +86,185 @@ logger = logging.getLogger(__name__)
 
 db = Proxy()
 
+# Default SQLITE_MAX_VARIABLE_NUMBER before sqlite 3.32
+SQLITE_MAX_VARIABLES = 999
+
+# Staging tables used with bulk_load: staging. Temporary tables are not
+# written to the WAL by PostgreSQL and are private to the connection.
+STAGING_TABLES = {
+    "sams_staging_jobs": [
+        ("jobid", "TEXT"),
+        ("recordid", "TEXT"),
+        ("user_name", "TEXT"),
+        ("project_name", "TEXT"),
+        ("ncpus", "INTEGER"),
+        ("start_time", "TIMESTAMP"),
+        ("end_time", "TIMESTAMP"),
+        ("user_time", "DOUBLE PRECISION"),
+        ("system_time", "DOUBLE PRECISION"),
+    ],
+    "sams_staging_softwares": [
+        ("path", "TEXT"),
+        ("software", "TEXT"),
+        ("version", "TEXT"),
+        ("versionstr", "TEXT"),
+        ("user_provided", "BOOLEAN"),
+        ("ignore", "BOOLEAN"),
+        ("last_updated", "TIMESTAMP"),
+    ],
+    "sams_staging_commands": [
+        ("jobid", "TEXT"),
+        ("node_name", "TEXT"),
+        ("path", "TEXT"),
+        ("start_time", "TIMESTAMP"),
+        ("end_time", "TIMESTAMP"),
+        ("user_time", "DOUBLE PRECISION"),
+        ("system_time", "DOUBLE PRECISION"),
+        ("last_updated", "TIMESTAMP"),
+    ],
+}
+
+# The job a staged row belongs to, jobs.jobid is not unique
+STAGED_JOB = 'j."id" = (SELECT MIN(j2."id") FROM "jobs" j2 WHERE j2."jobid" = s."jobid")'
+
+STAGED_COMMANDS = f"""
+    FROM "sams_staging_commands" s
+    JOIN "jobs" j ON {STAGED_JOB}
+    JOIN "nodes" n ON n."name" = s."node_name"
+    JOIN "softwares" w ON w."path" = s."path"
+    WHERE NOT EXISTS (
+        SELECT 1 FROM "commands" c WHERE c."job_id" = j."id" AND c."node_id" = n."id" AND c."software_id" = w."id"
+    )
+"""
+
+MERGE_DIMENSIONS = [
+    """
+    INSERT INTO "projects" ("name")
+    SELECT DISTINCT s."project_name" FROM "sams_staging_jobs" s
+    WHERE s."project_name" IS NOT NULL AND NOT EXISTS (SELECT 1 FROM "projects" t WHERE t."name" = s."project_name")
+    """,
+    """
+    INSERT INTO "users" ("name")
+    SELECT DISTINCT s."user_name" FROM "sams_staging_jobs" s
+    WHERE s."user_name" IS NOT NULL AND NOT EXISTS (SELECT 1 FROM "users" t WHERE t."name" = s."user_name")
+    """,
+    """
+    INSERT INTO "nodes" ("name")
+    SELECT DISTINCT s."node_name" FROM "sams_staging_commands" s
+    WHERE s."node_name" IS NOT NULL AND NOT EXISTS (SELECT 1 FROM "nodes" t WHERE t."name" = s."node_name")
+    """,
+    """
+    INSERT INTO "softwares" ("path", "software", "version", "versionstr", "user_provided", "ignore", "last_updated")
+    SELECT s."path", s."software", s."version", s."versionstr", s."user_provided", s."ignore", s."last_updated"
+    FROM "sams_staging_softwares" s
+    WHERE NOT EXISTS (SELECT 1 FROM "softwares" t WHERE t."path" = s."path")
+    """,
+    """
+    INSERT INTO "jobs" ("jobid", "recordid", "user_id", "project_id", "ncpus", "start_time", "end_time", "user_time", "system_time")
+    SELECT s."jobid", s."recordid", u."id", p."id", s."ncpus", s."start_time", s."end_time", s."user_time", s."system_time"
+    FROM "sams_staging_jobs" s
+    LEFT JOIN "users" u ON u."name" = s."user_name"
+    LEFT JOIN "projects" p ON p."name" = s."project_name"
+    WHERE NOT EXISTS (SELECT 1 FROM "jobs" t WHERE t."jobid" = s."jobid")
+    """,
+]
+
+# Jobs getting new commands are updated by rollup()
+MERGE_MARK_JOBS = f"""
+    INSERT INTO "dirty_jobs" ("job_id")
+    SELECT DISTINCT j."id" {STAGED_COMMANDS}
+    AND NOT EXISTS (SELECT 1 FROM "dirty_jobs" d WHERE d."job_id" = j."id")
+"""
+
+# Jobs getting new commands are queued for extraction, jobs already in the
+# queue are moved to the end of it
+MERGE_QUEUE_JOBS = [
+    f"""
+    DELETE FROM "extract_queue" WHERE "job_id" IN (SELECT j."id" {STAGED_COMMANDS})
+    """,
+    f"""
+    INSERT INTO "extract_queue" ("job_id")
+    SELECT DISTINCT j."id" {STAGED_COMMANDS}
+    ORDER BY 1
+    """,
+]
+
+# Jobs not sent before the extract_queue table was added
+SEED_EXTRACT_QUEUE = """
+    INSERT INTO "extract_queue" ("job_id")
+    SELECT DISTINCT c."job_id" FROM "commands" c JOIN "softwares" s ON s."id" = c."software_id"
+    WHERE (
+        NOT EXISTS (SELECT 1 FROM "last_sent" l WHERE l."timestamp" >= c."last_updated")
+        OR (s."last_updated" IS NOT NULL AND NOT EXISTS (SELECT 1 FROM "last_sent" l WHERE l."timestamp" >= s."last_updated"))
+    )
+    AND NOT EXISTS (SELECT 1 FROM "extract_queue" q WHERE q."job_id" = c."job_id")
+    ORDER BY 1
+"""
+
+# Jobs marked for update before the dirty_jobs table was added
+SEED_DIRTY_JOBS = """
+    INSERT INTO "dirty_jobs" ("job_id")
+    SELECT "id" FROM "jobs"
+    WHERE "start_time" IS NULL OR "end_time" IS NULL OR "user_time" IS NULL OR "system_time" IS NULL
+"""
+
+# Updates the times of the jobs in {jobs} from their commands
+ROLLUP_JOBS = {
+    "postgresql": """
+    UPDATE "jobs" SET "start_time" = x."start_time", "end_time" = x."end_time",
+        "user_time" = x."user_time", "system_time" = x."system_time",
+        "wall_time" = EXTRACT(EPOCH FROM x."end_time" - x."start_time")
+    FROM (
+        SELECT c."job_id", MIN(c."start_time") AS "start_time", MAX(c."end_time") AS "end_time",
+            SUM(c."user_time") AS "user_time", SUM(c."system_time") AS "system_time"
+        FROM "commands" c WHERE c."job_id" IN ({jobs})
+        GROUP BY c."job_id"
+    ) x
+    WHERE "jobs"."id" = x."job_id"
+    """,
+    "mysql": """
+    UPDATE `jobs` j JOIN (
+        SELECT c.`job_id`, MIN(c.`start_time`) AS `start_time`, MAX(c.`end_time`) AS `end_time`,
+            SUM(c.`user_time`) AS `user_time`, SUM(c.`system_time`) AS `system_time`
+        FROM `commands` c WHERE c.`job_id` IN ({jobs})
+        GROUP BY c.`job_id`
+    ) x ON j.`id` = x.`job_id`
+    SET j.`start_time` = x.`start_time`, j.`end_time` = x.`end_time`,
+        j.`user_time` = x.`user_time`, j.`system_time` = x.`system_time`,
+        j.`wall_time` = TIMESTAMPDIFF(SECOND, x.`start_time`, x.`end_time`)
+    """,
+    # Correlated subqueries as UPDATE ... FROM needs sqlite 3.33
+    "sqlite": """
+    UPDATE "jobs" SET
+        "start_time" = (SELECT MIN(c."start_time") FROM "commands" c WHERE c."job_id" = "jobs"."id"),
+        "end_time" = (SELECT MAX(c."end_time") FROM "commands" c WHERE c."job_id" = "jobs"."id"),
+        "user_time" = (SELECT SUM(c."user_time") FROM "commands" c WHERE c."job_id" = "jobs"."id"),
+        "system_time" = (SELECT SUM(c."system_time") FROM "commands" c WHERE c."job_id" = "jobs"."id"),
+        "wall_time" = (
+            SELECT CAST(ROUND((julianday(MAX(c."end_time")) - julianday(MIN(c."start_time"))) * 86400) AS INTEGER)
+            FROM "commands" c WHERE c."job_id" = "jobs"."id"
+        )
+    WHERE "id" IN ({jobs})
+    AND EXISTS (SELECT 1 FROM "commands" c WHERE c."job_id" = "jobs"."id")
+    """,
+}
+
+MERGE_COMMANDS = f"""
+    INSERT INTO "commands" ("job_id", "node_id", "software_id", "start_time", "end_time", "user_time", "system_time", "last_updated")
+    SELECT j."id", n."id", w."id", MIN(s."start_time"), MIN(s."end_time"), MIN(s."user_time"), MIN(s."system_time"), MIN(s."last_updated")
+    {STAGED_COMMANDS}
+    GROUP BY j."id", n."id", w."id"
+"""
+
+
+def copy_value(value):
+    """Value in the PostgreSQL COPY text format"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
 
 # Models
 class BaseModel(Model):
@@ -124,7 +322,38 @@ class Software(BaseModel):
         table_name = "softwares"
 
 
+class DirtyJob(BaseModel):
+    """Jobs with commands added since the last rollup"""
+
+    job = ForeignKeyField(Job, primary_key=True)
+
+    class Meta:
+        table_name = "dirty_jobs"
+
+
+class ExtractQueue(BaseModel):
+    """Jobs to extract, jobs queued again get a new id"""
+
+    job = ForeignKeyField(Job, unique=True)
+
+    class Meta:
+        table_name = "extract_queue"
+
+
+class ExtractFailed(BaseModel):
+    """Failed extraction attempts of each job"""
+
+    job = ForeignKeyField(Job, unique=True)
+    attempts = IntegerField()
+    error = TextField(null=True)
+
+    class Meta:
+        table_name = "extract_failed"
+
+
 class LastSent(BaseModel):
+    """Replaced by extract_queue, only used to seed it"""
+
     timestamp = DateTimeField()
 
     class Meta:
@@ -152,7 +381,17 @@ class Backend(sams.base.Backend):
         super(Backend, self).__init__(id, config)
         self.cluster = self.config.get([self.id, "cluster"])
         self.inserted = {}
+        self.updated = None
         self._dry_run = False
+        self.batch_size = int(self.config.get([self.id, "batch_size"], 1))
+        self.batch_time = float(self.config.get([self.id, "batch_time"], 0))
+        self.chunk_size = int(self.config.get([self.id, "chunk_size"], 1000))
+        self.bulk_load = self.config.get([self.id, "bulk_load"], "insert")
+        self.extract_max_attempts = int(self.config.get([self.id, "extract_max_attempts"], 3))
+        self.records = []
+        self.batch_started = None
+        # Ids of the rows in the dimension tables
+        self.cache = {Project: {}, User: {}, Node: {}, Software: {}}
 
         self.database = self.config.get([self.id, "database"], "sqlite")
         self.database_options = self.config.get([self.id, "database_options"], {})
@@ -165,6 +404,11 @@ class Backend(sams.base.Backend):
             sdb = MySQLDatabase(**self.database_options)
         else:
             raise sams.base.BackendException("A valid database config is not provided. Use: sqlite, postgresql or mysql")
+        if self.bulk_load not in ["insert", "staging"]:
+            raise sams.base.BackendException("Unknown bulk_load: %s. Use: insert or staging" % self.bulk_load)
+        if self.bulk_load == "staging" and self.database == "mysql":
+            raise sams.base.BackendException("bulk_load: staging is only supported with sqlite and postgresql")
+        self.staging_created = False
 
         db.initialize(sdb)
         self.db = db
@@ -173,12 +417,23 @@ class Backend(sams.base.Backend):
         create_tables = self.config.get([self.id, "create_tables"], "no")
         if create_tables == "yes":
             self.db.create_tables([User, Project, Job, Software, Command, Node, LastSent])
+        if Job.table_exists() and not DirtyJob.table_exists():
+            with self.db.atomic():
+                DirtyJob.create_table()
+                self.db.execute_sql(SEED_DIRTY_JOBS)
+        if Job.table_exists() and not ExtractQueue.table_exists():
+            with self.db.atomic():
+                ExtractQueue.create_table()
+                if LastSent.table_exists():
+                    self.db.execute_sql(SEED_EXTRACT_QUEUE)
+        if Job.table_exists() and not ExtractFailed.table_exists():
+            ExtractFailed.create_table()
 
     def dry_run(self, dry):
         self._dry_run = dry
 
     def aggregate(self, data):
-        """Information aggregate method"""
+        """Information aggregate method, the records are written by flush()"""
 
         jobid = int(data["sams.sampler.Core"]["jobid"])
         node_name = data["sams.sampler.Core"]["node"]
@@ -191,121 +446,231 @@ class Backend(sams.base.Backend):
         if len(data["sams.sampler.Software"]["execs"]) == 0:
             raise sams.base.AggregatorException("Jobid: {jobid} on node {node_name} has no execs")
 
-        with self.db.atomic():
-            # If project (account) is defined in data insert into table
-            project = None
-            if "account" in data["sams.sampler.SlurmInfo"]:
-                project_name = data["sams.sampler.SlurmInfo"]["account"]
-                try:
-                    project = Project.get(Project.name == project_name)
-                except Project.DoesNotExist:
-                    project = Project(name=project_name)
-                    project.save()
-
-            # If username is defined in data insert into table
-            user = None
-            if "username" in data["sams.sampler.SlurmInfo"]:
-                user_name = data["sams.sampler.SlurmInfo"]["username"]
-                try:
-                    user = User.get(User.name == user_name)
-                except User.DoesNotExist:
-                    user = User(name=user_name)
-                    user.save()
-
-            recordid = "%s:%s" % (self.cluster, jobid)
-            if "starttime" in data["sams.sampler.SlurmInfo"]:
-                starttime = data["sams.sampler.SlurmInfo"]["starttime"]
-                starttime = starttime.replace("-", "").replace("T", "").replace(":", "")
-                recordid = "%s:%s:%s" % (self.cluster, jobid, starttime)
-
-            # If username is defined in data insert into table
-            ncpus = None
-            if "cpus" in data["sams.sampler.SlurmInfo"]:
-                ncpus = data["sams.sampler.SlurmInfo"]["cpus"]
-
-            # Insert information about job
-            try:
-                job = Job.get(Job.jobid == jobid)
-            except Exception:
-                job = Job(
-                    jobid=jobid,
-                    user=user,
-                    project=project,
-                    ncpus=ncpus,
-                    recordid=recordid,
-                )
-                job.save()
+        slurm_info = data["sams.sampler.SlurmInfo"]
+        recordid = "%s:%s" % (self.cluster, jobid)
+        if "starttime" in slurm_info:
+            starttime = slurm_info["starttime"]
+            starttime = starttime.replace("-", "").replace("T", "").replace(":", "")
+            recordid = "%s:%s:%s" % (self.cluster, jobid, starttime)
+
+        start_time = datetime.fromtimestamp(int(data["sams.sampler.Software"]["start_time"]))
+        end_time = datetime.fromtimestamp(int(data["sams.sampler.Software"]["end_time"]))
+        commands = [
+            (path, start_time, end_time, info["user"], info["system"]) for path, info in data["sams.sampler.Software"]["execs"].items()
+        ]
+
+        if not self.records:
+            self.batch_started = time.time()
+        self.records.append(
+            {
+                "jobid": str(jobid),
+                "node": node_name,
+                "project": slurm_info.get("account"),
+                "user": slurm_info.get("username"),
+                "ncpus": slurm_info.get("cpus"),
+                "recordid": recordid,
+                "commands": commands,
+            }
+        )
 
-            # Insert node
-            node = None
-            try:
-                node = Node.get(Node.name == node_name)
-            except Node.DoesNotExist:
-                node = Node(name=node_name)
-                node.save()
-
-            # Insert information about running commands
-            for path, info in data["sams.sampler.Software"]["execs"].items():
-                # Insert software
-                software = None
-                try:
-                    software = Software.get(Software.path == path)
-                except Software.DoesNotExist:
-                    software = Software(path=path)
-                    software.save()
+    def pending(self):
+        return len(self.records)
 
-                try:
-                    command = Command.get(
-                        Command.job == job,
-                        Command.software == software,
-                        Command.node == node,
-                    )
-                except Exception:
-                    command = Command(
-                        job=job,
-                        software=software,
-                        node=node,
-                        start_time=datetime.fromtimestamp(int(data["sams.sampler.Software"]["start_time"])),
-                        end_time=datetime.fromtimestamp(int(data["sams.sampler.Software"]["end_time"])),
-                        user_time=info["user"],
-                        system_time=info["system"],
-                        last_updated=datetime.now(),
-                    )
-                    command.save()
+    def should_flush(self):
+        if len(self.records) >= self.batch_size:
+            return True
+        return bool(self.records and self.batch_time and time.time() - self.batch_started >= self.batch_time)
 
-                    # Mark job for update
-                    job.start_time = None
-                    job.end_time = None
-                    job.user_time = None
-                    job.system_time = None
-                    job.wall_time = None
-                    job.save()
+    def _chunks(self, rows, fields=1):
+        """Splits rows in chunks that fit in one statement"""
+        size = self.chunk_size
+        if self.database == "sqlite":
+            size = max(1, min(size, SQLITE_MAX_VARIABLES // fields))
+        for i in range(0, len(rows), size):
+            yield rows[i : i + size]
+
+    def _dimension_ids(self, model, column, names):
+        """Returns the ids of names in model, new names are inserted"""
+        cache = self.cache[model]
+        missing = sorted(set(name for name in names if name is not None and name not in cache))
+        for chunk in self._chunks(missing):
+            model.insert_many([{column: name} for name in chunk]).on_conflict_ignore().execute()
+        for chunk in self._chunks(missing):
+            for id, name in model.select(model.id, getattr(model, column)).where(getattr(model, column).in_(chunk)).tuples():
+                cache[name] = id
+        return cache
+
+    def flush(self):
+        """Writes the records aggregated since the last flush"""
+        records, self.records = self.records, []
+        self.batch_started = None
+        if not records:
+            return []
+        try:
+            with self.db.atomic():
+                if self.bulk_load == "staging":
+                    self._flush_staging(records)
+                else:
+                    self._flush(records)
+        except Exception:
+            # The transaction is rolled back, ids cached during it may not exist
+            for cache in self.cache.values():
+                cache.clear()
+            raise
+        return []
+
+    def _flush(self, records):
+        projects = self._dimension_ids(Project, "name", [r["project"] for r in records])
+        users = self._dimension_ids(User, "name", [r["user"] for r in records])
+        nodes = self._dimension_ids(Node, "name", [r["node"] for r in records])
+        softwares = self._dimension_ids(Software, "path", [path for r in records for path, *_ in r["commands"]])
+
+        # Jobs are created by the first record of the job
+        jobids = sorted(set(r["jobid"] for r in records))
+        jobs = {}
+        for chunk in self._chunks(jobids):
+            for id, jobid in Job.select(Job.id, Job.jobid).where(Job.jobid.in_(chunk)).order_by(Job.id).tuples():
+                jobs.setdefault(jobid, id)
+        new_jobs = {}
+        for r in records:
+            if r["jobid"] not in jobs and r["jobid"] not in new_jobs:
+                new_jobs[r["jobid"]] = {
+                    "jobid": r["jobid"],
+                    "user": users.get(r["user"]),
+                    "project": projects.get(r["project"]),
+                    "ncpus": r["ncpus"],
+                    "recordid": r["recordid"],
+                }
+        for chunk in self._chunks(list(new_jobs.values()), 5):
+            Job.insert_many(chunk).execute()
+        for chunk in self._chunks(list(new_jobs)):
+            for id, jobid in Job.select(Job.id, Job.jobid).where(Job.jobid.in_(chunk)).order_by(Job.id).tuples():
+                jobs.setdefault(jobid, id)
+
+        # One query for the existing commands of the jobs
+        existing = set()
+        job_ids = sorted(set(jobs[jobid] for jobid in jobids) - set(jobs[jobid] for jobid in new_jobs))
+        for chunk in self._chunks(job_ids):
+            existing.update(Command.select(Command.job, Command.software, Command.node).where(Command.job.in_(chunk)).tuples())
+
+        now = datetime.now()
+        commands = []
+        updated_jobs = set()
+        for r in records:
+            job = jobs[r["jobid"]]
+            node = nodes[r["node"]]
+            for path, start_time, end_time, user_time, system_time in r["commands"]:
+                key = (job, softwares[path], node)
+                if key in existing:
+                    continue
+                existing.add(key)
+                commands.append(
+                    {
+                        "job": job,
+                        "software": softwares[path],
+                        "node": node,
+                        "start_time": start_time,
+                        "end_time": end_time,
+                        "user_time": user_time,
+                        "system_time": system_time,
+                        "last_updated": now,
+                    }
+                )
+                updated_jobs.add(job)
+        for chunk in self._chunks(commands, 8):
+            Command.insert_many(chunk).execute()
+
+        # Mark jobs for update
+        for chunk in self._chunks(sorted(updated_jobs)):
+            DirtyJob.insert_many([{"job": job} for job in chunk]).on_conflict_ignore().execute()
+        self.queue(updated_jobs)
+
+    def queue(self, jobs):
+        """Queues jobs for extraction, jobs already in the queue are moved
+        to the end of it so a running extraction does not remove them."""
+        for chunk in self._chunks(sorted(jobs)):
+            ExtractQueue.delete().where(ExtractQueue.job.in_(chunk)).execute()
+            ExtractQueue.insert_many([{"job": job} for job in chunk]).execute()
+
+    def _flush_staging(self, records):
+        jobs = {}
+        paths = set()
+        commands = []
+        now = datetime.now()
+        for r in records:
+            jobs.setdefault(r["jobid"], (r["jobid"], r["recordid"], r["user"], r["project"], r["ncpus"], None, None, None, None))
+            for path, start_time, end_time, user_time, system_time in r["commands"]:
+                paths.add(path)
+                commands.append((r["jobid"], r["node"], path, start_time, end_time, user_time, system_time, now))
+        self.stage("sams_staging_jobs", jobs.values())
+        self.stage("sams_staging_softwares", [(path, None, None, None, None, None, None) for path in sorted(paths)])
+        self.stage("sams_staging_commands", commands)
+        self.merge()
+
+    def _create_staging(self):
+        if self.staging_created:
+            return
+        for table, columns in STAGING_TABLES.items():
+            self.db.execute_sql(
+                'CREATE TEMPORARY TABLE IF NOT EXISTS "%s" (%s)' % (table, ", ".join('"%s" %s' % column for column in columns))
+            )
+        self.staging_created = True
+
+    def stage(self, table, rows):
+        """Adds rows to a staging table, with COPY FROM STDIN on PostgreSQL.
+        The rows are written to the database tables by merge()."""
+        self._create_staging()
+        columns = ", ".join('"%s"' % name for name, _ in STAGING_TABLES[table])
+        cursor = self.db.cursor()
+        if self.database == "postgresql":
+            data = io.StringIO("".join("\t".join(copy_value(value) for value in row) + "\n" for row in rows))
+            sql = 'COPY "%s" (%s) FROM STDIN' % (table, columns)
+            if hasattr(cursor, "copy_expert"):
+                cursor.copy_expert(sql, data)
+            else:
+                with cursor.copy(sql) as copy:
+                    copy.write(data.getvalue())
+        else:
+            sql = 'INSERT INTO "%s" (%s) VALUES (%s)' % (table, columns, ", ".join([self.db.param] * len(STAGING_TABLES[table])))
+            cursor.executemany(sql, ([str(value) if isinstance(value, datetime) else value for value in row] for row in rows))
+
+    def merge(self, mark_jobs=True):
+        """Merges the staged rows into the database tables with one
+        statement for each table and empties the staging tables."""
+        self._create_staging()
+        for sql in MERGE_DIMENSIONS:
+            self.db.execute_sql(sql)
+        if mark_jobs:
+            self.db.execute_sql(MERGE_MARK_JOBS)
+            for sql in MERGE_QUEUE_JOBS:
+                self.db.execute_sql(sql)
+        self.db.execute_sql(MERGE_COMMANDS)
+        for table in STAGING_TABLES:
+            self.db.execute_sql('DELETE FROM "%s"' % table)
 
     def cleanup(self):
         pass
 
-    def close(self):
+    def rollup(self):
+        """Update the times of the jobs that got new commands. Only the
+        dirty jobs taken at the start are removed, jobs marked by other
+        aggregators meanwhile are left for the next rollup."""
         with self.db.atomic():
-            q = (
-                Command.select(
-                    Command.job,
-                    fn.MIN(Command.start_time).alias("start_time"),
-                    fn.MAX(Command.end_time).alias("end_time"),
-                    fn.SUM(Command.system_time).alias("system_time"),
-                    fn.SUM(Command.user_time).alias("user_time"),
-                )
-                .join(Job)
-                .where(Job.start_time.is_null() | Job.end_time.is_null() | Job.system_time.is_null() | Job.user_time.is_null())
-                .group_by(Command.job)
-            )
-            for x in q:
-                x.job.start_time = x.start_time
-                x.job.end_time = x.end_time
-                x.job.system_time = x.system_time
-                x.job.user_time = x.user_time
-                x.job.wall_time = (x.end_time - x.start_time).total_seconds()
-                x.job.last_updated = datetime.now()
-                x.job.save()
+            if self.database == "postgresql":
+                jobs = [job for (job,) in self.db.execute_sql('DELETE FROM "dirty_jobs" RETURNING "job_id"')]
+            else:
+                jobs = [job for (job,) in DirtyJob.select(DirtyJob.job).tuples()]
+            updated = 0
+            for chunk in self._chunks(sorted(jobs)):
+                sql = ROLLUP_JOBS[self.database].format(jobs=", ".join([self.db.param] * len(chunk)))
+                updated += self.db.execute_sql(sql, chunk).rowcount
+                if self.database != "postgresql":
+                    DirtyJob.delete().where(DirtyJob.job.in_(chunk)).execute()
+            logger.debug("Updated times of %d jobs", updated)
+
+    def close(self):
+        self.flush()
+        self.rollup()
 
     def update(self, software):
         """Information aggregate method"""
@@ -323,6 +688,8 @@ class Backend(sams.base.Backend):
                     s.last_updated = datetime.now()
                     if not self._dry_run:
                         s.save()
+                        if not s.ignore:
+                            self.queue([job for (job,) in Command.select(Command.job).where(Command.software == s).distinct().tuples()])
 
     @staticmethod
     def _print_software(software):
@@ -384,21 +751,18 @@ class Backend(sams.base.Backend):
                     software.software = None
                     software.save()
 
-    def extract(self):
-        """Software extract method"""
+    def extract(self, shards=None):
+        """Software extract method, extracts the jobs queued when the
+        extraction starts. commit() removes them from the queue after
+        all jobs are taken, skipped jobs are queued again."""
 
-        try:
-            updated = LastSent.get()
-        except LastSent.DoesNotExist:
-            updated = LastSent(timestamp=datetime.fromtimestamp(0))
-
-        updated_jobs = (
-            Command.select(Command.job).where(Command.last_updated > updated.timestamp).distinct()
-            | Command.select(Command.job)
-            .join(Software, on=Command.software == Software.id)
-            .where((Software.last_updated > updated.timestamp) & (Software.ignore is False))
-            .distinct()
-        )
+        self.updated = None
+        self.skipped = {}
+        max_id = ExtractQueue.select(fn.MAX(ExtractQueue.id)).scalar()
+        if max_id is None:
+            return
+
+        updated_jobs = ExtractQueue.select(ExtractQueue.job).where(ExtractQueue.id <= max_id)
 
         query = (
             Job.select(
@@ -410,8 +774,6 @@ class Backend(sams.base.Backend):
                 Software.versionstr,
                 Software.user_provided,
                 fn.SUM(Command.system_time + Command.user_time).alias("cpu"),
-                fn.MAX(Command.last_updated).alias("command_last_updated"),
-                fn.MAX(Command.software.last_updated).alias("software_last_updated"),
             )
             .join(Command, on=(Command.job == Job.id))
             .join(Software, on=(Command.software == Software.id), attr="software")
@@ -431,35 +793,55 @@ class Backend(sams.base.Backend):
         )
 
         jobs = {}
+        skipped = set()
 
         for job in query:
             logger.info("Job: %s", job.jobid)
-            if job.jobid not in jobs:
-                jobs[job.jobid] = sams.core.JobSoftware(job.jobid, job.recordid)
-
-            software = job.command.software.software % dict(user=job.user, project=job.project)
-            version = job.command.software.version % dict(user=job.user, project=job.project)
-            versionstr = job.command.software.versionstr % dict(user=job.user, project=job.project)
-
-            jobs[job.jobid].addSoftware(
-                sams.core.Software(
-                    software,
-                    version,
-                    versionstr,
-                    job.command.software.user_provided,
-                    job.cpu,
-                )
-            )
+            if job.jobid in skipped:
+                continue
 
-            if job.software_last_updated is not None:
-                updated.timestamp = max(updated.timestamp, job.software_last_updated)
-            if job.command_last_updated is not None:
-                updated.timestamp = max(updated.timestamp, job.command_last_updated)
+            names = dict(user=job.user, project=job.project)
+            try:
+                if job.jobid not in jobs:
+                    jobs[job.jobid] = sams.core.JobSoftware(job.jobid, job.recordid)
+
+                jobs[job.jobid].addSoftware(
+                    sams.core.Software(
+                        job.command.software.software and job.command.software.software % names,
+                        job.command.software.version and job.command.software.version % names,
+                        job.command.software.versionstr and job.command.software.versionstr % names,
+                        job.command.software.user_provided,
+                        job.cpu,
+                    )
+                )
+            except sams.core.JobSoftwareException as e:
+                # The job is left in the queue for the next run
+                logger.info("Skipping job %s: %s", job.jobid, e)
+                jobs.pop(job.jobid, None)
+                skipped.add(job.jobid)
+                self.skipped[job.id] = (job.jobid, str(e))
 
-        self.updated = updated
+        yield from jobs.values()
 
-        return jobs.values()
+        self.updated = max_id
 
     def commit(self):
-        """Commits last used timestamp to database."""
-        self.updated.save()
+        """Removes the extracted jobs from the queue, the skipped jobs get
+        a new id and are extracted again by the next run until they have
+        failed extract_max_attempts times."""
+        if self.updated is not None:
+            with self.db.atomic():
+                ExtractQueue.delete().where(ExtractQueue.id <= self.updated).execute()
+                requeue = []
+                for job, (jobid, error) in sorted(self.skipped.items()):
+                    failed = ExtractFailed.get_or_none(ExtractFailed.job == job) or ExtractFailed(job=job, attempts=0)
+                    failed.attempts += 1
+                    failed.error = error
+                    failed.save()
+                    if failed.attempts < self.extract_max_attempts:
+                        requeue.append(job)
+                    else:
+                        logger.error("Giving up on job %s after %d attempts: %s", jobid, failed.attempts, error)
+                self.queue(requeue)
+            self.updated = None
+            self.skipped = {}
@@ -26,6 +26,7 @@ import socket
 import threading
 import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 from sams.core import Config
@@ -57,6 +58,7 @@ class Sampler(threading.Thread):
     def __init__(self, id, outQueue, config):
         super(Sampler, self).__init__()
         self.id = id
+        self.sample_version = 0
         self._most_recent_sample = None
         self.outQueue = outQueue
         self.config = config
@@ -64,6 +66,9 @@ class Sampler(threading.Thread):
         self.pidQueue = queue.Queue()
         self.pids = []
         self.sampler_interval = self.config.get([self.id, "sampler_interval"], 60)
+        # Off by default, see checkpoint_data()
+        self.checkpoint_interval = float(self.config.get([self.id, "checkpoint_interval"], 0))
+        self.last_checkpoint = time.time()
 
     def init(self):  # pylint: disable=no-self-use
         pass
@@ -89,6 +94,14 @@ class Sampler(threading.Thread):
                     self.sample()
             except Exception:
                 logger.exception("Failed to do self.sample in %s", self.id)
+            if self.checkpoint_interval > 0 and time.time() - self.last_checkpoint >= self.checkpoint_interval:
+                self.last_checkpoint = time.time()
+                try:
+                    data = self.checkpoint_data()
+                    if data is not None:
+                        self.store(data, "checkpoint")
+                except Exception:
+                    logger.exception("Failed to do self.checkpoint_data in %s", self.id)
 
         try:
             self.store(self.final_data(), "final")
@@ -106,6 +119,17 @@ class Sampler(threading.Thread):
     def store(self, data, type="now"):
         self.outQueue.put(self._storage_wrapping(data, type))
 
+    @property
+    def _most_recent_sample(self):
+        return self._sample
+
+    @_most_recent_sample.setter
+    def _most_recent_sample(self, sample):
+        """Stores the sample and bumps sample_version so that
+        listeners can tell that there is a new sample."""
+        self._sample = sample
+        self.sample_version += 1
+
     @property
     def most_recent_sample(self):
         """The most recently sample or set of samples stored by a call
@@ -122,6 +146,13 @@ class Sampler(threading.Thread):
     def final_data(self):
         raise NotImplementedError("Not implemented")
 
+    # pylint: disable=no-self-use
+    def checkpoint_data(self):
+        """Snapshot of what final_data() would return right now,
+        or None if the sampler has nothing to checkpoint.
+        Must not have side effects."""
+        return None
+
     def do_sample(self):
         return len(self.pids) > 0
 
@@ -145,6 +176,31 @@ class Aggregator:
     def aggregate(self, data):
         raise NotImplementedError("Not implemented")
 
+    # pylint: disable=no-self-use
+    def pending(self):
+        """Number of aggregated records not yet stored durably"""
+        return 0
+
+    # pylint: disable=no-self-use
+    def should_flush(self):
+        return False
+
+    def flush(self):
+        """Store pending records durably, raises if they could not be stored.
+        May return the positions, counted from 0 at the previous flush, of
+        aggregate() calls whose records failed."""
+        return []
+
+    def cleanup(self):
+        pass
+
+    def rollup(self):
+        """Update derived data, called between batches when sams-aggregator runs with --watch"""
+        pass
+
+    def close(self):
+        pass
+
 
 class Loader:
     """Loader base class"""
@@ -162,9 +218,28 @@ class Loader:
         raise NotImplementedError("Not implemented")
 
     # pylint: disable=no-self-use
-    def commit(self):
+    def current(self):
+        """Handle of the record returned by next(), commit() and error()
+        take it to finish a record after later records have been read."""
+        return None
+
+    # pylint: disable=no-self-use
+    def commit(self, item=None):
+        raise NotImplementedError("Not implemented")
+
+    # pylint: disable=no-self-use
+    def error(self, item=None):
         raise NotImplementedError("Not implemented")
 
+    def wait(self, timeout):
+        """Wait at most timeout seconds for new records after next() returned
+        None, used when sams-aggregator runs with --watch."""
+        time.sleep(timeout)
+        self.load()
+
+    def close(self):
+        pass
+
 
 class BackendException(Exception):
     pass
@@ -182,9 +257,15 @@ class Backend:
         raise NotImplementedError("Not implemented")
 
     # pylint: disable=no-self-use
-    def extract(self):
+    def extract(self, shards=None):
         raise NotImplementedError("Not implemented")
 
+    # pylint: disable=no-self-use
+    def shards(self):
+        """Parts of the backend that can be extracted in parallel,
+        None if the backend can't be split."""
+        return None
+
 
 class Software:
     """Software base class"""
@@ -215,6 +296,13 @@ class Output(threading.Thread):
             if data is None:
                 self.dataQueue.task_done()
                 break
+            if data.get("type") == "checkpoint":
+                try:
+                    self.checkpoint({data["id"]: data["data"]})
+                except Exception:
+                    logger.exception("Failed to do self.checkpoint in %s", self.id)
+                self.dataQueue.task_done()
+                continue
             try:
                 self.store({data["id"]: data["data"]})
             except Exception:
@@ -241,6 +329,11 @@ class Output(threading.Thread):
     def final(self, data):
         self.store(data)
 
+    def checkpoint(self, data):
+        """Snapshot of the final data from a sampler, sent periodically
+        while the job is running. Ignored unless the output uses it."""
+        pass
+
     # pylint: disable=no-self-use
     def write(self):
         raise NotImplementedError("Not implemented")
@@ -257,32 +350,66 @@ class XMLWriter:
         self.config = config
 
     # pylint: disable=no-self-use
-    def write(self, data):
+    def write(self, data, commit=None):
+        raise NotImplementedError("Not implemented")
+
+    # pylint: disable=no-self-use
+    def write_part(self, data, part):
+        """Writes data to staged files, returns the files."""
+        raise NotImplementedError("Not implemented")
+
+    # pylint: disable=no-self-use
+    def publish(self, files, n=0):
+        """Gives the staged files their final names, in order starting
+        with number n. Returns the number of the next file."""
+        raise NotImplementedError("Not implemented")
+
+    # pylint: disable=no-self-use
+    def discard(self, files):
+        """Removes staged files."""
         raise NotImplementedError("Not implemented")
 
 
 class Listener(ABC):
-    """Base class for listening to sockets and sending encoded data."""
+    """Base class for listening to sockets and sending encoded data.
+
+    The encoded data is cached and only encoded again when one of the
+    samplers has a new sample. Connections are served by a pool of
+    ``workers`` threads.
+    """
 
     def __init__(self, id: str, config: Config, samplers: List):
         self.id = id
         self.config = config
         self.samplers = samplers
-        socket_directory = self.config.get([self.id, "socketdir"], "/tmp/softwareaccounting")
         self.job_id = self.config.get(["options", "jobid"], 0)
-        self.server_socket = socket.socket(socket.AF_UNIX)
+        self.workers = int(self.config.get([self.id, "workers"], 4))
+        self.socket_path = None
         self.is_finished = False
+        self.server_socket = self._bind()
+        self._cache_lock = threading.Lock()
+        self._cache_version = None
+        self._cache = b""
+        # Written to on exit to wake up the listening thread
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self.thread = threading.Thread(target=self._listen)
+
+    def _bind(self):
+        """Creates the server socket, a Unix socket in socketdir."""
+        socket_directory = self.config.get([self.id, "socketdir"], "/tmp/softwareaccounting")
+        server_socket = socket.socket(socket.AF_UNIX)
         if not os.path.isdir(socket_directory):
             os.mkdir(socket_directory)
         self.socket_path = f"{socket_directory}/{self.id}_{self.job_id:d}.socket"
         logger.debug(f"Socket path: {self.socket_path}")
         if os.path.exists(self.socket_path):
             os.unlink(self.socket_path)
-        self.server_socket.bind(self.socket_path)
-        self.thread = threading.Thread(target=self._listen)
+        server_socket.bind(self.socket_path)
+        return server_socket
 
     def start(self):
         """Starts listening on thread."""
+        self.server_socket.listen(5)
         self.thread.start()
         logger.debug("Launching listening thread...")
 
@@ -290,28 +417,53 @@ class Listener(ABC):
         """Sets finished flag to True to kill thread, joins and cleans up."""
         if not self.is_finished:
             self.is_finished = True
-            if self.thread.is_alive:
+            os.write(self._wakeup_write, b"\0")
+            if self.thread.is_alive():
                 self.thread.join(1)
             self.server_socket.close()
-            os.unlink(self.socket_path)
+            if self.socket_path is not None:
+                os.unlink(self.socket_path)
+            os.close(self._wakeup_read)
+            os.close(self._wakeup_write)
+
+    @property
+    def version(self):
+        """Changes whenever any of the samplers has a new sample."""
+        return tuple(getattr(sampler, "sample_version", 0) for sampler in self.samplers)
+
+    def cached_data(self):
+        """Returns ``(version, encoded_data)``, only encoding
+        the data again when the version has changed."""
+        version = self.version
+        with self._cache_lock:
+            if version != self._cache_version:
+                self._cache = self.encoded_data
+                self._cache_version = version
+            return self._cache_version, self._cache
 
     def _listen(self):
         """Listens to the socket for connections."""
-        self.server_socket.listen(5)
-        while not self.is_finished:
-            logger.debug("Waiting for connections...")
-            readable, _, _ = select.select([self.server_socket], [], [], 1)
-            if len(readable) > 0:
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.is_finished:
+                logger.debug("Waiting for connections...")
+                readable, _, _ = select.select([self.server_socket, self._wakeup_read], [], [])
+                if self.server_socket not in readable or self.is_finished:
+                    continue
                 try:
                     connection, address = self.server_socket.accept()
                     logger.debug(f"Connected to {address}")
                 except Exception as e:
-                    logger.debug(f"Sending data failed due to {e}!")
-                with connection:
-                    try:
-                        connection.sendall(self.encoded_data)
-                    except Exception as e:
-                        logger.debug(f"Sending data to {address} failed due to {e}!")
+                    logger.debug(f"Accepting connection failed due to {e}!")
+                    continue
+                executor.submit(self._serve, connection)
+
+    def _serve(self, connection):
+        """Sends the cached data to one client."""
+        with connection:
+            try:
+                connection.sendall(self.cached_data()[1])
+            except Exception as e:
+                logger.debug(f"Sending data failed due to {e}!")
 
     @property
     @abstractmethod
@@ -18,11 +18,15 @@ You should have received a copy of the GNU General Public License
 along with this program; If not, see <http://www.gnu.org/licenses/>.
 """
 
+import ctypes
+import ctypes.util
+import gzip
 import logging
 import os
 import queue
 import resource  # Resource usage information.
-import sys
+import select
+import struct
 import threading
 
 import yaml
@@ -132,6 +136,98 @@ class ClassLoader:
         return new_class
 
 
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# File name suffix used for each compression
+COMPRESSION_SUFFIX = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def compress(data, compression="none"):
+    """Compress bytes with compression (none, gzip or zstd)"""
+    if compression == "gzip":
+        return gzip.compress(data)
+    if compression == "zstd":
+        import zstandard  # pylint: disable=import-outside-toplevel
+
+        return zstandard.ZstdCompressor().compress(data)
+    if compression != "none":
+        raise Exception("Unknown compression: %s" % compression)
+    return data
+
+
+def decompress(data):
+    """Decompress bytes that are gzip or zstd compressed, other data is returned as is"""
+    if data[:2] == GZIP_MAGIC:
+        return gzip.decompress(data)
+    if data[:4] == ZSTD_MAGIC:
+        import zstandard  # pylint: disable=import-outside-toplevel
+
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def read_file(filename):
+    """Read the content of a possibly compressed file"""
+    with open(filename, "rb") as file:
+        return decompress(file.read())
+
+
+class Inotify:
+    """Minimal inotify(7) wrapper, raises OSError where inotify is not available"""
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        libname = ctypes.util.find_library("c")
+        self._libc = ctypes.CDLL(libname, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {}
+
+    def add_watch(self, path, mask):
+        """Watch path for events in mask, returns the watch descriptor"""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.watches[wd] = path
+        return wd
+
+    def read(self, timeout=None):
+        """Returns a list of (path, mask, name) events, empty on timeout"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        buf = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = self._EVENT.unpack_from(buf, offset)
+            offset += self._EVENT.size
+            name = os.fsdecode(buf[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((self.watches.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
 # The standard I/O file descriptors are redirected to /dev/null by default.
 if hasattr(os, "devnull"):
     REDIRECT_TO = os.devnull
@@ -189,39 +285,42 @@ def createDaemon(umask=0, workdir="/", maxfds=1024):
     return 0
 
 
+class JobSoftwareException(Exception):
+    pass
+
+
 class JobSoftware:
+    __slots__ = ("_softwares", "_jobid", "_recordid", "_cpu", "_totals", "_filtered")
+
     def __init__(self, jobid, recordid):
         self._softwares = []
         self._jobid = jobid
         self._recordid = recordid
+        self._cpu = 0
+        # Cached per remove_less_then
+        self._totals = {}
+        self._filtered = {}
 
         if self._recordid is None:
-            print("%s has no recordid" % (self._jobid))
-            sys.exit()
+            raise JobSoftwareException("%s has no recordid" % (self._jobid))
 
     def addSoftware(self, software):
-        if software.software is None:
-            print("%s has no software" % (self._recordid))
-            sys.exit()
-        if software.version is None:
-            print("%s has no version" % (self._recordid))
-            sys.exit()
-        if software.versionstr is None:
-            print("%s has no versionstr" % (self._recordid))
-            sys.exit()
-        if software.user_provided is None:
-            print("%s has no user_provided" % (self._recordid))
-            sys.exit()
-        if software.cpu is None:
-            print("%s has no cpu" % (self._recordid))
-            sys.exit()
+        for field in Software.__slots__:
+            if getattr(software, field) is None:
+                raise JobSoftwareException("%s has no %s" % (self._recordid, field))
         self._softwares.append(software)
+        self._cpu += software.cpu
+        self._totals.clear()
+        self._filtered.clear()
 
     def softwares(self, remove_less_then=1.0):
-        t = self.total_cpu()
-        if t == 0.0:
-            return self._softwares
-        return [x for x in self._softwares if 100 * x.cpu / t >= remove_less_then]
+        if remove_less_then not in self._filtered:
+            t = self.total_cpu()
+            if t == 0.0:
+                self._filtered[remove_less_then] = self._softwares
+            else:
+                self._filtered[remove_less_then] = [x for x in self._softwares if 100 * x.cpu / t >= remove_less_then]
+        return self._filtered[remove_less_then]
 
     def jobid(self):
         return self._jobid
@@ -230,10 +329,13 @@ class JobSoftware:
         return self._recordid
 
     def total_cpu(self, remove_less_then=1.0):
-        t = sum([x.cpu for x in self._softwares])
-        if t == 0.0 or remove_less_then == 0.0:
-            return t
-        return sum([x.cpu for x in self._softwares if 100 * x.cpu / t >= remove_less_then])
+        if remove_less_then not in self._totals:
+            t = self._cpu
+            if t == 0.0 or remove_less_then == 0.0:
+                self._totals[remove_less_then] = t
+            else:
+                self._totals[remove_less_then] = sum([x.cpu for x in self._softwares if 100 * x.cpu / t >= remove_less_then])
+        return self._totals[remove_less_then]
 
     def __str__(self):
         return "JobSoftware: %s (%s) - %s = %f" % (
@@ -248,6 +350,8 @@ class JobSoftware:
 
 
 class Software:
+    __slots__ = ("software", "version", "versionstr", "user_provided", "cpu")
+
     def __init__(self, software, version, versionstr, user_provided, cpu):
         self.software = software
         self.version = version
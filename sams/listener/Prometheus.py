@@ -7,6 +7,8 @@ from sams.core import Config
 
 logger = logging.getLogger(__name__)
 
+METRIC_RE = re.compile(r"^(\S+){")
+
 
 class Listener(sams.base.Listener):
     """
@@ -17,7 +19,8 @@ class Listener(sams.base.Listener):
         super().__init__(id, config, samplers)
         self.static_map = self.config.get([self.id, "static_map"], {})
         self.map = self.config.get([self.id, "map"], {})
-        self.metrics = self.config.get([self.id, "metrics"], {})
+        # Compile the metric regexps once
+        self.metrics = [(re.compile(metric), destination) for metric, destination in self.config.get([self.id, "metrics"], {}).items()]
 
     @staticmethod
     def _nested_getitem(dct: Dict, keys: Iterable) -> Dict:
@@ -39,9 +42,9 @@ class Listener(sams.base.Listener):
         for key in dct.keys():
             nb = "/".join([base, key])
             if key in dct and isinstance(dct[key], dict):
-                out = out + self._flatten_dict(dct[key], base=nb)
+                out.extend(self._flatten_dict(dct[key], base=nb))
             else:
-                out = out + [{"match": nb, "value": dct[key]}]
+                out.append({"match": nb, "value": dct[key]})
         return out
 
     @property
@@ -76,8 +79,7 @@ class Listener(sams.base.Listener):
         flat_dictionary = self._flatten_dict(data)
         logger.debug(f"Flat dictionary: {flat_dictionary}")
         for d in flat_dictionary:
-            for metric, destination in self.metrics.items():
-                reg = re.compile(metric)
+            for reg, destination in self.metrics:
                 m = reg.match(d["match"])
                 logger.debug(f"Metric matches: {m}")
                 if m is not None:
@@ -89,11 +91,10 @@ class Listener(sams.base.Listener):
         turns it into a Prometheus-formatted bytestring,
         ready to be sent over socket."""
         helped = dict()
-        metric_re = re.compile(r"^(\S+){")
         formatted_data = []
         for m in sorted(compiled_data.keys()):
             logger.debug(f"Data key: {m}")
-            match = metric_re.match(m)
+            match = METRIC_RE.match(m)
             # Check if key is in config
             if match is None:
                 continue
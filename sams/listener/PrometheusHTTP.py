@@ -0,0 +1,134 @@
+"""
+Serves the Prometheus listener data over HTTP on /metrics
+
+SAMS Software accounting
+Copyright (C) 2018-2021  Swedish National Infrastructure for Computing (SNIC)
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; If not, see <http://www.gnu.org/licenses/>.
+
+Config Options:
+
+sams.listener.PrometheusHTTP:
+    # Listen on a Unix socket in socketdir named
+    # sams.listener.PrometheusHTTP_<jobid>.socket
+    socketdir: /tmp/softwareaccounting
+
+    # Or listen on TCP instead when port is set.
+    # Only one job on each node can use the same port.
+    address: 127.0.0.1
+    port: 9101
+
+    # Number of threads serving clients.
+    workers: 4
+
+    # map, static_map and metrics are the same as for sams.listener.Prometheus
+"""
+
+import gzip
+import hashlib
+import logging
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler
+
+from sams.listener.Prometheus import Listener as PrometheusListener
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Handles one HTTP request, ``self.server`` is the Listener."""
+
+    timeout = 10
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        etag, payload, gzipped = self.server.http_payload()
+
+        encoding = None
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            payload = gzipped
+            encoding = "gzip"
+            # Each encoding is a different representation with its own ETag
+            etag = etag[:-1] + '-gz"'
+
+        if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("ETag", etag)
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        if body:
+            self.wfile.write(payload)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug(format, *args)
+
+
+class Listener(PrometheusListener):
+    """
+    Listener serving Prometheus exposition format on /metrics.
+    """
+
+    def __init__(self, id, config, samplers):
+        super().__init__(id, config, samplers)
+        self._http_lock = threading.Lock()
+        self._http_version = None
+        self._http_payload = (None, b"", b"")
+
+    def _bind(self):
+        port = self.config.get([self.id, "port"])
+        if port is None:
+            return super()._bind()
+        address = self.config.get([self.id, "address"], "127.0.0.1")
+        server_socket = socket.socket(socket.AF_INET)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((address, int(port)))
+        logger.debug(f"Listening on {address}:{port}")
+        return server_socket
+
+    def http_payload(self):
+        """Returns ``(etag, payload, gzipped payload)``, recalculated
+        only when the cached data has changed."""
+        version, payload = self.cached_data()
+        with self._http_lock:
+            if version != self._http_version:
+                etag = '"%s"' % hashlib.sha1(payload).hexdigest()
+                self._http_payload = (etag, payload, gzip.compress(payload))
+                self._http_version = version
+            return self._http_payload
+
+    def _serve(self, connection):
+        with connection:
+            try:
+                MetricsHandler(connection, "", self)
+            except Exception as e:
+                logger.debug(f"Serving HTTP request failed due to {e}!")
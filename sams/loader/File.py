@@ -16,18 +16,102 @@ GNU General Public License for more details.
 
 You should have received a copy of the GNU General Public License
 along with this program; If not, see <http://www.gnu.org/licenses/>.
+
+Config Options:
+
+sams.loader.File:
+    in_path: /data/softwareaccounting/data
+    archive_path: /data/softwareaccounting/archive
+    error_path: /data/softwareaccounting/error
+    file_pattern: '^.*\\.json$'
+
+    # Files are found while loading, at most lookahead files at the time.
+    lookahead: 10000
+
+    # Hidden files and the .checkpoint files of sams.output.File are not
+    # loaded. A .checkpoint without its final file that has not been
+    # updated for checkpoint_age seconds is renamed to the final name and
+    # loaded, its collector has stopped.
+    checkpoint_age: 86400
+
+    # Order of the files within each lookahead window: none, mtime or jobid
+    # (the leading digits of the file name).
+    sort: none
+
+    # Remember the directory being loaded so that a restarted loader
+    # does not scan the directories before it again.
+    cursor_file: /data/softwareaccounting/.sams.loader.File.cursor
+
+    # Number of processes reading and parsing files ahead of the
+    # aggregators, 0 reads in the aggregator process.
+    read_workers: 0
+
+    # Number of files being read ahead, default 4 * read_workers, at least 1.
+    read_ahead: 16
+
+    # Move committed files to archive_path/error_path in a separate thread.
+    commit_thread: false
+
+    # Claim files by moving them to claim_path/<instance>/ before they are
+    # loaded, so that several sams-aggregator can share in_path.
+    # Claims of an instance that has not updated its heartbeat file for
+    # stale_claim_age seconds are moved back to in_path, checked every
+    # stale_claim_age seconds. The default instance is <hostname>.<pid>.
+    claim_path: /data/softwareaccounting/processing
+    instance: node1
+    heartbeat_interval: 30
+    stale_claim_age: 600
+
+    # Only load the files of the shards (jobid / shard_size) where
+    # shard % instance_count == instance_index. Use the jobid_hash_size
+    # of the aggregator as shard_size.
+    instance_index: 0
+    instance_count: 1
+    shard_size: 0
+
+    # When sams-aggregator runs with --watch new files are found with inotify
+    # and in_path is scanned again every rescan_interval seconds. Without
+    # inotify (e.g. on NFS) in_path is scanned every poll_interval seconds.
+    inotify: true
+    poll_interval: 10
+    rescan_interval: 3600
 """
 
 import json
 import logging
 import os
+import platform
+import queue
 import re
 import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import sams.base
+import sams.core
 
 logger = logging.getLogger(__name__)
 
+CHECKPOINT_SUFFIX = ".checkpoint"
+
+
+def parse(filename):
+    """Read and parse one file, run in the read_workers processes"""
+    return json.loads(sams.core.read_file(filename))
+
+
+def pid_alive(pid):
+    """True if a process with pid is running on this host"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
 
 class Loader(sams.base.Loader):
     def __init__(self, id, config):
@@ -36,40 +120,385 @@ class Loader(sams.base.Loader):
         self.archive_path = self.config.get([self.id, "archive_path"])
         self.error_path = self.config.get([self.id, "error_path"])
         self.file_pattern = re.compile(self.config.get([self.id, "file_pattern"], "^.*$"))
-        self.files = []
+        self.lookahead = int(self.config.get([self.id, "lookahead"], 10000))
+        self.checkpoint_age = float(self.config.get([self.id, "checkpoint_age"], 86400))
+        self.sort = self.config.get([self.id, "sort"], "none")
+        if self.sort not in ["none", "mtime", "jobid"]:
+            raise Exception("Unknown sort: %s" % self.sort)
+        self.cursor_file = self.config.get([self.id, "cursor_file"])
+        self.cursor = ()
+        self.walker = iter([])
+        self.files = deque()
         self.current_file = None
+        self.read_workers = int(self.config.get([self.id, "read_workers"], 0))
+        self.read_ahead = int(self.config.get([self.id, "read_ahead"], self.read_workers * 4))
+        if self.read_workers > 0:
+            # Nothing would be read with read_ahead 0
+            self.read_ahead = max(1, self.read_ahead)
+        self.reading = deque()
+        self.pool = None
+        self.async_commit = self.config.get([self.id, "commit_thread"], False)
+        self.commit_queue = None
+        self.commit_thread = None
+
+        self.claim_path = self.config.get([self.id, "claim_path"])
+        self.instance = str(self.config.get([self.id, "instance"], "%s.%d" % (platform.node(), os.getpid())))
+        self.claim_root = os.path.join(self.claim_path, self.instance) if self.claim_path else None
+        self.heartbeat_interval = float(self.config.get([self.id, "heartbeat_interval"], 30))
+        self.stale_claim_age = float(self.config.get([self.id, "stale_claim_age"], 600))
+        self.heartbeat = None
+        self.instance_index = int(self.config.get([self.id, "instance_index"], 0))
+        self.instance_count = int(self.config.get([self.id, "instance_count"], 1))
+        self.shard_size = int(self.config.get([self.id, "shard_size"], 0))
+
+        self.use_inotify = self.config.get([self.id, "inotify"], True)
+        self.poll_interval = float(self.config.get([self.id, "poll_interval"], 10))
+        self.rescan_interval = float(self.config.get([self.id, "rescan_interval"], 3600))
+        self.inotify = None
+        self.watching = False
+        self.last_scan = 0
+        # Files handed out by next() and not yet committed, a file can be
+        # found both by a scan and by inotify.
+        self.loading = set()
 
     def load(self):
         """Find files in in_path matching file_pattern"""
-        for root, _, files in os.walk(self.in_path):
-            for file in files:
-                logger.debug("Found file: %s", file)
-                if self.file_pattern.match(file):
-                    logger.debug("Add %s to files[]", os.path.join(root, file))
-                    self.files.append({"file": file, "path": os.path.relpath(root, self.in_path)})
+        if self.cursor_file and os.path.exists(self.cursor_file):
+            with open(self.cursor_file) as file:
+                self.cursor = tuple(json.load(file))
+            logger.info("Continue from: %s", os.path.join(*self.cursor) if self.cursor else ".")
+        if self.claim_root and self.heartbeat is None:
+            self._recover_claims(startup=True)
+            self.heartbeat = threading.Event()
+            threading.Thread(target=self._heartbeat, args=(self.heartbeat,), daemon=True).start()
+        self.walker = self._walk()
+        self.last_scan = time.time()
+        self.files = deque()
+        self.reading = deque()
+        if self.read_workers > 0 and self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.read_workers)
+        if self.async_commit and self.commit_queue is None:
+            self.commit_queue = queue.Queue(maxsize=10000)
+            self.commit_thread = threading.Thread(target=self._mover, daemon=True)
+            self.commit_thread.start()
+
+    def _walk(self):
+        """Yields the files depth first with sorted names, directories
+        before the cursor are skipped."""
+        stack = [()]
+        while stack:
+            path = stack.pop()
+            subdirs = []
+            files = {}
+            names = set()
+            checkpoints = []
+            try:
+                with os.scandir(os.path.join(self.in_path, *path)) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                            continue
+                        names.add(entry.name)
+                        if entry.name.startswith("."):
+                            continue
+                        if entry.name.endswith(CHECKPOINT_SUFFIX):
+                            checkpoints.append(entry)
+                        elif self.file_pattern.match(entry.name) and self._routed(entry.name):
+                            files[entry.name] = entry
+            except OSError as e:
+                logger.error("Failed to scan %s: %s", os.path.join(self.in_path, *path), e)
+                continue
+
+            if path >= self.cursor:
+                relpath = os.path.join(*path) if path else "."
+                for entry in checkpoints:
+                    name = self._recover_checkpoint(path, entry, names)
+                    if name is not None:
+                        files[name] = None
+                for name in sorted(files):
+                    logger.debug("Add %s to files[]", os.path.join(relpath, name))
+                    file = {"file": name, "path": relpath, "dir": path}
+                    if self.sort == "mtime":
+                        entry = files[name]
+                        file["mtime"] = entry.stat().st_mtime if entry else os.stat(os.path.join(self.in_path, relpath, name)).st_mtime
+                    yield file
+
+            for name in sorted(subdirs, reverse=True):
+                subdir = path + (name,)
+                # Descend into directories after the cursor and the parents of the cursor
+                if subdir >= self.cursor or self.cursor[: len(subdir)] == subdir:
+                    stack.append(subdir)
+
+    def _recover_checkpoint(self, path, entry, names):
+        """Renames an orphaned checkpoint to its final name, returns the
+        final name or None if the checkpoint is not orphaned."""
+        name = entry.name[: -len(CHECKPOINT_SUFFIX)]
+        if name in names or not self.file_pattern.match(name) or not self._routed(name):
+            return None
+        try:
+            if time.time() - entry.stat().st_mtime < self.checkpoint_age:
+                return None
+            os.rename(entry.path, os.path.join(self.in_path, *path, name))
+        except OSError as e:
+            logger.debug("Failed to recover %s: %s", entry.path, e)
+            return None
+        logger.info("Loading orphaned checkpoint %s", entry.path)
+        return name
+
+    def _rescan(self):
+        logger.debug("Scanning %s", self.in_path)
+        self.walker = self._walk()
+        self.last_scan = time.time()
+
+    def _watch_tree(self, path):
+        """Adds inotify watches on path and the directories below it"""
+        mask = self.inotify.IN_CLOSE_WRITE | self.inotify.IN_MOVED_TO | self.inotify.IN_CREATE
+        for dirpath, _, _ in os.walk(path):
+            try:
+                self.inotify.add_watch(dirpath, mask)
+            except OSError as e:
+                logger.error("Failed to watch %s: %s", dirpath, e)
+
+    def _watch(self):
+        self.watching = True
+        if self.use_inotify:
+            try:
+                self.inotify = sams.core.Inotify()
+                self._watch_tree(self.in_path)
+            except OSError as e:
+                logger.info("inotify not available (%s), scanning %s every %d seconds", e, self.in_path, self.poll_interval)
+                self.inotify = None
+        # Files created before the watches were added
+        self._rescan()
+
+    def wait(self, timeout):
+        """Waits for new files in in_path"""
+        if not self.watching:
+            self._watch()
+            return
+        if self.inotify is None:
+            time.sleep(timeout)
+            if time.time() - self.last_scan >= self.poll_interval:
+                self._rescan()
+            return
+
+        rescan = time.time() - self.last_scan >= self.rescan_interval
+        for path, mask, name in self.inotify.read(timeout):
+            if mask & self.inotify.IN_Q_OVERFLOW:
+                logger.info("inotify queue overflow, scanning %s", self.in_path)
+                rescan = True
+            elif path is None or name.startswith(".") or name.endswith(CHECKPOINT_SUFFIX):
+                continue
+            elif mask & self.inotify.IN_ISDIR:
+                if mask & (self.inotify.IN_CREATE | self.inotify.IN_MOVED_TO):
+                    # Files may be in the directory before it is watched
+                    self._watch_tree(os.path.join(path, name))
+                    rescan = True
+            elif mask & (self.inotify.IN_CLOSE_WRITE | self.inotify.IN_MOVED_TO):
+                if self.file_pattern.match(name) and self._routed(name):
+                    relpath = os.path.relpath(path, self.in_path)
+                    directory = () if relpath == "." else tuple(relpath.split(os.sep))
+                    self.files.append({"file": name, "path": relpath, "dir": directory})
+        if rescan:
+            self._rescan()
+
+    def _routed(self, filename):
+        """True if the shard of the file belongs to this instance"""
+        if self.instance_count <= 1:
+            return True
+        m = re.match(r"^(\d+)", filename)
+        if not m:
+            return self.instance_index == 0
+        shard = int(m.group(1)) // self.shard_size if self.shard_size else 0
+        return shard % self.instance_count == self.instance_index
+
+    def _heartbeat(self, stop):
+        filename = os.path.join(self.claim_root, ".heartbeat")
+        last_recover = time.time()
+        while True:
+            try:
+                os.makedirs(self.claim_root, exist_ok=True)
+                with open(filename, "w") as file:
+                    file.write("%d\n" % os.getpid())
+            except OSError as e:
+                logger.error("Failed to update heartbeat %s: %s", filename, e)
+            # Instances may stop while this one is running
+            if time.time() - last_recover >= self.stale_claim_age:
+                last_recover = time.time()
+                try:
+                    self._recover_claims()
+                except OSError as e:
+                    logger.error("Failed to recover claims: %s", e)
+            if stop.wait(self.heartbeat_interval):
+                return
+
+    def _unclaim_tree(self, root):
+        """Moves all files below root back to in_path and removes root"""
+        for dirpath, _, files in os.walk(root, topdown=False):
+            relpath = os.path.relpath(dirpath, root)
+            for name in files:
+                if name == ".heartbeat":
+                    continue
+                os.makedirs(os.path.join(self.in_path, relpath), exist_ok=True)
+                os.rename(os.path.join(dirpath, name), os.path.join(self.in_path, relpath, name))
+        shutil.rmtree(root, ignore_errors=True)
+
+    def _heartbeat_age(self, root):
+        """Seconds since the heartbeat of the instance in root and its pid"""
+        try:
+            filename = os.path.join(root, ".heartbeat")
+            age = time.time() - os.stat(filename).st_mtime
+            with open(filename) as file:
+                return age, int(file.read())
+        except (OSError, ValueError):
+            return time.time() - os.stat(root).st_mtime, None
+
+    def _recover_claims(self, startup=False):
+        """Returns files claimed by this instance before a restart and by
+        instances that have stopped updating their heartbeat."""
+        os.makedirs(self.claim_path, exist_ok=True)
+        for name in os.listdir(self.claim_path):
+            root = os.path.join(self.claim_path, name)
+            if name.startswith(".") or not os.path.isdir(root):
+                continue
+            try:
+                age, pid = self._heartbeat_age(root)
+            except OSError:
+                continue
+            if name == self.instance:
+                if not startup:
+                    continue
+                if pid is not None and pid != os.getpid() and age < self.stale_claim_age and pid_alive(pid):
+                    raise Exception("Instance %s is already running with pid %d" % (name, pid))
+            elif age < self.stale_claim_age:
+                continue
+            # Only one instance gets to recover the claims
+            recover = os.path.join(self.claim_path, ".recover.%s.%s" % (name, self.instance))
+            try:
+                os.rename(root, recover)
+            except OSError:
+                continue
+            logger.info("Recovering files claimed by %s", name)
+            self._unclaim_tree(recover)
+
+    def _claim(self, file):
+        """Moves the file to claim_root, False if someone else has it"""
+        if not self.claim_root:
+            return True
+        claim_dir = os.path.join(self.claim_root, file["path"])
+        try:
+            os.makedirs(claim_dir, exist_ok=True)
+            os.rename(os.path.join(self.in_path, file["path"], file["file"]), os.path.join(claim_dir, file["file"]))
+        except FileNotFoundError:
+            logger.debug("Already claimed: %s", os.path.join(file["path"], file["file"]))
+            return False
+        except OSError as e:
+            logger.error("Failed to claim %s: %s", os.path.join(file["path"], file["file"]), e)
+            return False
+        return True
+
+    def _unclaim(self, file):
+        if self.claim_root:
+            os.rename(self.source(file), os.path.join(self.in_path, file["path"], file["file"]))
+
+    def source(self, file):
+        """Current filename of file"""
+        return os.path.join(self.claim_root or self.in_path, file["path"], file["file"])
+
+    @staticmethod
+    def _jobid(file):
+        m = re.match(r"^(\d+)", file["file"])
+        return (0, int(m.group(1)), file["file"]) if m else (1, 0, file["file"])
+
+    def _save_cursor(self, cursor):
+        if not self.cursor_file or cursor == self.cursor:
+            return
+        self.cursor = cursor
+        tfilename = self.cursor_file + ".tmp"
+        with open(tfilename, "w") as file:
+            json.dump(list(cursor), file)
+        os.rename(tfilename, self.cursor_file)
+
+    def _fill(self):
+        """Reads the next lookahead files"""
+        for file in self.walker:
+            self.files.append(file)
+            if len(self.files) >= self.lookahead:
+                break
+        if not self.files:
+            return
+        cursor = self.files[0]["dir"]
+        if self.sort == "mtime":
+            self.files = deque(sorted(self.files, key=lambda f: f["mtime"]))
+        elif self.sort == "jobid":
+            self.files = deque(sorted(self.files, key=self._jobid))
+        # All files before this window are done when its first file is loaded
+        self.files[0]["cursor"] = cursor
+
+    def _next_file(self):
+        cursor = None
+        while True:
+            if not self.files:
+                self._fill()
+                if not self.files:
+                    return None
+            file = self.files.popleft()
+            if "cursor" in file:
+                cursor = file["cursor"]
+            if self.watching:
+                key = (file["path"], file["file"])
+                if key in self.loading or not (self.claim_root or os.path.exists(self.source(file))):
+                    continue
+            if self._claim(file):
+                if self.watching:
+                    self.loading.add(key)
+                if cursor is not None:
+                    file["cursor"] = cursor
+                return file
+
+    def _read_ahead(self):
+        """Keeps read_ahead files being parsed by the worker processes"""
+        while len(self.reading) < self.read_ahead:
+            file = self._next_file()
+            if file is None:
+                break
+            self.reading.append((file, self.pool.submit(parse, self.source(file))))
 
     def next(self):
-        if len(self.files) == 0:
+        if self.pool:
+            self._read_ahead()
+            if not self.reading:
+                file, future = None, None
+            else:
+                file, future = self.reading.popleft()
+        else:
+            file = self._next_file()
+
+        if file is None:
+            # The walk is complete, next walk starts from the beginning
+            self.cursor = ()
+            if self.cursor_file and os.path.exists(self.cursor_file):
+                os.unlink(self.cursor_file)
             return None
-        self.current_file = self.files[0]
-        self.files = self.files[1:]
+
+        self.current_file = file
+        if "cursor" in file and self.cursor_file:
+            if self.commit_queue:
+                self.commit_queue.join()
+            self._save_cursor(file["cursor"])
         logger.debug(self.current_file)
-        filename = os.path.join(self.in_path, self.current_file["path"], self.current_file["file"])
+        filename = self.source(self.current_file)
         try:
-            with open(filename, "r") as file:
-                return json.load(file)
+            if self.pool:
+                return future.result()
+            return parse(filename)
         except Exception as e:
             raise Exception("Failed to load: %s due to %s" % (filename, str(e))) from e
         return None
 
-    def error(self):
-        """move file from in_path -> error_path/"""
-        logger.info(
-            "Error: %s",
-            os.path.join(self.current_file["path"], self.current_file["file"]),
-        )
-
-        out_path = os.path.join(self.error_path, self.current_file["path"])
+    @staticmethod
+    def _move(source, file, out_root):
+        out_path = os.path.join(out_root, file["path"])
         if not os.path.isdir(out_path):
             try:
                 os.makedirs(out_path)
@@ -78,34 +507,65 @@ class Loader(sams.base.Loader):
                 if not os.path.isdir(out_path):
                     assert False, "Failed to makedirs '%s' " % out_path
 
-        # Rename file to error directory
-        shutil.move(
-            os.path.join(self.in_path, self.current_file["path"], self.current_file["file"]),
-            os.path.join(out_path, self.current_file["file"]),
-        )
+        shutil.move(source, os.path.join(out_path, file["file"]))
 
-        self.current_file = None
+    def _mover(self):
+        while True:
+            item = self.commit_queue.get()
+            try:
+                if item is None:
+                    return
+                self._move(*item)
+                self.loading.discard((item[1]["path"], item[1]["file"]))
+            except Exception as e:
+                logger.error("Failed to move %s: %s", os.path.join(item[1]["path"], item[1]["file"]), e)
+            finally:
+                self.commit_queue.task_done()
 
-    def commit(self):
-        """move file from in_path -> archive_path/"""
-        logger.info(
-            "Commit: %s",
-            os.path.join(self.current_file["path"], self.current_file["file"]),
-        )
+    def _done(self, item, out_root):
+        file = item or self.current_file
+        if file is self.current_file:
+            self.current_file = None
+        move = (self.source(file), file, out_root)
+        if self.commit_queue:
+            self.commit_queue.put(move)
+        else:
+            self._move(*move)
+            self.loading.discard((file["path"], file["file"]))
 
-        out_path = os.path.join(self.archive_path, self.current_file["path"])
-        if not os.path.isdir(out_path):
-            try:
-                os.makedirs(out_path)
-            except Exception:
-                # Handle possible raise from other process
-                if not os.path.isdir(out_path):
-                    assert False, "Failed to makedirs '%s' " % out_path
+    def current(self):
+        return self.current_file
 
-        # Rename file to archive directory
-        shutil.move(
-            os.path.join(self.in_path, self.current_file["path"], self.current_file["file"]),
-            os.path.join(out_path, self.current_file["file"]),
-        )
+    def error(self, item=None):
+        """move file from in_path -> error_path/"""
+        file = item or self.current_file
+        logger.info("Error: %s", os.path.join(file["path"], file["file"]))
+        self._done(file, self.error_path)
 
-        self.current_file = None
+    def commit(self, item=None):
+        """move file from in_path -> archive_path/"""
+        file = item or self.current_file
+        logger.info("Commit: %s", os.path.join(file["path"], file["file"]))
+        self._done(file, self.archive_path)
+
+    def close(self):
+        """Waits for the outstanding moves and stops the workers"""
+        if self.commit_queue:
+            self.commit_queue.put(None)
+            self.commit_thread.join()
+            self.commit_queue = None
+        if self.pool:
+            for file, future in self.reading:
+                future.cancel()
+                self._unclaim(file)
+            self.reading = deque()
+            self.pool.shutdown()
+            self.pool = None
+        if self.heartbeat:
+            self.heartbeat.set()
+            self.heartbeat = None
+            # Files left unprocessed are returned to in_path
+            self._unclaim_tree(self.claim_root)
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
@@ -21,30 +21,51 @@ along with this program; If not, see <http://www.gnu.org/licenses/>.
 import json
 import logging
 import os
+import re
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-from tempfile import mkdtemp
 
 from sams.loader.File import Loader as File
 
 logger = logging.getLogger(__name__)
 
+SACCT_FIELDS = ["account", "starttime", "username", "nodes", "cpus", "partition", "uid"]
+
+
+def file_jobid(file):
+    """The jobid from the leading digits of the file name, else None"""
+    m = re.match(r"^(\d+)", file["file"])
+    return int(m.group(1)) if m else None
+
 
 class SacctLoader:
-    def __init__(self, sacct, env):
+    def __init__(self, sacct, env, chunk_size=500, workers=4, cache_file=None, cache_size=100000):
         self.sacct_bin = sacct
         # setup environment for running sacct
         self.env = os.environ.copy()
         for k, v in env.items():
             self.env[k] = v
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.cache_file = cache_file
+        self.cache_size = cache_size
+        self.cache = {}
+        # Jobids sacct did not find
+        self.not_found = set()
+        self.changed = False
+        if self.cache_file and os.path.exists(self.cache_file):
+            with open(self.cache_file) as file:
+                self.cache = {int(jobid): info for jobid, info in json.load(file).items()}
 
-    def run(self, jobid):
+    def query(self, jobids):
+        """Runs one sacct for jobids, returns a dict with the found jobs"""
         process = subprocess.run(
             [
                 self.sacct_bin,
                 "-P",
                 "-j",
-                str(jobid),
+                ",".join(str(jobid) for jobid in jobids),
                 "-X",
                 "-n",
                 "-o",
@@ -55,38 +76,122 @@ class SacctLoader:
             encoding="utf8",
             stdout=subprocess.PIPE,
         )
+        wanted = set(jobids)
+        found = {}
         for line in process.stdout.splitlines():
-            (
-                jobidraw,
-                account,
-                starttime,
-                username,
-                nodes,
-                cpus,
-                partition,
-                uid,
-            ) = line.strip().split("|")
-            if int(jobidraw) == jobid:
-                return dict(
-                    account=account,
-                    starttime=starttime,
-                    username=username,
-                    nodes=nodes,
-                    cpus=cpus,
-                    partition=partition,
-                    uid=uid,
-                )
+            jobidraw, *values = line.strip().split("|")
+            if jobidraw.isdigit() and int(jobidraw) in wanted:
+                found[int(jobidraw)] = dict(zip(SACCT_FIELDS, values))
+        return found
+
+    def _add(self, found):
+        self.cache.update(found)
+        self.changed = self.changed or bool(found)
+        while len(self.cache) > self.cache_size:
+            del self.cache[next(iter(self.cache))]
+
+    def cached(self, jobid):
+        return jobid in self.cache or jobid in self.not_found
+
+    def _try_query(self, jobids):
+        """query() that returns None if sacct fails"""
+        try:
+            return self.query(jobids)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error("Failed to fetch %d jobs from sacct: %s", len(jobids), e)
+            return None
+
+    def prefetch(self, jobids):
+        """Resolves the jobids not in the cache in chunk_size jobids for
+        each sacct, running workers sacct at the same time."""
+        missing = sorted(set(jobid for jobid in jobids if not self.cached(jobid)))
+        if not missing:
+            return
+        chunks = [missing[i : i + self.chunk_size] for i in range(0, len(missing), self.chunk_size)]
+        logger.debug("Fetching %d jobs from sacct in %d chunks", len(missing), len(chunks))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for chunk, found in zip(chunks, executor.map(self._try_query, chunks)):
+                # Only the jobids of the chunks sacct answered are known to be missing
+                if found is None:
+                    continue
+                self._add(found)
+                self._not_found(jobid for jobid in chunk if jobid not in found)
+        self.save()
+
+    def _not_found(self, jobids):
+        if len(self.not_found) > self.cache_size:
+            self.not_found.clear()
+        self.not_found.update(jobids)
+
+    def run(self, jobid):
+        if not self.cached(jobid):
+            self._add(self.query([jobid]))
+            self._not_found(jobid for jobid in [jobid] if jobid not in self.cache)
+        if jobid in self.cache:
+            return dict(self.cache[jobid])
         raise Exception(f"jobid {jobid} not found in sacct output")
 
+    def save(self):
+        """Writes the cache to cache_file"""
+        if not self.cache_file or not self.changed:
+            return
+        tfilename = self.cache_file + ".tmp"
+        with open(tfilename, "w") as file:
+            json.dump(self.cache, file)
+        os.rename(tfilename, self.cache_file)
+        self.changed = False
+
 
 class Loader(File):
     def __init__(self, id, config):
         super(Loader, self).__init__(id, config)
         sacct_bin = self.config.get([self.id, "sacct"], "/usr/bin/sacct")
         sacct_env = self.config.get([self.id, "environment"], {})
-        self.sacct = SacctLoader(sacct_bin, sacct_env)
+        self.sacct = SacctLoader(
+            sacct_bin,
+            sacct_env,
+            chunk_size=int(self.config.get([self.id, "sacct_chunk_size"], 500)),
+            workers=int(self.config.get([self.id, "sacct_workers"], 4)),
+            cache_file=self.config.get([self.id, "sacct_cache"]),
+        )
+        self.sacct_prefetch = int(self.config.get([self.id, "sacct_prefetch"], 1000))
+        self.sacct_prefetch_files = self.config.get([self.id, "sacct_prefetch_files"], True)
         self.updated_data = None
 
+    @staticmethod
+    def _missing_slurminfo(future):
+        """Jobid of a record read ahead without SlurmInfo, else None"""
+        if future.exception() is not None:
+            return None
+        data = future.result()
+        if "sams.sampler.SlurmInfo" in data:
+            return None
+        try:
+            return int(data["sams.sampler.Core"]["jobid"])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _prefetch(self, jobid):
+        """Resolves the jobid together with the jobids of the records read
+        ahead without SlurmInfo. With sacct_prefetch_files the jobids of
+        the file names not parsed yet are also resolved."""
+        jobids = [jobid]
+        for file, future in self.reading:
+            if len(jobids) >= self.sacct_prefetch:
+                break
+            if self.sacct_prefetch_files and not future.done():
+                jobids.append(file_jobid(file))
+                continue
+            missing = self._missing_slurminfo(future)
+            if missing is not None:
+                jobids.append(missing)
+        if self.sacct_prefetch_files:
+            for file in self.files:
+                if len(jobids) >= self.sacct_prefetch:
+                    break
+                jobids.append(file_jobid(file))
+        self.sacct.prefetch([jobid for jobid in jobids if jobid is not None])
+
     def next(self):
         self.updated_data = None
         data = super(Loader, self).next()
@@ -94,25 +199,28 @@ class Loader(File):
             return None
         if "sams.sampler.SlurmInfo" not in data:
             jobid = int(data["sams.sampler.Core"]["jobid"])
+            if not self.sacct.cached(jobid):
+                self._prefetch(jobid)
             data["sams.sampler.SlurmInfo"] = self.sacct.run(jobid)
             self.updated_data = deepcopy(data)
+            # Kept with the file as it may be committed after the next file is read
+            self.current_file["updated_data"] = self.updated_data
         return data
 
-    def commit(self):
-        if self.updated_data:
-            # Write new json file, including the SlurmInfo
-            in_file = self.current_file
-            temp_dir = mkdtemp()
-            with open(os.path.join(temp_dir, self.current_file["file"]), mode="w") as new_file:
-                new_file.write(json.dumps(self.updated_data))
-            in_path_save = self.in_path
-            self.in_path = temp_dir
-            self.current_file["path"] = ""
-        # Call the regular commit() function, to move new json file to archive directory
-        super().commit()
-        if self.updated_data:
-            # Cleanup temp dir and original input file
-            self.in_path = in_path_save
-            os.remove(os.path.join(self.in_path, in_file["path"], in_file["file"]))
-            if os.path.exists(temp_dir):
-                os.rmdir(temp_dir)
+    def commit(self, item=None):
+        in_file = item or self.current_file
+        updated_data = in_file.pop("updated_data", None)
+        if updated_data:
+            # Replace the file with one including the SlurmInfo before it is archived
+            filename = self.source(in_file)
+            tfilename = os.path.join(os.path.dirname(filename), ".%s" % in_file["file"])
+            with open(tfilename, mode="w") as new_file:
+                new_file.write(json.dumps(updated_data))
+                new_file.flush()
+                os.fsync(new_file.fileno())
+            os.rename(tfilename, filename)
+        super().commit(in_file)
+
+    def close(self):
+        super().close()
+        self.sacct.save()
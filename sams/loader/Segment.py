@@ -0,0 +1,239 @@
+"""
+Segment Loader
+
+Loads records from the NDJSON segment files written by sams-post-receiver
+with storage: segments.
+
+SAMS Software accounting
+Copyright (C) 2018-2021  Swedish National Infrastructure for Computing (SNIC)
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; If not, see <http://www.gnu.org/licenses/>.
+
+Config Options:
+
+sams.loader.Segment:
+    # Where the closed segments are.
+    in_path: /data/softwareaccounting/segments
+
+    # Segments that are done are moved here.
+    archive_path: /data/softwareaccounting/archive
+
+    # Records that failed are appended to <error_path>/<segment>.ndjson
+    error_path: /data/softwareaccounting/error
+
+    # The records done in the segments being loaded.
+    # Default: <in_path>/.sams.loader.Segment.state
+    state_file: /data/softwareaccounting/segments/.sams.loader.Segment.state
+
+    # Save the state after this many records, and after each record that
+    # failed. Committed records after the last saved state are loaded
+    # again after a crash, failed records are not.
+    state_interval: 100
+"""
+
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+import sams.base
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_RE = re.compile(r"^[^.].*\.ndjson$")
+
+
+def read_index(segment):
+    """Returns the (offset, length) of each record of the segment, from its
+    .idx index. Lines after the last record of the index are also found."""
+    records = []
+    end = 0
+    size = os.path.getsize(segment)
+    try:
+        with open(segment[:-7] + ".idx", "rb") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                    offset, length = int(entry["offset"]), int(entry["length"])
+                except (ValueError, KeyError, TypeError):
+                    break
+                if offset != end or offset + length > size:
+                    break
+                records.append((offset, length))
+                end = offset + length
+    except FileNotFoundError:
+        pass
+    if end < size:
+        with open(segment, "rb") as file:
+            file.seek(end)
+            for line in file:
+                records.append((end, len(line)))
+                end += len(line)
+    return records
+
+
+class Loader(sams.base.Loader):
+    def __init__(self, id, config):
+        super(Loader, self).__init__(id, config)
+        self.in_path = self.config.get([self.id, "in_path"])
+        self.archive_path = self.config.get([self.id, "archive_path"])
+        self.error_path = self.config.get([self.id, "error_path"])
+        self.state_file = self.config.get([self.id, "state_file"], os.path.join(self.in_path, ".%s.state" % self.id))
+        self.state_interval = int(self.config.get([self.id, "state_interval"], 100))
+        self.segments = []
+        self.segment = None
+        self.file = None
+        self.records = []
+        self.position = 0
+        self.current_record = None
+        self.uncommitted = 0
+        # For each segment being loaded, the number of the first record
+        # not done and the numbers of the records done after it
+        self.state = {}
+        self.done = {}
+        # Number of records of the segments being loaded
+        self.count = {}
+
+    def load(self):
+        """Find closed segments in in_path, oldest first"""
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as file:
+                state = json.load(file)
+            self.state = {name: segment["next"] for name, segment in state.items()}
+            self.done = {name: set(segment["done"]) for name, segment in state.items()}
+        self.segments = sorted(name for name in os.listdir(self.in_path) if SEGMENT_RE.match(name))
+        self.segments.reverse()
+        logger.debug("Found %d segments", len(self.segments))
+
+    def _save_state(self):
+        tfilename = self.state_file + ".tmp"
+        with open(tfilename, "w") as file:
+            json.dump({name: {"next": n, "done": sorted(self.done.get(name, ()))} for name, n in self.state.items()}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(tfilename, self.state_file)
+        self.uncommitted = 0
+
+    def _archive(self, name):
+        """Segment is done, move it and its index to archive_path"""
+        logger.info("Done with segment: %s", name)
+        os.makedirs(self.archive_path, exist_ok=True)
+        for filename in [name, name[:-7] + ".idx"]:
+            if os.path.exists(os.path.join(self.in_path, filename)):
+                shutil.move(os.path.join(self.in_path, filename), os.path.join(self.archive_path, filename))
+        self.state.pop(name, None)
+        self.done.pop(name, None)
+        self.count.pop(name, None)
+        self._save_state()
+
+    def _next_line(self):
+        """Returns the next record of the segments and its number, None
+        when all are read. Records done before a restart are skipped."""
+        while True:
+            if self.file is None:
+                if not self.segments:
+                    return None
+                self.segment = self.segments.pop()
+                filename = os.path.join(self.in_path, self.segment)
+                self.records = read_index(filename)
+                self.count[self.segment] = len(self.records)
+                self.state.setdefault(self.segment, 0)
+                self.done.setdefault(self.segment, set())
+                self.position = self.state[self.segment]
+                self.file = open(filename, "rb")
+                logger.debug("Loading segment %s from record %d", self.segment, self.position)
+            while self.position < len(self.records) and (
+                self.position < self.state[self.segment] or self.position in self.done[self.segment]
+            ):
+                self.position += 1
+            if self.position < len(self.records):
+                offset, length = self.records[self.position]
+                self.file.seek(offset)
+                self.position += 1
+                return self.position - 1, self.file.read(length)
+            self.file.close()
+            self.file = None
+            self._check_archive(self.segment)
+
+    def _check_archive(self, segment):
+        if segment != self.segment or self.file is None:
+            if self.state.get(segment) == self.count.get(segment):
+                self._archive(segment)
+
+    def next(self):
+        self.current_record = None
+        record = self._next_line()
+        if record is None:
+            if self.uncommitted:
+                self._save_state()
+            return None
+        n, line = record
+        self.current_record = (self.segment, n, line)
+        try:
+            return json.loads(line)["data"]
+        except Exception as e:
+            raise Exception("Failed to load record %d in %s due to %s" % (n, self.segment, str(e))) from e
+
+    def current(self):
+        return self.current_record
+
+    def _done(self, item):
+        """The state is moved past all records that are done"""
+        segment, n, _ = item
+        if item is self.current_record:
+            self.current_record = None
+        done = self.done[segment]
+        done.add(n)
+        while self.state[segment] in done:
+            done.remove(self.state[segment])
+            self.state[segment] += 1
+        self.uncommitted += 1
+        if self.uncommitted >= self.state_interval:
+            self._save_state()
+        self._check_archive(segment)
+
+    def error(self, item=None):
+        """append record to error_path/<segment>"""
+        item = item or self.current_record
+        segment, n, line = item
+        logger.info("Error: record %d in %s", n, segment)
+        os.makedirs(self.error_path, exist_ok=True)
+        with open(os.path.join(self.error_path, segment), "ab") as file:
+            file.write(line if line.endswith(b"\n") else line + b"\n")
+        self._done(item)
+        # A failed record is never loaded, nor appended, again
+        if self.uncommitted:
+            self._save_state()
+
+    def commit(self, item=None):
+        """mark record as committed"""
+        item = item or self.current_record
+        segment, n, _ = item
+        logger.debug("Commit: record %d in %s", n, segment)
+        self._done(item)
+
+    def wait(self, timeout):
+        """Sleeps and looks for segments closed since they were listed"""
+        if self.uncommitted:
+            self._save_state()
+        time.sleep(timeout)
+        known = set(self.count) | set(self.segments)
+        new = sorted(name for name in os.listdir(self.in_path) if SEGMENT_RE.match(name) and name not in known)
+        self.segments = list(reversed(new)) + self.segments
+
+    def close(self):
+        if self.uncommitted:
+            self._save_state()
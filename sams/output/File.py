@@ -33,13 +33,24 @@ sams.output.File:
 
   # Skip the list of modules.
   exclude: ['sams.sampler.ModuleName']
+
+  # Compress the output files (none, gzip or zstd).
+  # gzip adds .gz and zstd adds .zst to the file name.
+  # zstd requires the zstandard python module.
+  compression: none
+
+  # Write a snapshot of the final data every checkpoint_interval seconds
+  # to the file name with a .checkpoint suffix. 0 disables checkpoints.
+  checkpoint_interval: 0
 """
 
 import json
 import logging
 import os
+import time
 
 import sams.base
+import sams.core
 
 logger = logging.getLogger(__name__)
 
@@ -50,7 +61,14 @@ class Output(sams.base.Output):
     def __init__(self, id, config):
         super(Output, self).__init__(id, config)
         self.exclude = dict((e, True) for e in self.config.get([self.id, "exclude"], []))
+        self.compression = self.config.get([self.id, "compression"], "none")
+        self.checkpoint_interval = int(self.config.get([self.id, "checkpoint_interval"], 0))
+        if self.compression not in sams.core.COMPRESSION_SUFFIX:
+            raise Exception("compression must be one of: %s" % ", ".join(sams.core.COMPRESSION_SUFFIX))
         self.data = {}
+        self.checkpoint_data = {}
+        self.last_checkpoint = time.time()
+        self.base_path = None
 
     def store(self, data):
         for k, v in data.items():
@@ -58,15 +76,37 @@ class Output(sams.base.Output):
                 continue
             self.data[k] = v
 
-    def write(self):
-        base_path = self.config.get([self.id, "base_path"], "/tmp")
+    def checkpoint(self, data):
+        if self.checkpoint_interval <= 0:
+            return
+        for k, v in data.items():
+            if k in self.exclude:
+                continue
+            self.checkpoint_data[k] = v
+
+        if time.time() - self.last_checkpoint < self.checkpoint_interval:
+            return
+        self.last_checkpoint = time.time()
+
+        snapshot = dict(self.data)
+        snapshot.update(self.checkpoint_data)
+        logger.debug("Checkpoint %s", self.filename() + ".checkpoint")
+        self._write(self.filename() + ".checkpoint", snapshot)
+
+    def filename(self):
         file_pattern = self.config.get([self.id, "file_pattern"], "%(jobid)s.%(node)s.json")
         jobid = self.config.get(["options", "jobid"], 0)
         node = self.config.get(["options", "node"], 0)
-        jobid_hash_size = self.config.get([self.id, "jobid_hash_size"])
+        return file_pattern % {"jobid": jobid, "node": node} + sams.core.COMPRESSION_SUFFIX[self.compression]
 
-        filename = file_pattern % {"jobid": jobid, "node": node}
-        tfilename = ".%s" % filename
+    def path(self):
+        """Directory to write into, created on first use"""
+        if self.base_path is not None:
+            return self.base_path
+
+        base_path = self.config.get([self.id, "base_path"], "/tmp")
+        jobid = self.config.get(["options", "jobid"], 0)
+        jobid_hash_size = self.config.get([self.id, "jobid_hash_size"])
 
         if jobid_hash_size is not None:
             base_path = os.path.join(base_path, str(int(jobid / jobid_hash_size)))
@@ -79,9 +119,19 @@ class Output(sams.base.Output):
                     if not os.path.isdir(base_path):
                         assert False, "Failed to makedirs '%s' " % base_path
 
+        self.base_path = base_path
+        return base_path
+
+    def _write(self, filename, data):
+        """Atomically replace filename with data"""
+        base_path = self.path()
+        tfilename = ".%s" % filename
+        body = sams.core.compress(json.dumps(data, sort_keys=True, separators=(",", ":")).encode("utf-8"), self.compression)
         try:
-            with open(os.path.join(base_path, tfilename), "w") as file:
-                file.write(json.dumps(self.data, sort_keys=True, separators=(",", ":")))
+            with open(os.path.join(base_path, tfilename), "wb") as file:
+                file.write(body)
+                file.flush()
+                os.fsync(file.fileno())
             os.rename(os.path.join(base_path, tfilename), os.path.join(base_path, filename))
         except Exception:
             logger.debug("Failed to write file")
@@ -89,3 +139,11 @@ class Output(sams.base.Output):
                 os.unlink(os.path.join(base_path, tfilename))
             except Exception:
                 logger.error("Failed to unlink tmp file")
+
+    def write(self):
+        filename = self.filename()
+        self._write(filename, self.data)
+
+        checkpoint = os.path.join(self.path(), filename + ".checkpoint")
+        if os.path.exists(checkpoint):
+            os.unlink(checkpoint)
@@ -39,10 +39,29 @@ sams.output.Http:
 
   # Skip the list of modules.
   exclude: ['sams.sampler.ModuleName']
+
+  # Delay the upload with a per job delay between 0 and jitter_window
+  # seconds. The delay is derived from jobid and node so a job always
+  # gets the same delay. Spreads the uploads when many jobs end at once.
+  jitter_window: 0
+
+  # Number of times to retry when the receiver answers 429 or 503, or
+  # can't be reached, and the longest Retry-After (in seconds) to honour.
+  # Without Retry-After the upload is retried after 30 seconds.
+  retry_after_count: 10
+  retry_after_max: 600
+
+  # Give up when the upload has not succeeded within retry_total seconds,
+  # keeps the job epilogue from waiting on a receiver that is down.
+  # 0 retries without a time limit.
+  retry_total: 120
 """
 
+import email.utils
 import json
 import logging
+import time
+import zlib
 
 import requests
 
@@ -50,6 +69,64 @@ import sams.base
 
 logger = logging.getLogger(__name__)
 
+RETRY_STATUS = (429, 503)
+# Seconds to wait before a retry when the receiver gives no Retry-After
+RETRY_DELAY = 30
+
+
+def upload_delay(key, window):
+    """Deterministic delay in seconds between 0 and window for key"""
+    window = int(float(window or 0) * 1000)
+    if window <= 0:
+        return 0.0
+    return (zlib.crc32(key.encode("utf-8")) % window) / 1000.0
+
+
+def retry_after(response, default=RETRY_DELAY):
+    """Seconds to wait according to the Retry-After header of response"""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max(0, when.timestamp() - time.time())
+    except Exception:
+        return default
+
+
+def post(uri, body, headers, retry_count=10, retry_max=600, retry_total=0, **requests_kwargs):
+    """POST body to uri, waiting and retrying while the receiver is busy
+    or can't be reached, for at most retry_total seconds if set"""
+    deadline = time.time() + retry_total if retry_total else None
+    for n in range(retry_count + 1):
+        if deadline is not None and "timeout" not in requests_kwargs:
+            timeout = max(1, deadline - time.time())
+        else:
+            timeout = requests_kwargs.get("timeout")
+        kwargs = dict(requests_kwargs, timeout=timeout)
+        try:
+            response = requests.post(uri, data=body, headers=headers, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            delay = min(RETRY_DELAY, retry_max)
+            if n == retry_count or (deadline is not None and time.time() + delay > deadline):
+                raise
+            logger.info("Receiver not reachable (%s), retry in %.1f seconds", e, delay)
+            time.sleep(delay)
+            continue
+        if response.status_code not in RETRY_STATUS or n == retry_count:
+            break
+        delay = min(retry_after(response), retry_max)
+        if deadline is not None and time.time() + delay > deadline:
+            logger.info("Receiver busy (%d), giving up after %d seconds", response.status_code, retry_total)
+            break
+        logger.info("Receiver busy (%d), retry in %.1f seconds", response.status_code, delay)
+        time.sleep(delay)
+    return response
+
 
 class Output(sams.base.Output):
     """http/https output Class"""
@@ -75,6 +152,10 @@ class Output(sams.base.Output):
         key_file = self.config.get([self.id, "key_file"])
         username = self.config.get([self.id, "username"])
         password = self.config.get([self.id, "password"])
+        jitter_window = self.config.get([self.id, "jitter_window"], 0)
+        retry_after_count = int(self.config.get([self.id, "retry_after_count"], 10))
+        retry_after_max = int(self.config.get([self.id, "retry_after_max"], 600))
+        retry_total = float(self.config.get([self.id, "retry_total"], 120))
 
         jobid_hash = int(jobid / jobid_hash_size)
         uri = in_uri % {"jobid": jobid, "node": node, "jobid_hash": jobid_hash}
@@ -94,8 +175,13 @@ class Output(sams.base.Output):
         headers = {"Content-Type": "application/json"}
         body = json.dumps(self.data, sort_keys=True, separators=(",", ":"))
 
+        delay = upload_delay("%s.%s" % (jobid, node), jitter_window)
+        if delay:
+            logger.debug("Delay upload with %.1f seconds", delay)
+            time.sleep(delay)
+
         logger.debug("Sending data to: %s", uri)
-        response = requests.post(uri, data=body, headers=headers, **requests_kwargs)
+        response = post(uri, body, headers, retry_after_count, retry_after_max, retry_total, **requests_kwargs)
 
         if response.status_code == 200:
             return True
@@ -23,6 +23,10 @@ sams.sampler.Core:
     # in seconds
     sampler_interval: 100
 
+    # Send a checkpoint of the final data to the outputs every
+    # checkpoint_interval seconds. 0 disables checkpoints.
+    checkpoint_interval: 0
+
 Output:
 {
     jobid: 0,
@@ -59,3 +63,6 @@ class Sampler(sams.base.Sampler):
 
     def final_data(self):
         return self.core
+
+    def checkpoint_data(self):
+        return self.final_data()
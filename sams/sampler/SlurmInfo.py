@@ -132,3 +132,6 @@ class Sampler(sams.base.Sampler):
 
     def final_data(self):
         return self.data
+
+    def checkpoint_data(self):
+        return self.final_data()
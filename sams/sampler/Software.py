@@ -25,6 +25,10 @@ sams.sampler.Software:
     # in seconds
     sampler_interval: 100
 
+    # Send a checkpoint of the final data to the outputs every
+    # checkpoint_interval seconds. 0 disables checkpoints.
+    checkpoint_interval: 0
+
     # Map current running execs into softwares for live reporting
     # software_mapper: sams.software.Regexp
 
@@ -281,6 +285,9 @@ class Sampler(sams.base.Sampler):
 
     def final_data(self):
         logger.debug("%s final_data", self.id)
+        return self.checkpoint_data()
+
+    def checkpoint_data(self):
         aggr, _ = self._aggregate()
         return {
             "execs": aggr,
@@ -30,14 +30,16 @@ sams.xmlwriter.File:
     # Jobs / File
     jobs_per_file: 1000
 
+    # Indent the XML
+    indent: false
+
 """
 
 import logging
 import os
 import time
-from xml.dom import minidom
 from xml.etree import ElementTree
-from xml.etree.ElementTree import Element
+from xml.etree.ElementTree import Element, SubElement
 
 import sams.base
 
@@ -46,6 +48,60 @@ logger = logging.getLogger(__name__)
 SA_NAMESPACE = "http://sams.snic.se/namespaces/2019/01/softwareaccountingrecords"
 ISO_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
+# The records are written one at the time inside a root element declaring
+# the sa prefix, so the elements are named with the prefix.
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<sa:SoftwareAccountingRecords xmlns:sa="%s">' % SA_NAMESPACE
+XML_FOOTER = "</sa:SoftwareAccountingRecords>\n"
+
+
+def indent(elem, level=1, space="  "):
+    """Indents elem in place as if it is at level below the root"""
+    if len(elem):
+        elem.text = "\n" + space * (level + 1)
+        for child in elem:
+            indent(child, level + 1, space)
+            child.tail = "\n" + space * (level + 1)
+        child.tail = "\n" + space * level
+    return elem
+
+
+class RecordFile:
+    """One output file, written to a hidden file that is renamed when closed"""
+
+    def __init__(self, filename, pretty):
+        self.filename = filename
+        self.tfilename = os.path.join(os.path.dirname(filename), "." + os.path.basename(filename))
+        self.pretty = pretty
+        self.records = 0
+        self.file = open(self.tfilename, "wb")
+        self.file.write(XML_HEADER.encode("utf-8"))
+
+    def write(self, record):
+        if self.pretty:
+            self.file.write(b"\n  ")
+            indent(record)
+        self.file.write(ElementTree.tostring(record, encoding="utf-8").split(b"?>", 1)[-1].lstrip())
+        self.records += 1
+
+    def close(self):
+        """Makes the file durable"""
+        if self.pretty:
+            self.file.write(b"\n")
+        self.file.write(XML_FOOTER.encode("utf-8"))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.rename(self.tfilename, self.filename)
+        dirfd = os.open(os.path.dirname(self.filename) or ".", os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+    def abort(self):
+        self.file.close()
+        os.unlink(self.tfilename)
+
 
 class XMLWriter(sams.base.XMLWriter):
     """SAMS Software accounting xml output"""
@@ -55,92 +111,103 @@ class XMLWriter(sams.base.XMLWriter):
         self.create_time = time.time()
         self.remove_less_then = self.config.get([self.id, "remove_less_then"], 1.0)
         self.jobs_per_file = self.config.get([self.id, "jobs_per_file"], 1000)
-
-    @classmethod
-    def prettify(cls, elem):
-        """Return a pretty-printed XML string for the Element."""
-        rough_string = ElementTree.tostring(elem, "utf-8")
-        reparsed = minidom.parseString(rough_string)
-        return reparsed.toprettyxml(indent="  ", encoding="UTF-8")
-
-    def write(self, data):
-        """Data write method"""
-
-        data = list(data)
-
-        # If no data awailable don't do anything
-        if len(data) == 0:
-            return
-
-        # Create output
-        output_path = self.config.get([self.id, "output_path"], "/var/spool/softwareaccounting/records")
-        n = 0
-        while data:
-            output_file = os.path.join(output_path, "%s.%d.xml") % (
-                str(self.create_time),
-                n,
-            )
+        self.output_path = self.config.get([self.id, "output_path"], "/var/spool/softwareaccounting/records")
+        self.pretty = self.config.get([self.id, "indent"], False)
+
+    def filename(self, n):
+        return os.path.join(self.output_path, "%s.%d.xml") % (str(self.create_time), n)
+
+    def write(self, data, commit=None):
+        """Writes the jobs in data, jobs_per_file jobs in each file.
+        commit is called each time a file is closed and all jobs taken
+        from data so far are written."""
+        self._write(data, self.filename, commit)
+
+    def write_part(self, data, part):
+        """Writes the jobs in data to hidden files of part, publish()
+        gives them their final names."""
+        files = []
+
+        def filename(n):
+            files.append(os.path.join(self.output_path, ".%s.part%d.%d.xml" % (str(self.create_time), part, n)))
+            return files[-1]
+
+        try:
+            self._write(data, filename)
+        except Exception:
+            self.discard(files)
+            raise
+        return files
+
+    def publish(self, files, n=0):
+        """Renames the files written by write_part() to <create_time>.<n>.xml
+        starting with n, returns the next n"""
+        for filename in files:
+            os.rename(filename, self.filename(n))
             n = n + 1
-
-            # Create files with 'self.jobs_per_file' jobs
-            (output, data) = (data[: self.jobs_per_file], data[self.jobs_per_file :])
-
-            # Write file
-            with open(output_file, "wb") as f:
-                f.write(self.generate_xml(output))
-
-    def generate_xml(self, data):
-        """Generate XML output for SAMS"""
-        ElementTree.register_namespace("sa", SA_NAMESPACE)
-        sa_records = Element("{%s}SoftwareAccountingRecords" % SA_NAMESPACE)
-
-        for j in data:
-            if j.total_cpu() == 0.0:
-                continue
-            sa_records.append(self.generate_job(j))
-
-        return self.prettify(sa_records)
+        dirfd = os.open(self.output_path, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+        return n
+
+    def discard(self, files):
+        for filename in files:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def _write(self, data, filename, commit=None):
+        n = 0
+        output = None
+        try:
+            for job in data:
+                if job.total_cpu() == 0.0:
+                    continue
+                if output is None:
+                    output = RecordFile(filename(n), self.pretty)
+                    n = n + 1
+                output.write(self.generate_job(job))
+                if output.records >= self.jobs_per_file:
+                    output.close()
+                    output = None
+                    if commit:
+                        commit()
+            if output is not None:
+                output.close()
+                output = None
+                if commit:
+                    commit()
+        finally:
+            if output is not None:
+                output.abort()
 
     def generate_job(self, job):
         """Generate XML output for each job"""
-        r = Element("{%s}SoftwareAccountingRecord" % SA_NAMESPACE)
+        r = Element("sa:SoftwareAccountingRecord")
 
         # RecordIdentity
-        ri = Element("{%s}RecordIdentity" % SA_NAMESPACE)
-        ri.set("{%s}createTime" % SA_NAMESPACE, self.gm2isoTime(self.create_time))
-        ri.set("{%s}recordId" % SA_NAMESPACE, job.recordid())
-        r.append(ri)
+        ri = SubElement(r, "sa:RecordIdentity")
+        ri.set("sa:createTime", self.gm2isoTime(self.create_time))
+        ri.set("sa:recordId", job.recordid())
 
         # JobRecordID
-        jri = Element("{%s}JobRecordID" % SA_NAMESPACE)
-        jri.text = job.recordid()
-        r.append(jri)
+        SubElement(r, "sa:JobRecordID").text = job.recordid()
 
         # Software
+        total_cpu = job.total_cpu(self.remove_less_then)
         for sw in job.softwares(self.remove_less_then):
-            s = Element("{%s}Software" % SA_NAMESPACE)
+            s = SubElement(r, "sa:Software")
             # Software Name
-            name = Element("{%s}Name" % SA_NAMESPACE)
-            name.text = sw.software
-            s.append(name)
+            SubElement(s, "sa:Name").text = sw.software
             # Version
-            version = Element("{%s}Version" % SA_NAMESPACE)
-            version.text = sw.version
-            s.append(version)
+            SubElement(s, "sa:Version").text = sw.version
             # Local version
-            local_version = Element("{%s}LocalVersion" % SA_NAMESPACE)
-            local_version.text = sw.versionstr
-            s.append(local_version)
+            SubElement(s, "sa:LocalVersion").text = sw.versionstr
             # User Provided
-            user_provided = Element("{%s}UserProvided" % SA_NAMESPACE)
-            user_provided.text = {0: "false", 1: "true"}[sw.user_provided]
-            s.append(user_provided)
+            SubElement(s, "sa:UserProvided").text = {0: "false", 1: "true"}[sw.user_provided]
             # Usage in %
-            usage = Element("{%s}Usage" % SA_NAMESPACE)
-            usage.text = "%.2f" % (100 * sw.cpu / job.total_cpu(self.remove_less_then))
-            s.append(usage)
-
-            r.append(s)
+            SubElement(s, "sa:Usage").text = "%.2f" % (100 * sw.cpu / total_cpu)
 
         return r
 
@@ -21,7 +21,10 @@ along with this program; If not, see <http://www.gnu.org/licenses/>.
 """
 
 import logging
+import signal
 import sys
+import threading
+import time
 from optparse import OptionParser
 
 import sams.core
@@ -36,6 +39,7 @@ class Main:
     def __init__(self):
         self.loaders = []
         self.aggregators = []
+        self.exit = None
 
         # Options
         parser = OptionParser()
@@ -62,6 +66,13 @@ class Main:
             dest="loglevel",
             help="Loglevel",
         )
+        parser.add_option(
+            "--watch",
+            action="store_true",
+            dest="watch",
+            default=False,
+            help="Keep running and load new records as they arrive",
+        )
 
         (self.options, self.args) = parser.parse_args()
 
@@ -113,36 +124,117 @@ class Main:
                 sys.exit(1)
 
         logger.debug("Start loading %s", self.loaders)
-        for loader_config in self.loaders:
-            loader_config.load()
-            while True:
-                try:
-                    data = loader_config.next()
-                    if not data:
-                        break
-                except Exception as e:
-                    logger.error(e)
-                    loader_config.error()
-                    continue
-
-                try:
-                    logger.debug("Data: %s", data)
-                    for a in self.aggregators:
-                        a.aggregate(data)
-                    loader_config.commit()
-                except Exception as e:
-                    logger.error("Failed to do aggregation")
-                    logger.exception(e)
-
-                    # Cleanup of the aggregators.
-                    for a in self.aggregators:
-                        a.cleanup()
-                    loader_config.error()
+        if self.options.watch or self.config.get([id, "watch"], False):
+            self.watch()
+        else:
+            for loader in self.loaders:
+                loader.load()
+                # Records aggregated but not yet stored durably by all aggregators
+                pending = []
+                # Index in pending of each record given to an aggregator since its last flush
+                calls = {a: [] for a in self.aggregators}
+                self.run(loader, pending, calls)
+                self.flush(loader, pending, calls)
+                loader.close()
 
         # Close down the aggregagors.
         for a in self.aggregators:
             a.close()
 
+    def watch(self):
+        """Keeps loading new records until SIGTERM or SIGINT"""
+        self.exit = threading.Event()
+        signal.signal(signal.SIGINT, self.sigHandler)
+        signal.signal(signal.SIGTERM, self.sigHandler)
+        poll_interval = float(self.config.get([id, "poll_interval"], 1))
+        rollup_interval = float(self.config.get([id, "rollup_interval"], 60))
+
+        states = []
+        for loader in self.loaders:
+            loader.load()
+            states.append((loader, [], {a: [] for a in self.aggregators}))
+        last_rollup = time.time()
+        while not self.exit.is_set():
+            for loader, pending, calls in states:
+                self.run(loader, pending, calls)
+                self.flush(loader, pending, calls)
+            if time.time() - last_rollup >= rollup_interval:
+                for a in self.aggregators:
+                    a.rollup()
+                last_rollup = time.time()
+            if self.exit.is_set():
+                break
+            for n, (loader, _, _) in enumerate(states):
+                # Only the first loader waits, the others look for new records
+                loader.wait(poll_interval if n == 0 else 0)
+        for loader, pending, calls in states:
+            self.flush(loader, pending, calls)
+            loader.close()
+
+    def sigHandler(self, signum, frame):
+        logger.info("Got signal %d, stopping", signum)
+        self.exit.set()
+
+    def run(self, loader, pending, calls):
+        """Aggregates the records of loader until it has no more"""
+        while not (self.exit and self.exit.is_set()):
+            try:
+                data = loader.next()
+                if not data:
+                    break
+            except Exception as e:
+                logger.error(e)
+                loader.error()
+                continue
+
+            pending.append(loader.current())
+            try:
+                logger.debug("Data: %s", data)
+                for a in self.aggregators:
+                    a.aggregate(data)
+                    # Position of the record in the batch of a, only
+                    # records accepted by aggregate() are in the batch
+                    calls[a].append(len(pending) - 1)
+            except Exception as e:
+                logger.error("Failed to do aggregation")
+                logger.exception(e)
+
+                # Cleanup of the aggregators.
+                for a in self.aggregators:
+                    a.cleanup()
+                loader.error(pending[-1])
+                pending[-1] = None
+                continue
+
+            if not any(a.pending() for a in self.aggregators):
+                self.flush(loader, pending, calls)
+            elif any(a.should_flush() for a in self.aggregators):
+                self.flush(loader, pending, calls)
+
+    def flush(self, loader, pending, calls):
+        """Commit the pending records once all aggregators have stored them"""
+        failed = set()
+        try:
+            for a in self.aggregators:
+                for position in a.flush() or []:
+                    failed.add(calls[a][position])
+        except Exception as e:
+            logger.error("Failed to flush aggregators")
+            logger.exception(e)
+            for a in self.aggregators:
+                a.cleanup()
+            failed = set(range(len(pending)))
+        for n, item in enumerate(pending):
+            if item is None:
+                continue
+            if n in failed:
+                loader.error(item)
+            else:
+                loader.commit(item)
+        pending.clear()
+        for positions in calls.values():
+            positions.clear()
+
 
 if __name__ == "__main__":
     Main().start()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+"""
+Node exporter for SAMS Software accounting
+
+Merges the data from all per job listener sockets on a node into one
+Prometheus endpoint.
+
+SAMS Software accounting
+Copyright (C) 2018-2021  Swedish National Infrastructure for Computing (SNIC)
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import errno
+import gzip
+import hashlib
+import logging
+import os
+import re
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer
+from optparse import OptionParser
+
+import sams.core
+from sams import __version__
+from sams.listener.PrometheusHTTP import MetricsHandler
+
+logger = logging.getLogger(__name__)
+
+id = "sams.node-exporter"
+
+SAMPLE_RE = re.compile(r"^([^\s{]+)(\{.*\})?\s+(.*)$")
+COMMENT_RE = re.compile(r"^#\s+(HELP|TYPE)\s+(\S+)")
+
+
+def merge(payloads):
+    """Merges Prometheus exposition format payloads.
+    HELP and TYPE are only written once for each metric family and all
+    samples of a family are written together."""
+    comments = {}
+    samples = {}
+    for payload in payloads:
+        for line in payload.decode("utf-8").splitlines():
+            m = COMMENT_RE.match(line)
+            if m:
+                comments.setdefault(m.group(2), {}).setdefault(m.group(1), line)
+                continue
+            m = SAMPLE_RE.match(line)
+            if m:
+                samples.setdefault(m.group(1), []).append(line)
+    out = []
+    for name in sorted(samples):
+        for kind in ["HELP", "TYPE"]:
+            if kind in comments.get(name, {}):
+                out.append(comments[name][kind])
+        out.extend(samples[name])
+    return ("\n".join(out) + "\n").encode("utf-8") if out else b""
+
+
+class Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, exporter):
+        self.exporter = exporter
+        super().__init__(address, MetricsHandler)
+
+    def http_payload(self):
+        return self.exporter.http_payload()
+
+
+class Exporter:
+    """Keeps a merged view of all job sockets in socketdir"""
+
+    def __init__(self, config):
+        self.config = config
+        self.socketdir = self.config.get([id, "socketdir"], "/tmp/softwareaccounting")
+        self.socket_pattern = re.compile(self.config.get([id, "socket_pattern"], r"^sams\.listener\.Prometheus_\d+\.socket$"))
+        self.refresh_interval = float(self.config.get([id, "refresh_interval"], 15))
+        self.timeout = float(self.config.get([id, "timeout"], 5))
+        self.stale_age = float(self.config.get([id, "stale_age"], 60))
+        self.executor = ThreadPoolExecutor(max_workers=int(self.config.get([id, "workers"], 8)))
+
+        self.sockets = {}
+        self._lock = threading.Lock()
+        self._merged = ('"%s"' % hashlib.sha1(b"").hexdigest(), b"", gzip.compress(b""))
+        self.exit = threading.Event()
+        self.refresh_now = threading.Event()
+
+    def _add(self, name):
+        if self.socket_pattern.match(name):
+            with self._lock:
+                self.sockets.setdefault(os.path.join(self.socketdir, name), b"")
+
+    def _remove(self, name):
+        with self._lock:
+            self.sockets.pop(os.path.join(self.socketdir, name), None)
+
+    def scan(self):
+        """Finds job sockets with scandir"""
+        with os.scandir(self.socketdir) as it:
+            names = set(entry.name for entry in it if self.socket_pattern.match(entry.name))
+        with self._lock:
+            for path in list(self.sockets):
+                if os.path.basename(path) not in names:
+                    del self.sockets[path]
+        for name in names:
+            self._add(name)
+
+    def watch(self):
+        """Follows sockets being created and removed in socketdir,
+        falls back to scanning on every refresh without inotify."""
+        try:
+            inotify = sams.core.Inotify()
+            inotify.add_watch(
+                self.socketdir,
+                inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM,
+            )
+        except OSError as e:
+            logger.info("inotify not available (%s), scanning %s on refresh", e, self.socketdir)
+            return False
+
+        def follow():
+            while not self.exit.is_set():
+                for _, mask, name in inotify.read(1):
+                    if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                        self._add(name)
+                        self.refresh_now.set()
+                    elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                        self._remove(name)
+                    elif mask & inotify.IN_Q_OVERFLOW:
+                        self.scan()
+            inotify.close()
+
+        threading.Thread(target=follow, daemon=True).start()
+        return True
+
+    def fetch(self, path):
+        """Reads the payload of one job socket, returns None if the socket is gone"""
+        try:
+            with socket.socket(socket.AF_UNIX) as client:
+                client.settimeout(self.timeout)
+                client.connect(path)
+                chunks = []
+                while True:
+                    chunk = client.recv(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                return b"".join(chunks)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            if e.errno == errno.ECONNREFUSED:
+                # Nobody listens, remove the socket if it is left by a dead collector.
+                try:
+                    if time.time() - os.stat(path).st_mtime > self.stale_age:
+                        logger.info("Removing stale socket: %s", path)
+                        os.unlink(path)
+                        return None
+                except OSError:
+                    return None
+            logger.debug("Failed to read %s: %s", path, e)
+            return b""
+
+    def refresh(self):
+        with self._lock:
+            paths = list(self.sockets)
+        for path, payload in zip(paths, self.executor.map(self.fetch, paths)):
+            with self._lock:
+                if payload is None:
+                    self.sockets.pop(path, None)
+                elif payload and path in self.sockets:
+                    # Keep the last payload if the job did not answer this time
+                    self.sockets[path] = payload
+        with self._lock:
+            merged = merge(payload for _, payload in sorted(self.sockets.items()))
+            if merged != self._merged[1]:
+                etag = '"%s"' % hashlib.sha1(merged).hexdigest()
+                self._merged = (etag, merged, gzip.compress(merged))
+
+    def http_payload(self):
+        with self._lock:
+            return self._merged
+
+    def run(self):
+        watching = self.watch()
+        self.scan()
+        while not self.exit.is_set():
+            if not watching:
+                self.scan()
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.exception(e)
+            self.refresh_now.wait(self.refresh_interval)
+            self.refresh_now.clear()
+        self.executor.shutdown()
+
+
+class Main:
+    def __init__(self):
+        # Options
+        parser = OptionParser()
+        parser.add_option(
+            "--version",
+            action="store_true",
+            dest="show_version",
+            default=False,
+            help="Show version",
+        )
+        parser.add_option(
+            "--config",
+            type="string",
+            action="store",
+            dest="config",
+            default="/etc/sams/sams-node-exporter.yaml",
+            help="Config file [%default]",
+        )
+        parser.add_option("--logfile", type="string", action="store", dest="logfile", help="Log file")
+        parser.add_option(
+            "--loglevel",
+            type="string",
+            action="store",
+            dest="loglevel",
+            help="Loglevel",
+        )
+
+        (self.options, self.args) = parser.parse_args()
+
+        if self.options.show_version:
+            print("SAMS Software Accounting version %s" % __version__)
+            sys.exit(0)
+
+        self.config = sams.core.Config(self.options.config, {})
+
+        # Logging
+        loglevel = self.options.loglevel
+        if not loglevel:
+            loglevel = self.config.get([id, "loglevel"], "ERROR")
+        if not loglevel:
+            loglevel = self.config.get(["common", "loglevel"], "ERROR")
+        loglevel_n = getattr(logging, loglevel.upper(), None)
+        if not isinstance(loglevel_n, int):
+            raise ValueError("Invalid log level: %s" % loglevel)
+        logfile = self.options.logfile
+        if not logfile:
+            logfile = self.config.get([id, "logfile"])
+        if not logfile:
+            logfile = self.config.get(["common", "logfile"])
+        logformat = self.config.get([id, "logformat"], "%(asctime)s %(name)s:%(levelname)s %(message)s")
+        if logfile:
+            logging.basicConfig(filename=logfile, filemode="a", format=logformat, level=loglevel_n)
+        else:
+            logging.basicConfig(format=logformat, level=loglevel_n)
+
+        self.exporter = Exporter(self.config)
+        signal.signal(signal.SIGHUP, self.sigHandler)
+        signal.signal(signal.SIGINT, self.sigHandler)
+        signal.signal(signal.SIGTERM, self.sigHandler)
+
+    def sigHandler(self, signum, frame):
+        self.exporter.exit.set()
+        self.exporter.refresh_now.set()
+
+    def start(self):
+        server = Server(
+            (self.config.get([id, "address"], "127.0.0.1"), int(self.config.get([id, "port"], 9102))),
+            self.exporter,
+        )
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            self.exporter.run()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    Main().start()
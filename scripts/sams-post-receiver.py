@@ -20,9 +20,19 @@ You should have received a copy of the GNU General Public License
 along with this program; If not, see <http://www.gnu.org/licenses/>.
 """
 
+import errno
+import fcntl
+import json
 import logging
 import os
+import random
+import signal
+import socket
+import socketserver
 import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from optparse import OptionParser
 
 from flask import Flask, request
@@ -36,30 +46,93 @@ logger = logging.getLogger(__name__)
 id = "sams.post-receiver"
 
 
-class Receiver(MethodView):
+class BadRequest(Exception):
+    pass
+
+
+class Limiter:
+    """Limits the number of requests handled at the same time"""
+
+    def __init__(self, max_requests, retry_after):
+        self.retry_after = int(retry_after)
+        self.semaphore = None
+        if max_requests:
+            self.semaphore = threading.BoundedSemaphore(int(max_requests))
+
+    def acquire(self):
+        if self.semaphore is None:
+            return True
+        return self.semaphore.acquire(blocking=False)
+
+    def release(self):
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+    def retry_after_value(self):
+        """Retry-After is spread out so that clients do not return at once."""
+        return self.retry_after + random.randint(0, self.retry_after)
+
+    def busy(self):
+        """Response telling the client to come back later."""
+        return "Busy", 503, {"Retry-After": str(self.retry_after_value())}
+
+
+def check_filename(filename):
+    if os.path.basename(filename) != filename or filename.startswith("."):
+        raise BadRequest("Bad filename: %s" % filename)
+
+
+def parse_record(line):
+    """Parses one line of a batch, returns (jobid, filename, body)"""
+    try:
+        record = json.loads(line)
+        jobid = int(record["jobid"])
+        filename = record["filename"]
+        data = record["data"]
+    except Exception as e:
+        raise BadRequest("Bad record: %s" % e) from e
+    check_filename(filename)
+    return jobid, filename, json.dumps(data, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+class FileStorage:
+    """Stores each record as a file in base_path/<jobid_hash>/"""
+
     def __init__(self, base_path, jobid_hash_size):
-        super(Receiver, self).__init__()
         self.base_path = base_path
         self.jobid_hash_size = jobid_hash_size
+        # Directories known to exist
+        self.dirs = set()
 
-    def post(self, jobid, filename):
+    def close(self):
+        pass
+
+    def path(self, jobid):
         base_path = self.base_path
 
         if self.jobid_hash_size is not None:
             base_path = os.path.join(base_path, str(int(int(jobid) / int(self.jobid_hash_size))))
 
-            if not os.path.isdir(base_path):
+            if base_path not in self.dirs:
                 try:
                     os.makedirs(base_path)
                 except Exception:
                     # Handle possible raise from other process
                     if not os.path.isdir(base_path):
                         assert False, "Failed to makedirs '%s' " % base_path
+                self.dirs.add(base_path)
+
+        return base_path
+
+    def write(self, jobid, filename, chunks):
+        """Writes the chunks (iterable of bytes) into filename"""
+        base_path = self.path(jobid)
 
         tfilename = ".%s" % filename
         try:
             with open(os.path.join(base_path, tfilename), "wb") as file:
-                file.write(request.data)
+                for chunk in chunks:
+                    file.write(chunk)
             os.rename(os.path.join(base_path, tfilename), os.path.join(base_path, filename))
         except Exception as err:
             logger.debug("Failed to write file")
@@ -69,9 +142,277 @@ class Receiver(MethodView):
                 # Just log unlink errors
                 logger.error("Failed to unlink tmp file")
             raise Exception("Failed to write") from err
+
+
+class SegmentStorage:
+    """Appends records as lines to rotating NDJSON segment files.
+
+    Each process writes its own segment. While open it is named
+    .<start>-<host>-<pid>-<n>.ndjson and it is renamed without the dot
+    when it is closed. The <segment>.idx file has one line for each
+    record with its jobid, filename, offset and length in the segment.
+    The open segment is locked with fcntl until it is renamed, so other
+    receivers sharing segment_path leave it alone.
+    """
+
+    def __init__(self, segment_path, segment_size, segment_max_age, fsync):
+        self.segment_path = segment_path
+        self.segment_size = int(segment_size)
+        self.segment_max_age = float(segment_max_age)
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.count = 0
+        self.name = None
+        self.segment = None
+        self.index = None
+        self.opened = None
+        os.makedirs(self.segment_path, exist_ok=True)
+        threading.Thread(target=self._rotate_old, daemon=True).start()
+
+    @staticmethod
+    def recover(segment_path):
+        """Closes segments left open by receivers that are gone,
+        segments still locked by their receiver are skipped."""
+        if not os.path.isdir(segment_path):
+            return
+        for name in os.listdir(segment_path):
+            if not (name.startswith(".") and name.endswith(".ndjson")):
+                continue
+            try:
+                segment = open(os.path.join(segment_path, name), "ab")
+            except FileNotFoundError:
+                continue
+            with segment:
+                try:
+                    fcntl.lockf(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError as e:
+                    if e.errno in (errno.EACCES, errno.EAGAIN):
+                        logger.debug("Segment is in use: %s", name)
+                        continue
+                    raise
+                logger.info("Closing segment left open: %s", name)
+                index = name[:-7] + ".idx"
+                try:
+                    if os.path.exists(os.path.join(segment_path, index)):
+                        os.rename(os.path.join(segment_path, index), os.path.join(segment_path, index[1:]))
+                    os.rename(os.path.join(segment_path, name), os.path.join(segment_path, name[1:]))
+                except FileNotFoundError:
+                    # Closed by its receiver while we were waiting for the lock
+                    continue
+
+    def _open(self):
+        self.count += 1
+        self.name = "%d-%s-%d-%d" % (time.time(), socket.gethostname(), os.getpid(), self.count)
+        self.segment = open(os.path.join(self.segment_path, ".%s.ndjson" % self.name), "wb")
+        fcntl.lockf(self.segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.index = open(os.path.join(self.segment_path, ".%s.idx" % self.name), "wb")
+        self.opened = time.time()
+
+    def _close(self):
+        if self.segment is None:
+            return
+        for file in [self.index, self.segment]:
+            file.flush()
+            os.fsync(file.fileno())
+        # The index is made visible first, a visible segment always has its index.
+        for suffix in [".idx", ".ndjson"]:
+            os.rename(
+                os.path.join(self.segment_path, ".%s%s" % (self.name, suffix)),
+                os.path.join(self.segment_path, "%s%s" % (self.name, suffix)),
+            )
+        # Closing the segment releases the lock, after it is renamed
+        for file in [self.index, self.segment]:
+            file.close()
+        logger.debug("Closed segment: %s", self.name)
+        self.segment = None
+        self.index = None
+
+    def _rotate_old(self):
+        while True:
+            time.sleep(min(self.segment_max_age, 10))
+            with self.lock:
+                if self.segment is not None and time.time() - self.opened >= self.segment_max_age:
+                    self._close()
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def write(self, jobid, filename, chunks):
+        """Appends the record to the current segment"""
+        try:
+            data = json.loads(b"".join(chunks))
+        except ValueError as e:
+            raise BadRequest("Bad JSON: %s" % e) from e
+        line = json.dumps({"jobid": int(jobid), "filename": filename, "data": data}, sort_keys=True, separators=(",", ":"))
+        line = line.encode("utf-8") + b"\n"
+
+        with self.lock:
+            if self.segment is None:
+                self._open()
+            offset = self.segment.tell()
+            self.segment.write(line)
+            self.index.write(
+                json.dumps({"jobid": int(jobid), "filename": filename, "offset": offset, "length": len(line)}).encode("utf-8") + b"\n"
+            )
+            self.segment.flush()
+            self.index.flush()
+            if self.fsync:
+                os.fsync(self.segment.fileno())
+            if self.segment.tell() >= self.segment_size:
+                self._close()
+
+
+def read_chunks(stream, size, chunk_size=65536):
+    """Yields size bytes from stream in chunks"""
+    while size > 0:
+        chunk = stream.read(min(chunk_size, size))
+        if not chunk:
+            raise BadRequest("Body shorter than Content-Length")
+        size -= len(chunk)
+        yield chunk
+
+
+class Receiver(MethodView):
+    def __init__(self, storage, limiter):
+        super(Receiver, self).__init__()
+        self.storage = storage
+        self.limiter = limiter
+
+    def dispatch_request(self, *args, **kwargs):
+        if not self.limiter.acquire():
+            logger.info("Too many requests, asking client to retry later")
+            return self.limiter.busy()
+        try:
+            if request.max_content_length is not None and (request.content_length or 0) > request.max_content_length:
+                return "Body too large", 413
+            return super(Receiver, self).dispatch_request(*args, **kwargs)
+        except BadRequest as e:
+            return str(e), 400
+        finally:
+            self.limiter.release()
+
+    def post(self, jobid, filename):
+        check_filename(filename)
+        self.storage.write(jobid, filename, iter(lambda: request.stream.read(65536), b""))
         return "OK"
 
 
+class BatchReceiver(Receiver):
+    """Receives many records in one request.
+
+    The body is newline delimited JSON where each line is
+    {"jobid": 1234, "filename": "1234.node.json", "data": {...}}
+    """
+
+    def post(self):
+        for line in request.stream:
+            if not line.strip():
+                continue
+            jobid, filename, body = parse_record(line)
+            self.storage.write(jobid, filename, [body])
+        return "OK"
+
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    """Request handler of the builtin server, streams the body to storage"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    timeout = 60
+
+    def reply(self, status, message, headers=None):
+        body = message.encode("utf-8")
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.close_connection = True
+            self.reply(411, "Content-Length required")
+            return
+        try:
+            length = int(length)
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            self.close_connection = True
+            self.reply(400, "Invalid Content-Length")
+            return
+        if self.server.max_body_size and length > self.server.max_body_size:
+            self.close_connection = True
+            self.reply(413, "Body too large")
+            return
+
+        if not self.server.limiter.acquire():
+            logger.info("Too many requests, asking client to retry later")
+            self.close_connection = True
+            self.reply(503, "Busy", {"Retry-After": str(self.server.limiter.retry_after_value())})
+            return
+        try:
+            parts = self.path.split("?")[0].strip("/").split("/")
+            if parts == ["batch"]:
+                self.batch(length)
+            elif len(parts) == 2 and parts[0].isdigit():
+                check_filename(parts[1])
+                self.server.storage.write(int(parts[0]), parts[1], read_chunks(self.rfile, length))
+            else:
+                self.close_connection = True
+                self.reply(404, "Not found")
+                return
+            self.reply(200, "OK")
+        except BadRequest as e:
+            self.close_connection = True
+            self.reply(400, str(e))
+        except Exception as e:
+            logger.exception(e)
+            self.close_connection = True
+            self.reply(500, "Failed to write")
+        finally:
+            self.server.limiter.release()
+
+    def batch(self, length):
+        while length > 0:
+            line = self.rfile.readline(length)
+            if not line:
+                raise BadRequest("Body shorter than Content-Length")
+            length -= len(line)
+            if not line.strip():
+                continue
+            jobid, filename, body = parse_record(line)
+            self.server.storage.write(jobid, filename, [body])
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug(format, *args)
+
+
+class BuiltinServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server, several processes can share the port using SO_REUSEPORT"""
+
+    daemon_threads = True
+
+    def __init__(self, address, storage, limiter, max_body_size, server_socket=None):
+        self.storage = storage
+        self.limiter = limiter
+        self.max_body_size = max_body_size
+        super().__init__(address, ReceiverHandler, bind_and_activate=server_socket is None)
+        if server_socket is not None:
+            # Share the socket bound by the parent process
+            self.socket.close()
+            self.socket = server_socket
+            self.server_address = server_socket.getsockname()
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
 class Main:
     def __init__(self):
         # Options
@@ -129,18 +470,104 @@ class Main:
             logging.basicConfig(format=logformat, level=loglevel_n)
 
     def start(self):
+        if self.config.get([id, "storage"], "files") == "segments":
+            SegmentStorage.recover(self.segment_path())
+        if self.config.get([id, "server"], "flask") == "builtin":
+            self.start_builtin()
+        else:
+            self.start_flask()
+
+    def segment_path(self):
+        return self.config.get([id, "segment_path"], self.config.get([id, "base_path"], "/tmp"))
+
+    def storage(self):
+        if self.config.get([id, "storage"], "files") == "segments":
+            return SegmentStorage(
+                self.segment_path(),
+                self.config.get([id, "segment_size"], 64 * 1024 * 1024),
+                self.config.get([id, "segment_max_age"], 300),
+                self.config.get([id, "fsync"], False),
+            )
+        return FileStorage(self.config.get([id, "base_path"], "/tmp"), self.config.get([id, "jobid_hash_size"]))
+
+    def limiter(self):
+        return Limiter(self.config.get([id, "max_requests"], 0), self.config.get([id, "retry_after"], 30))
+
+    def start_flask(self):
         app = Flask(__name__)
-        view_func = Receiver.as_view(
-            "receiver",
-            base_path=self.config.get([id, "base_path"], "/tmp"),
-            jobid_hash_size=self.config.get([id, "jobid_hash_size"]),
-        )
-        app.add_url_rule("/<int:jobid>/<filename>", view_func=view_func)
-        app.run(
-            host=self.config.get([id, "bind"], "127.0.0.1"),
-            port=self.config.get([id, "port"], 8080),
+        app.config["MAX_CONTENT_LENGTH"] = int(self.config.get([id, "max_body_size"], 0)) or None
+        storage = self.storage()
+        kwargs = dict(storage=storage, limiter=self.limiter())
+        app.add_url_rule("/<int:jobid>/<filename>", view_func=Receiver.as_view("receiver", **kwargs))
+        app.add_url_rule("/batch", view_func=BatchReceiver.as_view("batch", **kwargs))
+        try:
+            app.run(
+                host=self.config.get([id, "bind"], "127.0.0.1"),
+                port=self.config.get([id, "port"], 8080),
+                threaded=True,
+            )
+        finally:
+            storage.close()
+
+    def serve(self, server_socket=None):
+        """Runs one builtin server until SIGTERM"""
+        address = (self.config.get([id, "bind"], "127.0.0.1"), self.config.get([id, "port"], 8080))
+        storage = self.storage()
+        server = BuiltinServer(
+            address,
+            storage,
+            self.limiter(),
+            int(self.config.get([id, "max_body_size"], 0)),
+            server_socket,
         )
 
+        def stop(signum, frame):
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        server.serve_forever()
+        server.server_close()
+        storage.close()
+
+    def start_builtin(self):
+        workers = int(self.config.get([id, "workers"], 4))
+        server_socket = None
+        if not hasattr(socket, "SO_REUSEPORT"):
+            address = (self.config.get([id, "bind"], "127.0.0.1"), self.config.get([id, "port"], 8080))
+            # Bind once in the parent and share the socket with the workers
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_socket.bind(address)
+            server_socket.listen(128)
+
+        if workers <= 1:
+            self.serve(server_socket)
+            return
+
+        children = []
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self.serve(server_socket)
+                finally:
+                    os._exit(0)  # pylint: disable=protected-access
+            children.append(pid)
+        logger.info("Started %d workers: %s", workers, children)
+
+        def stop(signum, frame):
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        for pid in children:
+            os.waitpid(pid, 0)
+
 
 if __name__ == "__main__":
     Main().start()
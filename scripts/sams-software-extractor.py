@@ -21,6 +21,7 @@ along with this program; If not, see <http://www.gnu.org/licenses/>.
 """
 
 import logging
+import multiprocessing
 import sys
 from optparse import OptionParser
 
@@ -32,6 +33,12 @@ logger = logging.getLogger(__name__)
 id = "sams.software-extractor"
 
 
+def extract_part(backend, xmlwriter, shard, part):
+    """Extracts one shard of the backend into the staged files of part"""
+    files = xmlwriter.write_part(backend.extract([shard]), part)
+    return backend, files
+
+
 class Main:
     def __init__(self):
         self.xmlwriter = None
@@ -110,6 +117,12 @@ class Main:
             logger.exception(e)
             sys.exit(1)
 
+        processes = int(self.config.get([id, "processes"], 1))
+        shards = self.backend.shards() if processes > 1 else None
+        if shards:
+            self.parallel(shards, processes)
+            return
+
         try:
             data = self.backend.extract()
         except Exception as e:
@@ -118,7 +131,8 @@ class Main:
             sys.exit(1)
 
         try:
-            self.xmlwriter.write(data)
+            # The extraction is committed as the files are written.
+            self.xmlwriter.write(data, self.backend.commit)
         except Exception as e:
             logger.error("Failed to write")
             logger.exception(e)
@@ -127,6 +141,28 @@ class Main:
         # commit extraction.
         self.backend.commit()
 
+    def parallel(self, shards, processes):
+        """Extracts and writes the shards in a process pool. The files of
+        each shard are given their final names in shard order and the
+        extraction of the shard is committed as soon as they are."""
+        n = 0
+        failed = False
+        with multiprocessing.Pool(min(processes, len(shards))) as pool:
+            results = [pool.apply_async(extract_part, (self.backend, self.xmlwriter, shard, part)) for part, shard in enumerate(shards)]
+            for shard, result in zip(shards, results):
+                try:
+                    backend, files = result.get()
+                    n = self.xmlwriter.publish(files, n)
+                    # commit extraction of the shard.
+                    backend.commit()
+                except Exception as e:
+                    logger.error("Failed to extract %s", shard)
+                    logger.exception(e)
+                    failed = True
+
+        if failed:
+            sys.exit(1)
+
 
 if __name__ == "__main__":
     Main().start()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""
+Node local upload relay for SAMS Software accounting
+
+Collects the files written by sams.output.File into a node local spool
+directory and sends many jobs in one request to the batch endpoint of
+the sams-post-receiver.
+
+SAMS Software accounting
+Copyright (C) 2018-2021  Swedish National Infrastructure for Computing (SNIC)
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import logging
+import os
+import platform
+import re
+import signal
+import sys
+import threading
+from optparse import OptionParser
+
+import sams.core
+from sams import __version__
+from sams.output.Http import post, upload_delay
+
+logger = logging.getLogger(__name__)
+
+id = "sams.upload-relay"
+
+
+class Main:
+    def __init__(self):
+        # Options
+        parser = OptionParser()
+        parser.add_option(
+            "--version",
+            action="store_true",
+            dest="show_version",
+            default=False,
+            help="Show version",
+        )
+        parser.add_option(
+            "--config",
+            type="string",
+            action="store",
+            dest="config",
+            default="/etc/sams/sams-upload-relay.yaml",
+            help="Config file [%default]",
+        )
+        parser.add_option("--logfile", type="string", action="store", dest="logfile", help="Log file")
+        parser.add_option(
+            "--loglevel",
+            type="string",
+            action="store",
+            dest="loglevel",
+            help="Loglevel",
+        )
+        parser.add_option(
+            "--once",
+            action="store_true",
+            dest="once",
+            default=False,
+            help="Send the spooled files once and exit",
+        )
+
+        (self.options, self.args) = parser.parse_args()
+
+        if self.options.show_version:
+            print("SAMS Software Accounting version %s" % __version__)
+            sys.exit(0)
+
+        self.config = sams.core.Config(self.options.config, {})
+
+        # Logging
+        loglevel = self.options.loglevel
+        if not loglevel:
+            loglevel = self.config.get([id, "loglevel"], "ERROR")
+        if not loglevel:
+            loglevel = self.config.get(["common", "loglevel"], "ERROR")
+        loglevel_n = getattr(logging, loglevel.upper(), None)
+        if not isinstance(loglevel_n, int):
+            raise ValueError("Invalid log level: %s" % loglevel)
+        logfile = self.options.logfile
+        if not logfile:
+            logfile = self.config.get([id, "logfile"])
+        if not logfile:
+            logfile = self.config.get(["common", "logfile"])
+        logformat = self.config.get([id, "logformat"], "%(asctime)s %(name)s:%(levelname)s %(message)s")
+        if logfile:
+            logging.basicConfig(filename=logfile, filemode="a", format=logformat, level=loglevel_n)
+        else:
+            logging.basicConfig(format=logformat, level=loglevel_n)
+
+        self.spool_path = self.config.get([id, "spool_path"], "/var/spool/softwareaccounting/relay")
+        self.file_pattern = re.compile(self.config.get([id, "file_pattern"], r"^.*\.json$"))
+        self.error_path = self.config.get([id, "error_path"], os.path.join(self.spool_path, "error"))
+        self.uri = self.config.get([id, "uri"])
+        self.batch_size = int(self.config.get([id, "batch_size"], 500))
+        self.interval = int(self.config.get([id, "interval"], 60))
+        self.jitter_window = self.config.get([id, "jitter_window"], 0)
+
+        self.requests_kwargs = {}
+        username = self.config.get([id, "username"])
+        password = self.config.get([id, "password"])
+        if username and password:
+            self.requests_kwargs["auth"] = (username, password)
+        cert_file = self.config.get([id, "cert_file"])
+        key_file = self.config.get([id, "key_file"])
+        if key_file and cert_file:
+            self.requests_kwargs["cert"] = (cert_file, key_file)
+
+        self.exit = threading.Event()
+        signal.signal(signal.SIGHUP, self.sigHandler)
+        signal.signal(signal.SIGINT, self.sigHandler)
+        signal.signal(signal.SIGTERM, self.sigHandler)
+
+    def sigHandler(self, signum, frame):
+        self.exit.set()
+
+    def spooled(self):
+        """Yields lists of at most batch_size spooled files"""
+        batch = []
+        with os.scandir(self.spool_path) as it:
+            for entry in it:
+                # Hidden files are being written by sams.output.File
+                if entry.is_file() and not entry.name.startswith(".") and self.file_pattern.match(entry.name):
+                    batch.append(entry.name)
+                    if len(batch) >= self.batch_size:
+                        yield batch
+                        batch = []
+        if batch:
+            yield batch
+
+    def move_error(self, filename):
+        """Moves a file that can not be sent to error_path"""
+        try:
+            os.makedirs(self.error_path, exist_ok=True)
+            os.rename(os.path.join(self.spool_path, filename), os.path.join(self.error_path, filename))
+        except OSError as e:
+            logger.error("Failed to move %s to %s: %s", filename, self.error_path, e)
+
+    def send(self, filenames):
+        """Sends files in one request, removes them when the receiver has them"""
+        lines = []
+        sent = []
+        for filename in filenames:
+            path = os.path.join(self.spool_path, filename)
+            try:
+                with open(path, "r") as file:
+                    data = json.load(file)
+                jobid = int(data["sams.sampler.Core"]["jobid"])
+            except Exception as e:
+                logger.error("Failed to load %s: %s", path, e)
+                self.move_error(filename)
+                continue
+            lines.append(json.dumps({"jobid": jobid, "filename": filename, "data": data}, sort_keys=True, separators=(",", ":")))
+            sent.append(path)
+
+        if not lines:
+            return True
+
+        logger.debug("Sending %d records to: %s", len(lines), self.uri)
+        response = post(
+            self.uri,
+            "\n".join(lines) + "\n",
+            {"Content-Type": "application/x-ndjson"},
+            int(self.config.get([id, "retry_after_count"], 10)),
+            int(self.config.get([id, "retry_after_max"], 600)),
+            float(self.config.get([id, "retry_total"], 600)),
+            **self.requests_kwargs,
+        )
+        if response.status_code != 200:
+            logger.error("Failed to send %d records to: %s (%d)", len(lines), self.uri, response.status_code)
+            return False
+
+        for path in sent:
+            os.unlink(path)
+        return True
+
+    def start(self):
+        delay = upload_delay(platform.node(), self.jitter_window)
+        while not self.exit.wait(delay):
+            for batch in self.spooled():
+                try:
+                    if not self.send(batch):
+                        break
+                except Exception as e:
+                    logger.exception(e)
+                    break
+            if self.options.once:
+                break
+            delay = self.interval
+
+
+if __name__ == "__main__":
+    Main().start()
@@ -0,0 +1,100 @@
+import json
+import sqlite3
+import threading
+
+import pytest
+
+import sams.base
+import sams.core
+from sams.aggregator.SoftwareAccounting import MIGRATIONS, TABLES, Aggregator, migrate
+
+ID = "sams.aggregator.SoftwareAccounting"
+
+
+def make_config(tmp_path, **options):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(json.dumps({ID: dict({"db_path": str(tmp_path), "cluster": "C"}, **options)}))
+    return sams.core.Config(str(config_file), {})
+
+
+def test_processes_default_batch(tmp_path):
+    aggregator = Aggregator(ID, make_config(tmp_path, processes=2))
+    assert aggregator.batch_size == 100
+    assert aggregator.batch_time == 30
+
+
+def test_processes_reject_batch_size_one(tmp_path):
+    with pytest.raises(sams.base.AggregatorException):
+        Aggregator(ID, make_config(tmp_path, processes=2, batch_size=1))
+
+
+def open_db(path):
+    db = sqlite3.connect(str(path), timeout=30, check_same_thread=False)
+    db.isolation_level = None
+    return db
+
+
+def make_old_db(path):
+    """Create a user_version 0 database with duplicates left by earlier versions"""
+    db = open_db(path)
+    for sql in TABLES:
+        db.execute(sql)
+    db.executemany("INSERT INTO users(id, user) VALUES (?, ?)", [(1, "alice"), (2, "alice")])
+    db.executemany("INSERT INTO projects(id, project) VALUES (?, ?)", [(1, "p1"), (2, "p1")])
+    db.executemany("INSERT INTO node(id, node) VALUES (?, ?)", [(1, "n1"), (2, "n1")])
+    db.executemany("INSERT INTO software(id, path) VALUES (?, ?)", [(1, "/bin/a"), (2, "/bin/a")])
+    db.executemany(
+        "INSERT INTO jobs(id, jobid, recordid, user, project) VALUES (?, ?, ?, ?, ?)",
+        [(1, "1", "C:1", 1, 1), (2, "1", "C:1", 2, 2)],
+    )
+    db.executemany(
+        "INSERT INTO command(id, jobid, node, software, user, sys, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(1, 1, 1, 1, 1.0, 0.0, 0), (2, 2, 2, 2, 2.0, 0.0, 0)],
+    )
+    return db
+
+
+def test_migrate_merges_duplicates(tmp_path):
+    db = make_old_db(tmp_path / "old.db")
+    migrate(db)
+
+    assert db.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+    assert db.execute("SELECT id, user FROM users").fetchall() == [(1, "alice")]
+    assert db.execute("SELECT id, project FROM projects").fetchall() == [(1, "p1")]
+    assert db.execute("SELECT id, node FROM node").fetchall() == [(1, "n1")]
+    assert db.execute("SELECT id, path FROM software").fetchall() == [(1, "/bin/a")]
+    assert db.execute("SELECT id, jobid, user, project FROM jobs").fetchall() == [(1, "1", 1, 1)]
+    assert db.execute("SELECT id, jobid, node, software FROM command").fetchall() == [(1, 1, 1, 1)]
+    with pytest.raises(sqlite3.IntegrityError):
+        db.execute("INSERT INTO users(user) VALUES ('alice')")
+
+
+def test_concurrent_migrate(tmp_path, caplog):
+    path = tmp_path / "old.db"
+    make_old_db(path).close()
+    barrier = threading.Barrier(4)
+    errors = []
+
+    def run():
+        db = open_db(path)
+        barrier.wait()
+        try:
+            migrate(db)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            db.close()
+
+    caplog.set_level("INFO", logger="sams.aggregator.SoftwareAccounting")
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    migrated = [r.getMessage() for r in caplog.records if r.getMessage().startswith("Migrating")]
+    assert sorted(migrated) == ["Migrating database schema to version %d" % (n + 1) for n in range(len(MIGRATIONS))]
+    db = open_db(path)
+    assert db.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+    assert db.execute("SELECT count(*) FROM users").fetchone()[0] == 1
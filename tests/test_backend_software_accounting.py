@@ -0,0 +1,126 @@
+import json
+import sqlite3
+
+import pytest
+
+import sams.base
+import sams.core
+from sams.aggregator.SoftwareAccounting import MIGRATIONS, Aggregator
+from sams.backend.SoftwareAccounting import Backend
+
+AGGREGATOR = "sams.aggregator.SoftwareAccounting"
+BACKEND = "sams.backend.SoftwareAccounting"
+
+
+def make_config(tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(
+        json.dumps(
+            {
+                AGGREGATOR: {"db_path": str(tmp_path), "cluster": "C"},
+                BACKEND: {"db_path": str(tmp_path)},
+            }
+        )
+    )
+    return sams.core.Config(str(config_file), {})
+
+
+def test_backend_refuses_old_schema(tmp_path):
+    config = make_config(tmp_path)
+    aggregator = Aggregator(AGGREGATOR, config)
+    aggregator.get_db(1)
+    aggregator.close()
+    db = str(tmp_path / "sa-0.db")
+
+    Backend._open_db(db).close()
+
+    dbh = sqlite3.connect(db)
+    dbh.execute("PRAGMA user_version = 0")
+    dbh.close()
+    with pytest.raises(sams.base.BackendException, match="run sams-aggregator"):
+        Backend._open_db(db)
+    dbh = sqlite3.connect(db)
+    assert dbh.execute("PRAGMA user_version").fetchone()[0] == 0
+    dbh.close()
+
+    aggregator = Aggregator(AGGREGATOR, config)
+    aggregator.get_db(1)
+    aggregator.close()
+    dbh = Backend._open_db(db)
+    assert dbh.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+    dbh.close()
+
+
+def record(jobid):
+    return {
+        "sams.sampler.Core": {"jobid": jobid, "node": "n1"},
+        "sams.sampler.SlurmInfo": {"account": "p1", "username": "u1", "cpus": 4},
+        "sams.sampler.Software": {"start_time": 1000, "end_time": 2000, "execs": {"/sw/a/bin/x": {"user": 1.0, "system": 0.5}}},
+    }
+
+
+def extract(backend):
+    jobs = [job for job in backend.extract()]
+    backend.commit()
+    return jobs
+
+
+def test_failing_job_is_given_up(tmp_path, caplog):
+    config = make_config(tmp_path)
+    aggregator = Aggregator(AGGREGATOR, config)
+    aggregator.aggregate(record(1))
+    aggregator.close()
+    db = str(tmp_path / "sa-0.db")
+    dbh = sqlite3.connect(db)
+    # Classified without versionstr, the job can not be extracted
+    dbh.execute("UPDATE software SET software = 'a', version = '1', user_provided = 0, ignore = 0")
+    dbh.commit()
+    dbh.close()
+
+    backend = Backend(BACKEND, config)
+    for attempt in range(3):
+        assert extract(backend) == []
+    dbh = sqlite3.connect(db)
+    assert dbh.execute("SELECT count(*) FROM extract_queue").fetchone()[0] == 0
+    assert dbh.execute("SELECT attempts, error FROM extract_failed").fetchall() == [(3, "C:1 has no versionstr")]
+    errors = [r.getMessage() for r in caplog.records if r.levelname == "ERROR"]
+    assert errors == ["Giving up on job 1 after 3 attempts: C:1 has no versionstr"]
+
+    # Classifying the software again queues the job again
+    dbh.execute("UPDATE software SET versionstr = 'v1'")
+    dbh.commit()
+    dbh.close()
+    assert [job.jobid() for job in extract(backend)] == ["1"]
+
+
+def test_reclassification_requeues_extracted_jobs(tmp_path):
+    config = make_config(tmp_path)
+    aggregator = Aggregator(AGGREGATOR, config)
+    aggregator.aggregate(record(1))
+    aggregator.aggregate(record(2))
+    aggregator.close()
+    db = str(tmp_path / "sa-0.db")
+    dbh = sqlite3.connect(db)
+    dbh.execute("UPDATE software SET software = 'a', version = '1', versionstr = 'a/1', user_provided = 0, ignore = 0")
+    dbh.commit()
+
+    backend = Backend(BACKEND, config)
+    jobs = extract(backend)
+    assert [job.jobid() for job in jobs] == ["1", "2"]
+    assert [s.version for s in jobs[0].softwares(0.0)] == ["1"]
+    assert extract(backend) == []
+    assert dbh.execute("SELECT count(*) FROM extract_queue").fetchone()[0] == 0
+
+    # Both already extracted jobs are sent again with the new version
+    dbh.execute("UPDATE software SET version = '2', versionstr = 'a/2'")
+    dbh.commit()
+    jobs = extract(backend)
+    assert [job.jobid() for job in jobs] == ["1", "2"]
+    assert [s.version for job in jobs for s in job.softwares(0.0)] == ["2", "2"]
+    assert extract(backend) == []
+
+    # Ignored software does not queue the jobs again
+    dbh.execute("UPDATE software SET ignore = 1")
+    dbh.commit()
+    dbh.close()
+    assert extract(backend) == []
@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+import sams.core
+from sams.backend.SoftwareAccountingPW import Backend, Command, Job
+
+ID = "sams.backend.SoftwareAccountingPW"
+
+
+def record(jobid, path):
+    return {
+        "sams.sampler.Core": {"jobid": jobid, "node": "n1"},
+        "sams.sampler.SlurmInfo": {"account": "p1", "username": "u1", "cpus": 4},
+        "sams.sampler.Software": {"start_time": 1000, "end_time": 2000, "execs": {path: {"user": 1.0, "system": 0.5}}},
+    }
+
+
+@pytest.mark.parametrize("bulk_load", ["insert", "staging"])
+def test_duplicated_job_uses_lowest_id(tmp_path, bulk_load):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(
+        json.dumps(
+            {
+                ID: {
+                    "cluster": "C",
+                    "create_tables": "yes",
+                    "database": "sqlite",
+                    "database_options": {"database": str(tmp_path / "pw.db")},
+                    "bulk_load": bulk_load,
+                }
+            }
+        )
+    )
+    backend = Backend(ID, sams.core.Config(str(config_file), {}))
+    # Duplicates left by earlier versions
+    Job.insert(id=7, jobid="1").execute()
+    Job.insert(id=3, jobid="1").execute()
+    # Catches queries that depend on the order of an unordered SELECT
+    backend.db.execute_sql("PRAGMA reverse_unordered_selects = ON")
+
+    backend.aggregate(record(1, "/sw/a/bin/x"))
+    backend.flush()
+    backend.aggregate(record(1, "/sw/b/bin/y"))
+    backend.flush()
+    assert [job for (job,) in Command.select(Command.job).tuples()] == [3, 3]
@@ -0,0 +1,50 @@
+import gzip
+import socket
+import threading
+
+from sams.listener.PrometheusHTTP import MetricsHandler
+
+
+class Server:
+    def http_payload(self):
+        return '"abc"', b"metric 1\n", gzip.compress(b"metric 1\n")
+
+
+def serve(connection):
+    with connection:
+        MetricsHandler(connection, "", Server())
+
+
+def get(*headers):
+    client, server = socket.socketpair()
+    thread = threading.Thread(target=serve, args=(server,))
+    thread.start()
+    client.sendall(("GET /metrics HTTP/1.0\r\n" + "".join("%s\r\n" % h for h in headers) + "\r\n").encode())
+    response = b""
+    while True:
+        data = client.recv(65536)
+        if not data:
+            break
+        response += data
+    thread.join()
+    client.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    lines = head.decode().split("\r\n")
+    return int(lines[0].split()[1]), dict(line.split(": ", 1) for line in lines[1:]), body
+
+
+def test_etag_per_encoding():
+    status, headers, body = get()
+    assert (status, headers["ETag"], body) == (200, '"abc"', b"metric 1\n")
+    assert headers["Vary"] == "Accept-Encoding"
+
+    status, headers, body = get("Accept-Encoding: gzip")
+    assert (status, headers["ETag"], headers["Content-Encoding"]) == (200, '"abc-gz"', "gzip")
+    assert gzip.decompress(body) == b"metric 1\n"
+
+    assert get('If-None-Match: "abc"')[0] == 304
+    assert get("Accept-Encoding: gzip", 'If-None-Match: "abc-gz"')[0] == 304
+    # The identity representation does not match the gzip one
+    assert get("Accept-Encoding: gzip", 'If-None-Match: "abc"')[0] == 200
+    status, headers, _ = get('If-None-Match: "abc-gz"')
+    assert (status, "Content-Encoding" in headers) == (200, False)
@@ -0,0 +1,144 @@
+import errno
+import json
+import os
+import time
+
+import pytest
+
+import sams.core
+from sams.loader.File import Loader
+
+ID = "sams.loader.File"
+
+
+def make_loader(tmp_path, **options):
+    config_file = tmp_path / "config.yaml"
+    defaults = {
+        "in_path": str(tmp_path / "in"),
+        "archive_path": str(tmp_path / "archive"),
+        "error_path": str(tmp_path / "error"),
+        "file_pattern": r"^.*\.json$",
+    }
+    config_file.write_text(json.dumps({ID: dict(defaults, **options)}))
+    return Loader(ID, sams.core.Config(str(config_file), {}))
+
+
+def write_record(path, jobid):
+    path.mkdir(parents=True, exist_ok=True)
+    (path / ("%d.n.json" % jobid)).write_text(json.dumps({"jobid": jobid}))
+
+
+def write_heartbeat(root, pid, age=0):
+    root.mkdir(parents=True, exist_ok=True)
+    heartbeat = root / ".heartbeat"
+    heartbeat.write_text("%d\n" % pid)
+    os.utime(heartbeat, (time.time() - age, time.time() - age))
+
+
+def test_claim_error_skips_file(tmp_path, monkeypatch):
+    write_record(tmp_path / "in", 1)
+    loader = make_loader(tmp_path, claim_path=str(tmp_path / "claims"), instance="a")
+    loader.load()
+
+    def rename(source, destination):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(os, "rename", rename)
+    assert loader.next() is None
+    monkeypatch.undo()
+    loader.close()
+    assert os.listdir(tmp_path / "in") == ["1.n.json"]
+
+
+def test_recover_own_claims_of_stopped_process(tmp_path):
+    write_record(tmp_path / "claims" / "a", 1)
+    # No process has this pid
+    write_heartbeat(tmp_path / "claims" / "a", 2**22 + 1)
+    loader = make_loader(tmp_path, claim_path=str(tmp_path / "claims"), instance="a")
+    loader.load()
+    assert loader.next() == {"jobid": 1}
+    loader.close()
+
+
+def test_same_instance_running(tmp_path):
+    write_heartbeat(tmp_path / "claims" / "a", os.getppid())
+    loader = make_loader(tmp_path, claim_path=str(tmp_path / "claims"), instance="a")
+    with pytest.raises(Exception, match="already running"):
+        loader.load()
+
+
+def test_recover_stale_claims_while_running(tmp_path):
+    (tmp_path / "in").mkdir()
+    loader = make_loader(tmp_path, claim_path=str(tmp_path / "claims"), instance="a", stale_claim_age=60)
+    loader.load()
+    assert loader.next() is None
+
+    # b stops after a has started
+    write_record(tmp_path / "claims" / "b" / "x", 2)
+    write_heartbeat(tmp_path / "claims" / "b", os.getpid(), age=10)
+    loader._recover_claims()
+    assert not (tmp_path / "in" / "x").exists()
+
+    write_heartbeat(tmp_path / "claims" / "b", os.getpid(), age=120)
+    loader._recover_claims()
+    assert os.listdir(tmp_path / "in" / "x") == ["2.n.json"]
+    loader.load()
+    assert loader.next() == {"jobid": 2}
+    loader.close()
+
+
+def loaded(loader):
+    records = []
+    loader.load()
+    while True:
+        record = loader.next()
+        if record is None:
+            return records
+        records.append(record)
+        loader.commit()
+
+
+def test_checkpoints_are_not_loaded(tmp_path):
+    write_record(tmp_path / "in", 1)
+    (tmp_path / "in" / "1.n.json.checkpoint").write_text(json.dumps({"jobid": "partial"}))
+    (tmp_path / "in" / ".2.n.json").write_text(json.dumps({"jobid": "temporary"}))
+    # Job 3 is still running
+    (tmp_path / "in" / "3.n.json.checkpoint").write_text(json.dumps({"jobid": 3}))
+    loader = make_loader(tmp_path, file_pattern=None)
+    assert loaded(loader) == [{"jobid": 1}]
+    loader.close()
+    assert sorted(os.listdir(tmp_path / "in")) == [".2.n.json", "1.n.json.checkpoint", "3.n.json.checkpoint"]
+
+
+def test_orphaned_checkpoint_is_loaded(tmp_path):
+    (tmp_path / "in").mkdir()
+    checkpoint = tmp_path / "in" / "3.n.json.checkpoint"
+    checkpoint.write_text(json.dumps({"jobid": 3}))
+    os.utime(checkpoint, (time.time() - 7200, time.time() - 7200))
+    loader = make_loader(tmp_path, checkpoint_age=3600)
+    assert loaded(loader) == [{"jobid": 3}]
+    loader.close()
+    assert os.listdir(tmp_path / "in") == []
+    assert os.listdir(tmp_path / "archive" / ".") == ["3.n.json"]
+
+
+def test_cursor_resume_across_directories(tmp_path):
+    for directory, jobid in [("a/x", 1), ("a/y", 2), ("b", 3), ("c", 4)]:
+        write_record(tmp_path / "in" / directory, jobid)
+    cursor_file = tmp_path / "cursor"
+    loader = make_loader(tmp_path, cursor_file=str(cursor_file), lookahead=1)
+    loader.load()
+    for jobid in [1, 2]:
+        assert loader.next() == {"jobid": jobid}
+        loader.commit()
+    # Crash while in a/y
+    assert json.loads(cursor_file.read_text()) == ["a", "y"]
+
+    # Directories before the cursor are not scanned again
+    write_record(tmp_path / "in" / "a" / "x", 5)
+    loader = make_loader(tmp_path, cursor_file=str(cursor_file), lookahead=1)
+    assert loaded(loader) == [{"jobid": 3}, {"jobid": 4}]
+    assert not cursor_file.exists()
+
+    # The next walk starts from the beginning
+    assert loaded(loader) == [{"jobid": 5}]
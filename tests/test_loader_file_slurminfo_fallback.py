@@ -0,0 +1,76 @@
+import json
+import stat
+
+import sams.core
+from sams.loader.FileSlurmInfoFallback import Loader, SacctLoader
+
+ID = "sams.loader.FileSlurmInfoFallback"
+
+SACCT = """#!/bin/sh
+echo "$@" >> %(calls)s
+[ -e %(fail)s ] && exit 1
+for jobid in $(echo "$3" | tr , ' '); do
+    [ $((jobid %% 2)) -eq 1 ] && echo "$jobid|p1|2024-01-01T00:00:00|u1|1|4|normal|1000"
+done
+exit 0
+"""
+
+
+def make_sacct(tmp_path):
+    sacct = tmp_path / "sacct"
+    sacct.write_text(SACCT % {"calls": tmp_path / "calls", "fail": tmp_path / "fail"})
+    sacct.chmod(sacct.stat().st_mode | stat.S_IEXEC)
+    return str(sacct)
+
+
+def calls(tmp_path):
+    return (tmp_path / "calls").read_text().splitlines() if (tmp_path / "calls").exists() else []
+
+
+def test_prefetch_walked_files(tmp_path):
+    in_path = tmp_path / "in"
+    in_path.mkdir()
+    for jobid in [1, 3, 5, 7]:
+        (in_path / ("%d.n.json" % jobid)).write_text(json.dumps({"sams.sampler.Core": {"jobid": jobid}}))
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(
+        json.dumps(
+            {
+                ID: {
+                    "in_path": str(in_path),
+                    "archive_path": str(tmp_path / "archive"),
+                    "error_path": str(tmp_path / "error"),
+                    "sacct": make_sacct(tmp_path),
+                }
+            }
+        )
+    )
+    loader = Loader(ID, sams.core.Config(str(config_file), {}))
+    loader.load()
+    jobids = []
+    while True:
+        data = loader.next()
+        if data is None:
+            break
+        assert data["sams.sampler.SlurmInfo"]["account"] == "p1"
+        jobids.append(data["sams.sampler.Core"]["jobid"])
+        loader.commit()
+    loader.close()
+    assert jobids == [1, 3, 5, 7]
+    # One sacct for all files
+    assert len(calls(tmp_path)) == 1
+    with open(tmp_path / "archive" / "." / "3.n.json") as file:
+        assert json.load(file)["sams.sampler.SlurmInfo"]["username"] == "u1"
+
+
+def test_failed_sacct_is_not_cached(tmp_path):
+    sacct = SacctLoader(make_sacct(tmp_path), {}, chunk_size=2)
+    (tmp_path / "fail").touch()
+    sacct.prefetch([1, 2, 3, 4])
+    assert not any(sacct.cached(jobid) for jobid in [1, 2, 3, 4])
+    (tmp_path / "fail").unlink()
+    sacct.prefetch([1, 2, 3, 4])
+    assert [sacct.cached(jobid) for jobid in [1, 2, 3, 4]] == [True, True, True, True]
+    assert sacct.run(3)["account"] == "p1"
+    assert 2 in sacct.not_found
+    assert len(calls(tmp_path)) == 4
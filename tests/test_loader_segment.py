@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+import sams.core
+from sams.loader.Segment import Loader
+
+ID = "sams.loader.Segment"
+SEGMENT = "1000-host-1-1"
+
+
+def write_segment(path, jobids, index=True):
+    path.mkdir(exist_ok=True)
+    offset = 0
+    with open(path / (SEGMENT + ".ndjson"), "wb") as segment, open(path / (SEGMENT + ".idx"), "wb") as idx:
+        for jobid in jobids:
+            line = json.dumps({"jobid": jobid, "filename": "%d.n.json" % jobid, "data": {"jobid": jobid}}).encode() + b"\n"
+            segment.write(line)
+            if index:
+                idx.write(json.dumps({"jobid": jobid, "offset": offset, "length": len(line)}).encode() + b"\n")
+            offset += len(line)
+
+
+def make_loader(tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(
+        json.dumps(
+            {
+                ID: {
+                    "in_path": str(tmp_path / "in"),
+                    "archive_path": str(tmp_path / "archive"),
+                    "error_path": str(tmp_path / "error"),
+                }
+            }
+        )
+    )
+    loader = Loader(ID, sams.core.Config(str(config_file), {}))
+    loader.load()
+    return loader
+
+
+def error_jobids(tmp_path):
+    with open(tmp_path / "error" / (SEGMENT + ".ndjson")) as file:
+        return [json.loads(line)["jobid"] for line in file]
+
+
+@pytest.mark.parametrize("index", [True, False])
+def test_failed_records_are_not_loaded_again(tmp_path, index):
+    write_segment(tmp_path / "in", [1, 2, 3, 4, 5], index)
+    loader = make_loader(tmp_path)
+    batch = []
+    for _ in range(4):
+        loader.next()
+        batch.append(loader.current())
+    # Partial batch failure, 3 fails and the aggregator dies before 1 is committed
+    loader.commit(batch[1])
+    loader.error(batch[2])
+
+    loader = make_loader(tmp_path)
+    jobids = []
+    while True:
+        data = loader.next()
+        if data is None:
+            break
+        jobids.append(data["jobid"])
+        loader.commit()
+    loader.close()
+    assert jobids == [1, 4, 5]
+    assert error_jobids(tmp_path) == [3]
+    assert sorted(p.name for p in (tmp_path / "archive").iterdir()) == [SEGMENT + ".idx", SEGMENT + ".ndjson"]
+    assert not (tmp_path / "in" / (SEGMENT + ".ndjson")).exists()
@@ -0,0 +1,64 @@
+import pytest
+import requests
+
+import sams.output.Http as http
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(http.time, "time", clock.time)
+    monkeypatch.setattr(http.time, "sleep", clock.sleep)
+    return clock
+
+
+def test_post_gives_up_after_retry_total(clock, monkeypatch):
+    def post(*args, **kwargs):
+        raise requests.ConnectionError("refused")
+
+    monkeypatch.setattr(http.requests, "post", post)
+    with pytest.raises(requests.ConnectionError):
+        http.post("http://receiver/1/1.n.json", "{}", {}, retry_count=10, retry_max=600, retry_total=100)
+    assert clock.sleeps == [30, 30, 30]
+
+
+def test_post_busy_gives_up_after_retry_total(clock, monkeypatch):
+    class Response:
+        status_code = 503
+        headers = {"Retry-After": "50"}
+
+    timeouts = []
+
+    def post(*args, **kwargs):
+        timeouts.append(kwargs["timeout"])
+        return Response()
+
+    monkeypatch.setattr(http.requests, "post", post)
+    response = http.post("http://receiver/1/1.n.json", "{}", {}, retry_count=10, retry_max=600, retry_total=120)
+    assert response.status_code == 503
+    assert clock.sleeps == [50, 50]
+    assert timeouts == [120, 70, 20]
+
+
+def test_post_without_retry_total(clock, monkeypatch):
+    def post(*args, **kwargs):
+        assert kwargs["timeout"] is None
+        raise requests.ConnectionError("refused")
+
+    monkeypatch.setattr(http.requests, "post", post)
+    with pytest.raises(requests.ConnectionError):
+        http.post("http://receiver/1/1.n.json", "{}", {}, retry_count=3, retry_max=10)
+    assert clock.sleeps == [10, 10, 10]
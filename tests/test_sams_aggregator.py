@@ -0,0 +1,79 @@
+import importlib.util
+import json
+import os
+
+import sams.core
+
+SCRIPT = os.path.join(os.path.dirname(__file__), "..", "scripts", "sams-aggregator.py")
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location("sams_aggregator", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def record(jobid):
+    return {
+        "sams.sampler.Core": {"jobid": jobid, "node": "n1"},
+        "sams.sampler.SlurmInfo": {"account": "p1", "username": "u1", "cpus": 4},
+        "sams.sampler.Software": {"start_time": 1000, "end_time": 2000, "execs": {"/sw/a/bin/x": {"user": 1.0, "system": 0.5}}},
+    }
+
+
+def test_malformed_record_in_batch_with_processes(tmp_path):
+    in_path = tmp_path / "in"
+    in_path.mkdir()
+    for jobid in range(1, 6):
+        data = record(jobid)
+        if jobid == 3:
+            # Fails in Aggregator.aggregate before it is sent to a worker
+            del data["sams.sampler.Core"]
+        if jobid == 5:
+            # Fails in the worker process
+            del data["sams.sampler.SlurmInfo"]
+        with open(in_path / ("%d.n.json" % jobid), "w") as file:
+            json.dump(data, file)
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(
+        json.dumps(
+            {
+                "sams.loader.File": {
+                    "in_path": str(in_path),
+                    "archive_path": str(tmp_path / "archive"),
+                    "error_path": str(tmp_path / "error"),
+                    "file_pattern": r"^.*\.json$",
+                },
+                "sams.aggregator.SoftwareAccounting": {
+                    "db_path": str(tmp_path / "db"),
+                    "cluster": "C",
+                    "processes": 1,
+                    "batch_size": 10,
+                },
+            }
+        )
+    )
+    os.mkdir(tmp_path / "db")
+    config = sams.core.Config(str(config_file), {})
+    loader = sams.core.ClassLoader.load("sams.loader.File", "Loader")("sams.loader.File", config)
+    aggregator = sams.core.ClassLoader.load("sams.aggregator.SoftwareAccounting", "Aggregator")(
+        "sams.aggregator.SoftwareAccounting", config
+    )
+
+    main = object.__new__(load_script().Main)
+    main.loaders = [loader]
+    main.aggregators = [aggregator]
+    main.exit = None
+
+    loader.load()
+    pending = []
+    calls = {aggregator: []}
+    main.run(loader, pending, calls)
+    main.flush(loader, pending, calls)
+    loader.close()
+    aggregator.close()
+
+    files = lambda path: sorted(name for _, _, names in os.walk(path) for name in names)  # noqa: E731
+    assert files(tmp_path / "error") == ["3.n.json", "5.n.json"]
+    assert files(tmp_path / "archive") == ["1.n.json", "2.n.json", "4.n.json"]